@@ -1,6 +1,8 @@
 import os
 import sys
-from src.agent.graph import app
+from src.agent.graph import get_app
+from src.agent.checkpoint import RunFinishedError, run_input, thread_config
+from src.agent.progress import stream_graph_events
 
 def main():
     # if "OPENAI_API_KEY" not in os.environ:
@@ -9,8 +11,14 @@ def main():
     #    # but for now we enforce it as the agent relies on LLM.
     #    return
 
-    if len(sys.argv) > 1:
-        user_request = " ".join(sys.argv[1:])
+    args = sys.argv[1:]
+    # --thread <id> names the checkpoint thread; an unfinished run of it is resumed.
+    thread_id = None
+    if args[:1] == ["--thread"] and len(args) > 1:
+        thread_id, args = args[1], args[2:]
+
+    if args:
+        user_request = " ".join(args)
     else:
         user_request = "Plan a refactor for usb_alloc_urb to use gfp_flags."
     
@@ -23,21 +31,35 @@ def main():
         "status": "start"
     }
     
+    app = get_app()
+    config = thread_config(thread_id)
+    try:
+        graph_input = run_input(app, config, initial_state)
+    except RunFinishedError as e:
+        print(e)
+        return
+    thread_id = config["configurable"]["thread_id"]
+    print(f"Thread: {thread_id}" + (" (resuming)" if graph_input is None else ""))
+    
     try:
-        for event in app.stream(initial_state):
-            for key, value in event.items():
-                print(f"\n--- Node: {key} ---")
-                # Print relevant info based on node
-                if key == "architect":
-                    print(f"Generated Script:\n{value.get('cocci_script', '')[:100]}...")
-                elif key == "test_gen":
-                    print(f"Generated Mock Code:\n{value.get('mock_c_code', '')[:100]}...")
-                elif key == "validator":
-                    print(f"Validation Status: {value.get('status')}")
-                    if value.get('patch_diff'):
-                        print(f"Patch Generated:\n{value.get('patch_diff')}")
-                elif key == "refiner":
-                    print("Refining script...")
+        for event in stream_graph_events(app, graph_input, config):
+            if event["event"] == "node":
+                scope = "/".join(event["namespace"] + [event["node"]])
+                print(f"\n--- Node: {scope} ({event['duration']:.2f}s, at {event['elapsed']:.2f}s) ---")
+                update = event["update"] or {}
+                # Print the artifacts as soon as they are produced
+                if update.get("strategy"):
+                    print(f"Strategy: {update['strategy']}")
+                if update.get("cocci_script"):
+                    print(f"Script:\n{update['cocci_script'][:300]}...")
+                if update.get("validation_error"):
+                    print(f"Validation: {update['validation_error']}")
+                if update.get("patch_preview"):
+                    print(f"Patch Preview:\n{update['patch_preview']}")
+            elif event["event"] == "progress":
+                print(f"  [{event['elapsed']:.2f}s] {event['data']}")
+            elif event["event"] == "done":
+                print(f"\nFinished in {event['elapsed']:.2f}s with status {event['state'].get('status')}.")
     except Exception as e:
         print(f"Error running agent: {e}")
 
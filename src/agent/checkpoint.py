@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import uuid
+from typing import Any, Dict, List, Optional
+from langgraph.checkpoint.sqlite import SqliteSaver
+from src.mcp_server.cache import get_cache_dir
+
+# Durable checkpoints of graph runs.
+# The main graph and the SPG subgraph are compiled with one SQLite checkpointer, so every
+# completed node of a run (identified by its thread id) is on disk. A run that crashed or
+# was stopped is resumed from its last completed node, including inside the subgraph, and
+# the intermediate states of any run can be read back without executing a node.
+
+class RunFinishedError(ValueError):
+    """The thread id names a run that already finished; its checkpoints are not reused."""
+
+def checkpoint_db_path() -> str:
+    """SQLite file of the checkpoints: LK_SPG_CHECKPOINT_DB (":memory:" keeps them for the process only)."""
+    return os.environ.get("LK_SPG_CHECKPOINT_DB") or os.path.join(get_cache_dir(), "checkpoints.sqlite3")
+
+def open_checkpointer(db_path: Optional[str] = None) -> SqliteSaver:
+    """A SqliteSaver on db_path (default checkpoint_db_path()), shareable across threads."""
+    # SqliteSaver serialises access to the connection with its own lock.
+    return SqliteSaver(sqlite3.connect(db_path or checkpoint_db_path(), check_same_thread=False))
+
+def thread_config(thread_id: Optional[str] = None) -> Dict[str, Any]:
+    """Run config for the given thread id (a new one if None)."""
+    return {"configurable": {"thread_id": thread_id or uuid.uuid4().hex}}
+
+def pending_nodes(graph: Any, config: Dict[str, Any]) -> List[str]:
+    """Nodes a checkpointed run still has to execute (empty for new or finished runs)."""
+    if graph.checkpointer is None:
+        return []
+    return list(graph.get_state(config).next)
+
+def run_finished(graph: Any, config: Dict[str, Any]) -> bool:
+    """Whether the thread holds a run that ran to completion."""
+    if graph.checkpointer is None:
+        return False
+    snapshot = graph.get_state(config)
+    return snapshot.created_at is not None and not snapshot.next
+
+def run_input(graph: Any, config: Dict[str, Any], state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    The input to run the thread with: None resumes an unfinished run, otherwise state.
+
+    Raises:
+        RunFinishedError: The thread's run already finished. Starting a new run on top of
+            it would inherit its channel values (strategy, outputs), so a new thread is needed.
+    """
+    if pending_nodes(graph, config):
+        return None
+    if run_finished(graph, config):
+        raise RunFinishedError(f"Run {config['configurable']['thread_id']} already finished; start a new thread.")
+    return state
+
+def run_history(graph: Any, thread_id: str) -> List[Dict[str, Any]]:
+    """
+    Reads the checkpoints of a run back from the database, oldest first; nothing is executed.
+    Subgraph checkpoints are read through the graph by their namespace, so the subgraph
+    must be discoverable by LangGraph (see spg_agent_node in src/agent/graph.py).
+
+    Returns:
+        One entry per checkpoint: "namespace" ([] for the main graph, ["spg_agent"] for the
+        SPG subgraph), "step", "source" (input / loop / update), "ts", "next" (the nodes
+        scheduled after it), "values" (the state at that point) and "checkpoint_id".
+    """
+    if graph.checkpointer is None:
+        return []
+    # Listing without a namespace yields the checkpoints of every namespace of the thread.
+    namespaces = dict.fromkeys(
+        saved.config["configurable"].get("checkpoint_ns", "")
+        for saved in graph.checkpointer.list(thread_config(thread_id))
+    )
+    entries = []
+    for checkpoint_ns in namespaces:
+        config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}}
+        for snapshot in graph.get_state_history(config):
+            entries.append({
+                # Nested namespaces look like "spg_agent:<task id>|..."; keep the node names.
+                "namespace": [part.split(":")[0] for part in checkpoint_ns.split("|")] if checkpoint_ns else [],
+                "step": snapshot.metadata.get("step"),
+                "source": snapshot.metadata.get("source"),
+                "ts": snapshot.created_at,
+                "next": list(snapshot.next),
+                "values": snapshot.values,
+                "checkpoint_id": snapshot.config["configurable"]["checkpoint_id"],
+            })
+    entries.sort(key=lambda e: e["ts"])
+    return entries
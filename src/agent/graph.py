@@ -1,6 +1,9 @@
-from typing import Dict, Any, Literal
+import os
+from typing import Any, Callable, Dict, Literal
 from langgraph.graph import StateGraph, END
 from src.agent.state import AgentState, SpgState
+from src.agent.checkpoint import open_checkpointer
+from src.agent.runtime import Lazy
 from src.agent.nodes import (
     analyze_feasibility,
     node_rag_retrieve,
@@ -8,11 +11,23 @@ from src.agent.nodes import (
     node_syntax_check,
     node_dry_run,
     node_refine_script,
+    node_discover_targets,
     node_apply_real,
     llm_refactor_agent
 )
 
 # --- Define SPG Subgraph ---
+def check_draft_router(state: SpgState) -> Literal["syntax_check", "discover_targets", "refine_script", "failed"]:
+    # Speculative drafting validates its candidates itself (see src/agent/speculative.py).
+    status = state.get("status")
+    if status == "success":
+        return "discover_targets"
+    if status == "speculative_failed":
+        if state["iteration_count"] >= 5:
+            return "failed"
+        return "refine_script"
+    return "syntax_check"
+
 def check_syntax_router(state: SpgState) -> Literal["dry_run", "refine_script", "failed"]:
     if state["status"] == "syntax_ok":
         return "dry_run"
@@ -22,9 +37,9 @@ def check_syntax_router(state: SpgState) -> Literal["dry_run", "refine_script",
         
     return "refine_script"
 
-def check_dry_run_router(state: SpgState) -> Literal["apply_real", "refine_script", "failed"]:
+def check_dry_run_router(state: SpgState) -> Literal["discover_targets", "refine_script", "failed"]:
     if state["status"] == "success":
-        return "apply_real"
+        return "discover_targets"
     
     if state["iteration_count"] >= 5: 
         return "failed"
@@ -37,11 +52,23 @@ spg_workflow.add_node("architect_draft", node_architect_draft)
 spg_workflow.add_node("syntax_check", node_syntax_check)
 spg_workflow.add_node("dry_run", node_dry_run)
 spg_workflow.add_node("refine_script", node_refine_script)
+spg_workflow.add_node("discover_targets", node_discover_targets)
 spg_workflow.add_node("apply_real", node_apply_real)
 
 spg_workflow.set_entry_point("rag_retrieve")
 spg_workflow.add_edge("rag_retrieve", "architect_draft")
-spg_workflow.add_edge("architect_draft", "syntax_check")
+
+# Draft Router
+spg_workflow.add_conditional_edges(
+    "architect_draft",
+    check_draft_router,
+    {
+        "syntax_check": "syntax_check",
+        "discover_targets": "discover_targets",
+        "refine_script": "refine_script",
+        "failed": END
+    }
+)
 
 # Syntax Check Router
 spg_workflow.add_conditional_edges(
@@ -59,7 +86,7 @@ spg_workflow.add_conditional_edges(
     "dry_run",
     check_dry_run_router,
     {
-        "apply_real": "apply_real",
+        "discover_targets": "discover_targets",
         "refine_script": "refine_script",
         "failed": END
     }
@@ -68,25 +95,41 @@ spg_workflow.add_conditional_edges(
 # Refine Loop
 spg_workflow.add_edge("refine_script", "syntax_check")
 
+spg_workflow.add_edge("discover_targets", "apply_real")
 spg_workflow.add_edge("apply_real", END)
-spg_subgraph = spg_workflow.compile()
+
+# Both graphs checkpoint into the same database: a run resumed by thread id picks up the
+# subgraph where it stopped too (see src/agent/checkpoint.py). The database is opened and
+# the graphs compiled on first use, not at import.
+_checkpointer = Lazy(open_checkpointer)
+_spg_subgraph = Lazy(lambda: spg_workflow.compile(checkpointer=get_checkpointer()))
+
+def get_checkpointer() -> Any:
+    """The checkpointer shared by the main graph and the SPG subgraph."""
+    return _checkpointer.get()
+
+def get_spg_subgraph() -> Any:
+    """The compiled, checkpointed SPG subgraph."""
+    return _spg_subgraph.get()
 
 
 # --- Wrapper for Subgraph Integration ---
-def spg_agent_wrapper(state: AgentState) -> Dict[str, Any]:
+def spg_agent_wrapper(state: AgentState, spg_subgraph: Any = None) -> Dict[str, Any]:
     print(">>> Entering SPG Subgraph >>>")
     
     # Map AgentState to SpgState
-    # Note: target_files logic needs to be robust. 
-    # For now, we pass empty list if not found, node_apply_real handles it.
-    # Ideally, we'd extract this from feasibility_result or user_request.
+    # target_files starts empty; node_discover_targets fills it from the kernel tree
+    # once the script has passed the dry run.
     subgraph_input = {
         "task_description": state['user_request'],
-        "target_files": [], # TODO: Extract targets from analysis
+        "target_files": [],
+        "kernel_dir": state.get('kernel_dir') or os.environ.get("LK_SPG_KERNEL_DIR"),
         "iteration_count": 0
     }
     
-    result = spg_subgraph.invoke(subgraph_input)
+    # Inside a checkpointed run the subgraph inherits its thread; on resume the input is
+    # ignored and the subgraph continues from its last completed node.
+    result = (spg_subgraph or get_spg_subgraph()).invoke(subgraph_input)
     
     return {
         "spg_output": result,
@@ -94,6 +137,16 @@ def spg_agent_wrapper(state: AgentState) -> Dict[str, Any]:
         "status": result.get("status")
     }
 
+def spg_agent_node(spg_subgraph: Any) -> Callable[[AgentState], Dict[str, Any]]:
+    """
+    The main graph's spg_agent node around a compiled subgraph. LangGraph finds the
+    subgraph through the closure, so its checkpoints can be read back by namespace
+    (see run_history in src/agent/checkpoint.py).
+    """
+    def spg_agent(state: AgentState) -> Dict[str, Any]:
+        return spg_agent_wrapper(state, spg_subgraph)
+    return spg_agent
+
 # --- Define Main Graph ---
 def strategy_router(state: AgentState) -> Literal["spg_agent", "llm_refactor"]:
     strategy = state.get("strategy", "LLM_DIRECT")
@@ -101,27 +154,34 @@ def strategy_router(state: AgentState) -> Literal["spg_agent", "llm_refactor"]:
         return "spg_agent"
     return "llm_refactor"
 
-main_workflow = StateGraph(AgentState)
-main_workflow.add_node("analyze_feasibility", analyze_feasibility)
-main_workflow.add_node("spg_agent", spg_agent_wrapper)
-main_workflow.add_node("llm_refactor", llm_refactor_agent)
+def build_main_workflow(spg_subgraph: Any) -> StateGraph:
+    main_workflow = StateGraph(AgentState)
+    main_workflow.add_node("analyze_feasibility", analyze_feasibility)
+    main_workflow.add_node("spg_agent", spg_agent_node(spg_subgraph))
+    main_workflow.add_node("llm_refactor", llm_refactor_agent)
 
-main_workflow.set_entry_point("analyze_feasibility")
+    main_workflow.set_entry_point("analyze_feasibility")
 
-main_workflow.add_conditional_edges(
-    "analyze_feasibility",
-    strategy_router,
-    {
-        "spg_agent": "spg_agent",
-        "llm_refactor": "llm_refactor"
-    }
-)
+    main_workflow.add_conditional_edges(
+        "analyze_feasibility",
+        strategy_router,
+        {
+            "spg_agent": "spg_agent",
+            "llm_refactor": "llm_refactor"
+        }
+    )
+
+    main_workflow.add_edge("spg_agent", END)
+    main_workflow.add_edge("llm_refactor", END)
+    return main_workflow
 
-main_workflow.add_edge("spg_agent", END)
-main_workflow.add_edge("llm_refactor", END)
+_app = Lazy(lambda: build_main_workflow(get_spg_subgraph()).compile(checkpointer=get_checkpointer()))
 
-app = main_workflow.compile()
+def get_app() -> Any:
+    """The compiled, checkpointed main graph."""
+    return _app.get()
 
 # For testing compilation
 if __name__ == "__main__":
+    get_app()
     print("Graph compiled successfully.")
@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.caches import BaseCache
+from langchain_core.messages import messages_from_dict, messages_to_dict
+from langchain_core.outputs import ChatGeneration, Generation
+from src.mcp_server.cache import get_cache_dir
+
+# Response cache of the agent's LLM.
+# An exact tier answers a call whose prompt and model configuration (model, temperature,
+# ...) were seen before; an optional semantic tier answers a call whose prompt text embeds
+# within a cosine-similarity threshold of a cached prompt of the same configuration.
+# Entries live in SQLite and the least recently used ones are evicted past the size bound.
+# A response that turned out to be wrong (a draft failing validation) is discarded, so a
+# retry of the same prompt asks the LLM again instead of replaying the failure. Which entry
+# answered a prompt is recorded in SQLite too, so a resumed run or another process can
+# discard it.
+
+# Set to 0 to disable the cache.
+LLM_CACHE = os.environ.get("LK_SPG_LLM_CACHE", "1") != "0"
+# Maximum number of cached responses.
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LK_SPG_LLM_CACHE_MAX_ENTRIES", "2000"))
+# Cosine similarity a prompt needs to reuse a cached response; 0 disables the semantic tier.
+LLM_CACHE_SIMILARITY = float(os.environ.get("LK_SPG_LLM_CACHE_SIMILARITY", "0"))
+# Prompt embeddings of missed lookups kept for update(); calls that never store a response drop out.
+PENDING_VECTORS_MAX = 256
+
+def _cache_key(prompt: str, llm_string: str) -> str:
+    h = hashlib.sha256()
+    for part in (llm_string, prompt):
+        data = part.encode('utf-8', errors='surrogateescape')
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+def _prompt_text(prompt: str) -> str:
+    """The message contents of a chat prompt (serialized by langchain), or the prompt itself."""
+    try:
+        messages = json.loads(prompt)
+        parts = [m["kwargs"]["content"] for m in messages if isinstance(m["kwargs"].get("content"), str)]
+    except (ValueError, TypeError, KeyError):
+        return prompt
+    return "\n".join(parts) or prompt
+
+def _text_key(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8', errors='surrogateescape')).hexdigest()
+
+def _dump_generations(generations: Sequence[Generation]) -> str:
+    return json.dumps([
+        {"message": messages_to_dict([g.message])[0]} if isinstance(g, ChatGeneration) else {"text": g.text}
+        for g in generations
+    ])
+
+def _load_generations(value: str) -> List[Generation]:
+    return [
+        ChatGeneration(message=messages_from_dict([g["message"]])[0]) if "message" in g else Generation(text=g["text"])
+        for g in json.loads(value)
+    ]
+
+class LLMResponseCache(BaseCache):
+    """
+    Exact and (optionally) semantic LLM response cache on SQLite, passed to the chat model as `cache`.
+
+    Args:
+        db_path: SQLite file (default $LK_SPG_CACHE_DIR/llm_cache.sqlite3).
+        max_entries: Size bound; the least recently used responses are evicted beyond it.
+        embeddings: Embedding model of the semantic tier (None disables it).
+        similarity: Minimum cosine similarity of a semantic hit.
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        embeddings: Any = None,
+        similarity: float = LLM_CACHE_SIMILARITY
+    ):
+        self.db_path = db_path or os.path.join(get_cache_dir(), "llm_cache.sqlite3")
+        self.max_entries = max_entries
+        self.embeddings = embeddings
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, llm TEXT NOT NULL, value TEXT NOT NULL, vector BLOB, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        # Entry that last answered (or was stored for) a prompt text, for discard():
+        # sha256 of the prompt text -> responses.key.
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS served (text TEXT PRIMARY KEY, key TEXT NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS served_key ON served (key)")
+        self._conn.commit()
+        # Prompt embeddings computed by a missed lookup, stored with the response by update().
+        self._pending_vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        # Unit prompt vectors per model configuration, loaded on the first semantic lookup
+        # and kept current by update() and evictions: llm_string -> (keys, matrix).
+        self._vectors: Dict[str, Tuple[List[str], np.ndarray]] = {}
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _embed(self, prompt: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(_prompt_text(prompt)), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _vector_matrix(self, llm_string: str, dim: int) -> Tuple[List[str], np.ndarray]:
+        """The cached prompt vectors of one configuration (of dimension dim); call with the lock held."""
+        entry = self._vectors.get(llm_string)
+        if entry is None or entry[1].shape[1] != dim:
+            # Vectors of another embedding model are left out.
+            rows = self._conn.execute(
+                "SELECT key, vector FROM responses WHERE llm = ? AND length(vector) = ?", (llm_string, dim * 4)
+            ).fetchall()
+            matrix = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), dim)
+            entry = self._vectors[llm_string] = ([r[0] for r in rows], matrix)
+        return entry
+
+    def _add_vector(self, llm_string: str, key: str, vector: np.ndarray) -> None:
+        entry = self._vectors.get(llm_string)
+        if entry is None or entry[1].shape[1] != vector.shape[0]:
+            return  # Loaded from the database on the next semantic lookup
+        keys, matrix = entry
+        if key in keys:
+            matrix = matrix.copy()
+            matrix[keys.index(key)] = vector
+        else:
+            keys = keys + [key]
+            matrix = np.vstack([matrix, vector[None, :]])
+        self._vectors[llm_string] = (keys, matrix)
+
+    def _drop_vectors(self, removed: Sequence[str]) -> None:
+        removed = set(removed)
+        for llm_string, (keys, matrix) in list(self._vectors.items()):
+            keep = [i for i, key in enumerate(keys) if key not in removed]
+            if len(keep) != len(keys):
+                self._vectors[llm_string] = ([keys[i] for i in keep], matrix[keep])
+
+    def _remember(self, prompt: str, key: str) -> None:
+        """Records that key answered prompt; call with the lock held, the caller commits."""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO served (text, key, used) VALUES (?, ?, ?)",
+            (_text_key(_prompt_text(prompt)), key, time.time())
+        )
+
+    def _semantic_lookup(self, key: str, prompt: str, llm_string: str) -> Optional[str]:
+        vector = self._embed(prompt)
+        with self._lock:
+            self._pending_vectors[key] = vector
+            while len(self._pending_vectors) > PENDING_VECTORS_MAX:
+                self._pending_vectors.popitem(last=False)
+            keys, matrix = self._vector_matrix(llm_string, vector.shape[0])
+            if not keys:
+                return None
+            scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.similarity else None
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        key = _cache_key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.exact_hits += 1
+                self._remember(prompt, key)
+                self._touch(key)
+                return _load_generations(row[0])
+        if self.embeddings is not None and self.similarity > 0:
+            match = self._semantic_lookup(key, prompt, llm_string)
+            if match is not None:
+                with self._lock:
+                    row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (match,)).fetchone()
+                    if row is not None:
+                        self.semantic_hits += 1
+                        self._pending_vectors.pop(key, None)
+                        self._remember(prompt, match)
+                        self._touch(match)
+                        return _load_generations(row[0])
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _touch(self, key: str) -> None:
+        self._conn.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        self._conn.commit()
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        key = _cache_key(prompt, llm_string)
+        with self._lock:
+            vector = self._pending_vectors.pop(key, None)
+        if vector is None and self.embeddings is not None and self.similarity > 0:
+            vector = self._embed(prompt)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, llm, value, vector, used) VALUES (?, ?, ?, ?, ?)",
+                (key, llm_string, _dump_generations(return_val), vector.tobytes() if vector is not None else None, time.time())
+            )
+            if vector is not None:
+                self._add_vector(llm_string, key, vector)
+            self._remember(prompt, key)
+            excess = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                evicted = [r[0] for r in self._conn.execute("SELECT key FROM responses ORDER BY used LIMIT ?", (excess,))]
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", [(k,) for k in evicted])
+                self._conn.executemany("DELETE FROM served WHERE key = ?", [(k,) for k in evicted])
+                self._drop_vectors(evicted)
+            # Many prompts can share one entry through semantic hits; keep the newest.
+            self._conn.execute(
+                "DELETE FROM served WHERE text NOT IN (SELECT text FROM served ORDER BY used DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def discard(self, prompt_text: str) -> bool:
+        """
+        Evicts the response that last answered a prompt, exactly or semantically.
+
+        Args:
+            prompt_text: The prompt as passed to the model (for chat prompts, the message contents).
+        Returns:
+            Whether a cached response was evicted.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT key FROM served WHERE text = ?", (_text_key(prompt_text),)).fetchone()
+            if row is None:
+                return False
+            key = row[0]
+            deleted = self._conn.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+            self._conn.execute("DELETE FROM served WHERE key = ?", (key,))
+            self._conn.commit()
+            self._drop_vectors([key])
+            return deleted > 0
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.execute("DELETE FROM served")
+            self._conn.commit()
+            self._pending_vectors.clear()
+            self._vectors.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                "entries": entries,
+                "max_entries": self.max_entries,
+            }
+
+_llm_cache: Optional[LLMResponseCache] = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """
+    Returns the process-wide LLM response cache, or None when disabled with LK_SPG_LLM_CACHE=0.
+    The semantic tier uses the retrieval embedding model when LK_SPG_LLM_CACHE_SIMILARITY > 0.
+    """
+    global _llm_cache
+    if not LLM_CACHE:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            embeddings = None
+            if LLM_CACHE_SIMILARITY > 0:
+                from src.rag.embeddings import get_embedding_model
+                embeddings = get_embedding_model()
+            _llm_cache = LLMResponseCache(embeddings=embeddings)
+        return _llm_cache
+
+def discard_response(llm: Any, prompt_text: Optional[str]) -> None:
+    """
+    Evicts the cached response of llm to prompt_text (a draft or refinement that failed
+    validation), so a retry of the run asks the LLM again instead of replaying it.
+    """
+    cache = getattr(llm, "cache", None)
+    if prompt_text and isinstance(cache, LLMResponseCache) and cache.discard(prompt_text):
+        print("Discarded the cached LLM response of a failed draft.")
@@ -5,15 +5,15 @@ from typing import Any, Dict, List
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from src.agent.state import AgentState, SpgState
-from src.rag.retriever import CocciRetriever
 from src.mcp_server.tools import run_spatch_syntax_check, run_spatch_dry_run
-from src.agent.utils import get_llm
+from src.mcp_server.discovery import discover_target_files
+from src.agent.llm_cache import discard_response
+from src.agent.runtime import get_retriever, get_shared_llm
+from src.agent.speculative import SPECULATIVE_K, parse_draft, run_coroutine_sync, speculative_draft
+from src.agent.progress import progress_reporter, report_progress
 
-# Initialize LLM
-llm = get_llm()
-
-# Initialize Retriever
-retriever = CocciRetriever()
+# The LLM and the retriever are process-wide singletons created on first use
+# (see src/agent/runtime.py), so importing the graph stays cheap.
 
 def analyze_feasibility(state: AgentState) -> Dict[str, Any]:
     """
@@ -29,15 +29,17 @@ def analyze_feasibility(state: AgentState) -> Dict[str, Any]:
     except FileNotFoundError:
         return {"error": "feasibility_prompt.md not found"}
         
+    # The system prompt is passed as a value: its JSON example braces are not template fields.
     prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
+        ("system", "{system_prompt}"),
         ("user", "Change Request Update: {user_request}")
     ])
     
-    chain = prompt | llm | JsonOutputParser()
+    messages = prompt.format_messages(system_prompt=system_prompt, user_request=state['user_request'])
+    chain = get_shared_llm() | JsonOutputParser()
     
     try:
-        result = chain.invoke({"user_request": state['user_request']})
+        result = chain.invoke(messages)
         strategy = result.get("strategy", "LLM_DIRECT") # Default fallback
         print(f"Strategy Decision: {strategy}")
         return {
@@ -46,6 +48,8 @@ def analyze_feasibility(state: AgentState) -> Dict[str, Any]:
         }
     except Exception as e:
         print(f"Feasibility Analysis Failed: {e}")
+        # A retry must not be answered with the same unparsable response.
+        discard_response(get_shared_llm(), "\n".join(m.content for m in messages))
         # Fallback to direct refactor if analysis fails
         return {
             "feasibility_result": {"error": str(e)},
@@ -57,8 +61,8 @@ def analyze_feasibility(state: AgentState) -> Dict[str, Any]:
 def node_rag_retrieve(state: SpgState) -> Dict[str, Any]:
     print("--- [Node] RAG Retrieval ---")
     query = state.get('task_description', '')
-    # Use structured retrieval
-    docs = retriever.retrieve_structured(query)
+    # Use structured retrieval: three syntax rules and three examples keep the prompt short
+    docs = get_retriever().retrieve_structured(query, k=3)
     
     patterns = f"""
     // Reference Syntax Rules
@@ -89,33 +93,68 @@ def node_architect_draft(state: SpgState) -> Dict[str, Any]:
     Ensure your response is a valid JSON object.
     """
     
-    response = llm.invoke(prompt_text)
+    if SPECULATIVE_K > 1:
+        return _speculative_architect_draft(prompt_text, iter_count)
+
+    response = get_shared_llm().invoke(prompt_text)
     
     try:
-        # Try to parse JSON directly
-        content = response.content
-        # Heuristic to find JSON if wrapped in markdown code blocks
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-             content = content.split("```")[1].split("```")[0].strip()
-             
-        data = json.loads(content)
+        data = parse_draft(response.content)
         return {
-            "cocci_script": data.get("cocci_script", ""),
-            "mock_c_code": data.get("mock_c", ""),
+            "cocci_script": data["cocci_script"],
+            "mock_c_code": data["mock_c"],
+            "draft_prompt": prompt_text,
             "iteration_count": iter_count + 1
         }
     except Exception as e:
         print(f"Drafting failed to parse JSON: {e}")
+        # A retry must not be answered with the same unparsable response.
+        discard_response(get_shared_llm(), prompt_text)
         # Return error state or empty to fail validation
         return {
             "cocci_script": "",
             "mock_c_code": "",
+            "draft_prompt": None,
             "validation_error": "Failed to generate valid JSON response",
             "iteration_count": iter_count + 1
         }
 
+def _speculative_architect_draft(prompt_text: str, iter_count: int) -> Dict[str, Any]:
+    """
+    Drafts SPECULATIVE_K candidates in parallel and validates them through spatch.
+    A passing candidate goes straight to target discovery; otherwise the candidate
+    that got furthest is handed to refinement together with its error.
+    """
+    # Candidates are validated on another event loop, so bind the reporter here.
+    report = progress_reporter()
+    on_candidate = lambda c: report(
+        "candidate", index=c["index"], reached=c["stage"], cocci_script=c["cocci_script"], error=c.get("error")
+    )
+    result = run_coroutine_sync(speculative_draft(get_shared_llm(), prompt_text, on_candidate=on_candidate))
+    winner = result["winner"]
+    if winner:
+        print(f"Speculative drafting: candidate {winner['index']} passed after {result['attempts']} attempts.")
+        return {
+            "cocci_script": winner["cocci_script"],
+            "mock_c_code": winner["mock_c_code"],
+            "patch_preview": winner["patch_preview"],
+            "draft_prompt": None,
+            "validation_error": None,
+            "iteration_count": iter_count + 1,
+            "status": "success"
+        }
+
+    best = result["best"] or {}
+    print(f"Speculative drafting: none of {result['attempts']} candidates passed.")
+    return {
+        "cocci_script": best.get("cocci_script", ""),
+        "mock_c_code": best.get("mock_c_code", ""),
+        "draft_prompt": None,  # Failed candidates are discarded by speculative_draft
+        "validation_error": best.get("error", "All speculative candidates failed."),
+        "iteration_count": iter_count + 1,
+        "status": "speculative_failed"
+    }
+
 def _get_tool_by_name(name: str):
     """Helper to retrieve a tool by name from the exposed tools list."""
     # Since get_tools returns a list, we just iterate.
@@ -144,6 +183,7 @@ def node_syntax_check(state: SpgState) -> Dict[str, Any]:
     syntax_res = tool.invoke({"script_content": script})
     
     if syntax_res != "OK":
+        discard_response(get_shared_llm(), state.get("draft_prompt"))
         return {
             "validation_error": f"Syntax Error: {syntax_res}",
             "status": "syntax_error"
@@ -170,6 +210,7 @@ def node_dry_run(state: SpgState) -> Dict[str, Any]:
     patch_res = tool.invoke({"script_content": script, "mock_c_code": mock_c})
     
     if not patch_res.strip():
+        discard_response(get_shared_llm(), state.get("draft_prompt"))
         return {
             "validation_error": "Logic Error: Script is valid but matched nothing in Mock code.",
             "status": "logic_error"
@@ -209,7 +250,7 @@ def node_refine_script(state: SpgState) -> Dict[str, Any]:
     Output ONLY the fixed .cocci script in a code block.
     """
     
-    response = llm.invoke(prompt_text)
+    response = get_shared_llm().invoke(prompt_text)
     content = response.content
     
     # Extract code
@@ -221,10 +262,34 @@ def node_refine_script(state: SpgState) -> Dict[str, Any]:
         
     return {
         "cocci_script": script,
+        "draft_prompt": prompt_text,
         "iteration_count": iter_count + 1,
         "status": "fixed"
     }
 
+def node_discover_targets(state: SpgState) -> Dict[str, Any]:
+    print("--- [Node] Discover Targets ---")
+    if state.get('target_files'):
+        return {}
+
+    kernel_dir = state.get('kernel_dir') or os.environ.get("LK_SPG_KERNEL_DIR")
+    if not kernel_dir or not os.path.isdir(kernel_dir):
+        print("No kernel tree configured; skipping target discovery.")
+        return {}
+
+    report_progress("discovering", kernel_dir=kernel_dir)
+    try:
+        report = discover_target_files(state['cocci_script'], kernel_dir)
+    except Exception as e:
+        print(f"Target discovery failed: {e}")
+        return {"discovery_report": {"error": str(e)}}
+
+    print(f"Discovered {len(report['targets'])} target files (cached: {report['cached']}).")
+    return {
+        "target_files": report["targets"],
+        "discovery_report": {k: v for k, v in report.items() if k != "targets"}
+    }
+
 def node_apply_real(state: SpgState) -> Dict[str, Any]:
     print("--- [Node] Apply In-Place ---")
     script = state['cocci_script']
@@ -235,8 +300,10 @@ def node_apply_real(state: SpgState) -> Dict[str, Any]:
         return {"applied_diff": "No target files.", "final_cocci_script": script}
 
     # Use Tool
+    report_progress("applying", target_files=len(target_files))
     tool = _get_tool_by_name("apply_cocci")
     result = tool.invoke({"script_content": script, "target_files": target_files})
+    report_progress("applied", target_files=len(target_files), summary=result.strip().splitlines()[-1] if result.strip() else "")
     
     return {
         "applied_diff": result,
@@ -252,7 +319,7 @@ def llm_refactor_agent(state: AgentState) -> Dict[str, Any]:
     print("--- [Node] LLM Direct Refactor ---")
     
     # Bind tools to the LLM
-    llm_with_tools = llm.bind_tools(get_tools())
+    llm_with_tools = get_shared_llm().bind_tools(get_tools())
     
     # Simple single-shot invocation for now. 
     # In a real agent loop, this would be a ReAct loop.
@@ -0,0 +1,59 @@
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+from langgraph.config import get_stream_writer
+
+# Progress events of a graph run.
+# stream_graph_events() turns LangGraph's "updates" and "custom" streams (including the
+# SPG subgraph, which runs inside the spg_agent node) into flat event dicts with
+# timestamps and per-node durations. Nodes report intermediate progress through
+# report_progress(), which is a no-op when the graph is not being streamed.
+
+def progress_reporter() -> Callable[..., None]:
+    """
+    Returns report(stage, **data) bound to the current run's stream.
+    Call it in the node itself; the returned function may then be used from other threads.
+    """
+    try:
+        writer = get_stream_writer()
+    except RuntimeError:
+        return lambda stage, **data: None
+    return lambda stage, **data: writer({"stage": stage, **data})
+
+def report_progress(stage: str, **data: Any) -> None:
+    """Emits a "progress" event from inside a node (ignored outside a streamed run)."""
+    progress_reporter()(stage, **data)
+
+def stream_graph_events(graph: Any, state: Optional[Dict[str, Any]], config: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Runs the graph and yields its events as they happen.
+    With state None, a checkpointed run is resumed (config names its thread).
+
+    Yields:
+        {"event": "start"}, then one {"event": "node", "node", "namespace", "duration", "update"}
+        per finished node and {"event": "progress", "namespace", "data"} per report_progress()
+        call, then {"event": "done", "state"} with the final top-level state. Every event has
+        "ts" (epoch seconds) and "elapsed" (seconds since the start). A node's duration runs
+        from the previous event of its graph (or of the parent graph, for a subgraph's first node).
+    """
+    started = time.time()
+    yield {"event": "start", "ts": started, "elapsed": 0.0}
+    final_state = dict(state) if state is not None else dict(graph.get_state(config).values)
+    last: Dict[tuple, float] = {(): started}
+    for namespace, mode, payload in graph.stream(state, config, stream_mode=["updates", "custom"], subgraphs=True):
+        now = time.time()
+        # Namespace entries look like "spg_agent:<task id>"; keep the node names.
+        path = tuple(part.split(":")[0] for part in namespace)
+        base = {"namespace": list(path), "ts": now, "elapsed": round(now - started, 4)}
+        if mode == "custom":
+            yield {"event": "progress", **base, "data": payload}
+            continue
+        for node, update in payload.items():
+            scope = path
+            while scope not in last:
+                scope = scope[:-1]
+            yield {"event": "node", "node": node, **base, "duration": round(now - last[scope], 4), "update": update}
+            last[path] = now
+            if not path:
+                final_state.update(update or {})
+    finished = time.time()
+    yield {"event": "done", "ts": finished, "elapsed": round(finished - started, 4), "state": final_state}
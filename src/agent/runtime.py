@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Generic, Optional, TypeVar
+
+# Process-wide runtime resources of the agent: the LLM client, the retriever and the
+# tool registry. Nothing is built when the agent modules are imported; each resource is
+# created on first use, exactly once even under concurrent requests. warm_up() builds all
+# of them up front (the API calls it at startup) and reports the import-to-ready time.
+
+# Reference point of the import-to-ready measurement (the API imports this module first).
+IMPORT_STARTED = time.perf_counter()
+# Set to 0 to skip the warm-up at API startup (resources are then built by the first run).
+WARMUP = os.environ.get("LK_SPG_WARMUP", "1") != "0"
+
+T = TypeVar("T")
+
+class Lazy(Generic[T]):
+    """A value built by `factory` on first get(), once per process."""
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: Optional[T] = None
+        self._built = False
+        self._lock = threading.Lock()
+
+    @property
+    def built(self) -> bool:
+        return self._built
+
+    def get(self) -> T:
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._value = self._factory()
+                    self._built = True
+        return self._value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._value = None
+            self._built = False
+
+def _build_llm() -> Any:
+    from src.agent.utils import get_llm
+    return get_llm()
+
+def _build_retriever() -> Any:
+    from src.rag.retriever import CocciRetriever
+    return CocciRetriever()
+
+_llm: Lazy[Any] = Lazy(lambda: _build_llm())
+_retriever: Lazy[Any] = Lazy(lambda: _build_retriever())
+_startup: Dict[str, Any] = {}
+
+def get_shared_llm() -> Any:
+    """The LLM shared by all graph nodes."""
+    return _llm.get()
+
+def get_retriever() -> Any:
+    """The CocciRetriever shared by all graph runs."""
+    return _retriever.get()
+
+def warm_up() -> Dict[str, Any]:
+    """
+    Builds every lazy resource now instead of on the first request.
+
+    Returns:
+        Seconds spent per resource and "import_to_ready" (since this module was imported).
+        Failures are reported under "errors"; the resource is retried on first use.
+    """
+    from src.agent.tools import get_tools
+
+    timings: Dict[str, Any] = {}
+    errors: Dict[str, str] = {}
+    steps = [
+        ("llm", get_shared_llm),
+        ("retriever", get_retriever),
+        # Loads the keyword index, so the first retrieval does not pay for it.
+        ("bm25_index", lambda: get_retriever().bm25),
+        ("tools", get_tools),
+    ]
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            errors[name] = str(e)
+        timings[name] = round(time.perf_counter() - started, 4)
+    timings["import_to_ready"] = round(time.perf_counter() - IMPORT_STARTED, 4)
+    if errors:
+        timings["errors"] = errors
+    _startup.clear()
+    _startup.update(timings)
+    details = ", ".join(f"{k} {v:.3f}s" for k, v in timings.items() if k not in ("import_to_ready", "errors"))
+    print(f"Agent ready in {timings['import_to_ready']:.3f}s since import ({details}).")
+    for name, error in errors.items():
+        print(f"Warm-up of {name} failed: {error}")
+    return timings
+
+def startup_report() -> Dict[str, Any]:
+    """The timings of the last warm_up(), which resources are built and the LLM cache statistics."""
+    from src.agent import llm_cache, tools
+    return {
+        "warmed_up": bool(_startup),
+        "timings": dict(_startup),
+        "built": {"llm": _llm.built, "retriever": _retriever.built, "tools": tools._tools is not None},
+        "llm_cache": llm_cache._llm_cache.stats() if llm_cache._llm_cache is not None else None,
+    }
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional
+from src.agent.llm_cache import discard_response
+from src.mcp_server.async_tools import arun_spatch_dry_run, arun_spatch_syntax_check
+
+# Speculative drafting for the SPG subgraph.
+# K candidate (script, mock) pairs are drafted concurrently and each one is validated
+# through spatch (syntax check, then dry run) as soon as its draft arrives. The first
+# candidate that passes both checks wins and the remaining drafts/validations are
+# cancelled, which also kills their spatch processes.
+
+# Number of candidates drafted per iteration (1 disables speculative drafting).
+SPECULATIVE_K = int(os.environ.get("LK_SPG_SPECULATIVE_K", "1"))
+# Maximum number of candidates drafted/validated at the same time.
+SPECULATIVE_CONCURRENCY = int(os.environ.get("LK_SPG_SPECULATIVE_CONCURRENCY", "4"))
+
+# Steers the candidates towards different solutions so they do not all fail the same way.
+CANDIDATE_HINTS = [
+    "",
+    "Prefer the simplest rule that matches the old usage, with few metavariables.",
+    "Use SmPL disjunctions to cover the variants of the old usage you expect in the kernel.",
+    "Match on the function call expression and let the isomorphisms handle casts and parentheses.",
+    "Write the mock C code first as realistic kernel code, then a script that matches it exactly.",
+]
+
+def parse_draft(content: str) -> Dict[str, str]:
+    """
+    Extracts the "cocci_script" / "mock_c" JSON object from an LLM response,
+    tolerating markdown code fences. Raises ValueError if no JSON object can be parsed.
+    """
+    if "```json" in content:
+        content = content.split("```json")[1].split("```")[0].strip()
+    elif "```" in content:
+        content = content.split("```")[1].split("```")[0].strip()
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("Response is not a JSON object")
+    return {"cocci_script": data.get("cocci_script", ""), "mock_c": data.get("mock_c", "")}
+
+async def _ainvoke(llm: Any, prompt: str) -> Any:
+    if hasattr(llm, "ainvoke"):
+        return await llm.ainvoke(prompt)
+    return await asyncio.to_thread(llm.invoke, prompt)
+
+async def _draft_and_validate(llm: Any, prompt: str, index: int, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Drafts one candidate and runs it through the syntax check and the dry run."""
+    hint = CANDIDATE_HINTS[index % len(CANDIDATE_HINTS)]
+    candidate_prompt = f"{prompt}\n    {hint}" if hint else prompt
+    candidate = {"index": index, "cocci_script": "", "mock_c_code": "", "patch_preview": None, "stage": "draft",
+                 "prompt": candidate_prompt}
+    async with semaphore:
+        response = await _ainvoke(llm, candidate_prompt)
+        try:
+            draft = parse_draft(response.content)
+        except ValueError as e:
+            candidate["error"] = f"Failed to generate valid JSON response ({e})"
+            return candidate
+        candidate.update(cocci_script=draft["cocci_script"], mock_c_code=draft["mock_c"])
+        if not candidate["cocci_script"]:
+            candidate["error"] = "Empty script."
+            return candidate
+
+        candidate["stage"] = "syntax_check"
+        syntax_res = await arun_spatch_syntax_check(candidate["cocci_script"])
+        if syntax_res != "OK":
+            candidate["error"] = f"Syntax Error: {syntax_res}"
+            return candidate
+
+        candidate["stage"] = "dry_run"
+        if not candidate["mock_c_code"]:
+            candidate["error"] = "Empty mock code."
+            return candidate
+        patch_res = await arun_spatch_dry_run(candidate["cocci_script"], candidate["mock_c_code"])
+        if not patch_res.strip():
+            candidate["error"] = "Logic Error: Script is valid but matched nothing in Mock code."
+            return candidate
+        # The dry-run tool reports failures as text rather than raising.
+        if patch_res.startswith(("Runtime Error", "Error:", "System Error")):
+            candidate["error"] = patch_res
+            return candidate
+
+        candidate.update(stage="passed", patch_preview=patch_res, error=None)
+        return candidate
+
+_STAGE_RANK = {"draft": 0, "syntax_check": 1, "dry_run": 2, "passed": 3}
+
+async def speculative_draft(
+    llm: Any,
+    prompt: str,
+    k: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    on_candidate: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    Drafts k candidates concurrently and returns the first one that passes validation.
+
+    Args:
+        llm: Chat model used for drafting (anything with invoke/ainvoke).
+        prompt: The drafting prompt shared by all candidates.
+        k: Number of candidates (defaults to LK_SPG_SPECULATIVE_K).
+        concurrency: Maximum candidates in flight (defaults to LK_SPG_SPECULATIVE_CONCURRENCY).
+        on_candidate: Called with every validated candidate as soon as it finishes.
+    Returns:
+        A dict with "winner" (the passing candidate, or None), "best" (the candidate that got
+        furthest through validation, used for refinement when nothing passed) and "attempts".
+    """
+    k = max(1, k or SPECULATIVE_K)
+    semaphore = asyncio.Semaphore(max(1, concurrency or SPECULATIVE_CONCURRENCY))
+    tasks = [asyncio.ensure_future(_draft_and_validate(llm, prompt, i, semaphore)) for i in range(k)]
+    finished: List[Dict[str, Any]] = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                candidate = await next_done
+            except Exception as e:
+                print(f"[speculative] candidate failed: {e}")
+                continue
+            finished.append(candidate)
+            print(f"[speculative] candidate {candidate['index']} reached {candidate['stage']}")
+            if on_candidate:
+                on_candidate(candidate)
+            if candidate["stage"] == "passed":
+                return {"winner": candidate, "best": candidate, "attempts": len(finished)}
+            # The next iteration (or a retried run) must draft this candidate anew.
+            discard_response(llm, candidate["prompt"])
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    best = max(finished, key=lambda c: (_STAGE_RANK[c["stage"]], -c["index"]), default=None)
+    return {"winner": None, "best": best, "attempts": len(finished)}
+
+def run_coroutine_sync(coro: Any) -> Any:
+    """Runs a coroutine from synchronous code, even when called inside a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    result: Dict[str, Any] = {}
+
+    def _target():
+        try:
+            result["value"] = asyncio.run(coro)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=_target)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
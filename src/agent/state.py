@@ -5,6 +5,7 @@ class SpgState(TypedDict):
     # --- Input (from upstream) ---
     task_description: str       # Description of the upgrade task
     target_files: List[str]     # List of files to modify
+    kernel_dir: Optional[str]   # Kernel tree scanned for targets when target_files is empty
     
     # --- Internal Context ---
     retrieved_patterns: str     # RAG retrieved patterns
@@ -12,10 +13,12 @@ class SpgState(TypedDict):
     # --- Artifacts ---
     cocci_script: str           # Current .cocci script
     mock_c_code: str            # Mock C code for dry run
+    draft_prompt: Optional[str] # Prompt of the LLM response that produced cocci_script
     
     # --- Feedback Loop ---
     validation_error: Optional[str] # Error from spatch or Logic error
     patch_preview: Optional[str]    # Patch generated by dry run
+    discovery_report: Optional[Dict[str, Any]] # Summary of the target discovery scan
     iteration_count: int        # Loop counter
     
     # --- Output (to downstream) ---
@@ -26,6 +29,7 @@ class SpgState(TypedDict):
 # --- Main Graph State ---
 class AgentState(TypedDict):
     user_request: str          # User's natural language request or git diff
+    kernel_dir: Optional[str]  # Kernel tree to patch (defaults to $LK_SPG_KERNEL_DIR)
     
     # Feasibility Analysis
     feasibility_result: Optional[Dict[str, Any]] # JSON output from analysis
@@ -1,3 +1,4 @@
+import threading
 from langchain_core.tools import StructuredTool
 from src.mcp_server.tools import (
     run_spatch_syntax_check,
@@ -6,51 +7,83 @@ from src.mcp_server.tools import (
     kernel_grep,
     list_tree,
     read_window,
+    read_windows,
     lookup_symbol_def
 )
+from src.mcp_server.async_tools import (
+    arun_spatch_syntax_check,
+    arun_spatch_dry_run,
+    arun_spatch_apply,
+    akernel_grep,
+    alist_tree,
+    aread_window,
+    aread_windows,
+    alookup_symbol_def
+)
 
-# Wrap MCP tools as LangChain StructuredTools
-tools = [
-    StructuredTool.from_function(
-        func=run_spatch_syntax_check,
-        name="check_cocci_syntax",
-        description="Checks the syntax of a Coccinelle semantic patch script.",
-    ),
-    StructuredTool.from_function(
-        func=run_spatch_dry_run,
-        name="dry_run_cocci",
-        description="Runs a dry run of a Coccinelle script on a mock C file to verify logic.",
-    ),
-    StructuredTool.from_function(
-        func=kernel_grep,
-        name="grep_kernel",
-        description="Searches for a regex pattern in the kernel source code.",
-    ),
-    StructuredTool.from_function(
-        func=list_tree,
-        name="list_directory",
-        description="Lists the directory structure up to a certain depth.",
-    ),
-    StructuredTool.from_function(
-        func=read_window,
-        name="read_file_window",
-        description="Reads a window of code lines around a specific line number.",
-    ),
-    StructuredTool.from_function(
-        func=lookup_symbol_def,
-        name="lookup_symbol",
-        description="Searches for the definition of a C symbol (struct/function) using heuristics.",
-    ),
-    StructuredTool.from_function(
-        func=run_spatch_apply,
-        name="apply_cocci",
-        description="Applies a Coccinelle script to target files in-place.",
-    ),
-]
+# Wrap MCP tools as LangChain StructuredTools.
+# Each tool also carries its asyncio-native counterpart, used by ainvoke().
+# The registry is built on first use (see get_tools), not at import time.
+def _build_tools():
+    return [
+        StructuredTool.from_function(
+            func=run_spatch_syntax_check,
+            coroutine=arun_spatch_syntax_check,
+            name="check_cocci_syntax",
+            description="Checks the syntax of a Coccinelle semantic patch script.",
+        ),
+        StructuredTool.from_function(
+            func=run_spatch_dry_run,
+            coroutine=arun_spatch_dry_run,
+            name="dry_run_cocci",
+            description="Runs a dry run of a Coccinelle script on a mock C file to verify logic.",
+        ),
+        StructuredTool.from_function(
+            func=kernel_grep,
+            coroutine=akernel_grep,
+            name="grep_kernel",
+            description="Searches for a regex pattern in the kernel source code.",
+        ),
+        StructuredTool.from_function(
+            func=list_tree,
+            coroutine=alist_tree,
+            name="list_directory",
+            description="Lists the directory structure up to a certain depth.",
+        ),
+        StructuredTool.from_function(
+            func=read_window,
+            coroutine=aread_window,
+            name="read_file_window",
+            description="Reads a window of code lines around a specific line number.",
+        ),
+        StructuredTool.from_function(
+            func=read_windows,
+            coroutine=aread_windows,
+            name="read_file_windows",
+            description="Reads several windows of code lines, from one or more files, in a single call.",
+        ),
+        StructuredTool.from_function(
+            func=lookup_symbol_def,
+            coroutine=alookup_symbol_def,
+            name="lookup_symbol",
+            description="Searches for the definition of a C symbol (struct/function) using heuristics.",
+        ),
+        StructuredTool.from_function(
+            func=run_spatch_apply,
+            coroutine=arun_spatch_apply,
+            name="apply_cocci",
+            description="Applies a Coccinelle script to target files in-place (sharded across parallel spatch processes) and returns per-file diffs.",
+        ),
+    ]
 
-# Expose the list of tools
-ALL_TOOLS = tools
+_tools = None
+_tools_lock = threading.Lock()
 
 def get_tools():
-    """Returns the list of available tools."""
-    return ALL_TOOLS
+    """Returns the list of available tools (a process-wide registry, built once)."""
+    global _tools
+    if _tools is None:
+        with _tools_lock:
+            if _tools is None:
+                _tools = _build_tools()
+    return _tools
@@ -1,5 +1,4 @@
 import os
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import BaseMessage
 from typing import Any, List, Optional
 
@@ -17,4 +16,8 @@ def get_llm():
         print("Warning: OPENAI_API_KEY not found. Using MockLLM.")
         return MockLLM()
     
-    return ChatOpenAI(model="gpt-4o", temperature=0.2)
+    # Deferred: langchain_openai is slow to import and only needed once an LLM is built.
+    from langchain_openai import ChatOpenAI
+    from src.agent.llm_cache import get_llm_cache
+    # Repeated prompts are answered from the response cache (src/agent/llm_cache.py).
+    return ChatOpenAI(model="gpt-4o", temperature=0.2, cache=get_llm_cache())
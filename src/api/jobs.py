@@ -0,0 +1,217 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+from src.mcp_server.cache import get_cache_dir
+
+# Job subsystem of the API server.
+# A submitted agent run becomes a job: it is recorded in SQLite, queued on a bounded
+# thread pool and executed there, so the event loop never blocks on spatch or the LLM.
+# Every node event of a run is appended to the job's event log, which clients poll or
+# stream. Jobs that were queued or running when the server stopped are queued again on
+# the next start, and the agent runner resumes them from their checkpoints.
+# Cancellation is cooperative: a running job stops at its next event. So does a running
+# job when the server shuts down, but it stays "running" and is re-queued on the next start.
+
+MAX_JOBS = int(os.environ.get("LK_SPG_MAX_JOBS", "2"))
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+TERMINAL = (SUCCEEDED, FAILED, CANCELLED)
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled."""
+
+class JobInterrupted(Exception):
+    """Raised inside a running job once the server shuts down."""
+
+# runner(request, emit) -> result; emit(event, data) appends to the event log and raises
+# JobCancelled / JobInterrupted once the job should stop.
+# The request passed to the runner also carries the "job_id".
+Runner = Callable[[Dict[str, Any], Callable[[str, Any], None]], Dict[str, Any]]
+
+class JobStore:
+    """SQLite record of jobs and their event logs."""
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or os.environ.get("LK_SPG_JOBS_DB") or os.path.join(get_cache_dir(), "jobs.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY, status TEXT NOT NULL, request TEXT NOT NULL, result TEXT, error TEXT,"
+            " created REAL NOT NULL, started REAL, finished REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " job_id TEXT NOT NULL, seq INTEGER NOT NULL, ts REAL NOT NULL, event TEXT NOT NULL, data TEXT,"
+            " PRIMARY KEY (job_id, seq))"
+        )
+        self._conn.commit()
+
+    def create(self, request: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, request, created) VALUES (?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(request), time.time())
+            )
+            self._conn.commit()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, status, request, result, error, created, started, finished FROM jobs WHERE job_id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ("job_id", "status", "request", "result", "error", "created", "started", "finished")
+        job = dict(zip(keys, row))
+        job["request"] = json.loads(job["request"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def set_status(self, job_id: str, status: str, only_if: Optional[tuple] = None, **fields: Any) -> bool:
+        """Updates status (and result/error/started/finished); with only_if, only from those states."""
+        columns = {"status": status}
+        for key in ("result", "error", "started", "finished"):
+            if key in fields:
+                columns[key] = json.dumps(fields[key], default=str) if key == "result" else fields[key]
+        sql = "UPDATE jobs SET " + ", ".join(f"{k} = ?" for k in columns) + " WHERE job_id = ?"
+        params: List[Any] = list(columns.values()) + [job_id]
+        if only_if:
+            sql += f" AND status IN ({', '.join('?' for _ in only_if)})"
+            params.extend(only_if)
+        with self._lock:
+            changed = self._conn.execute(sql, params).rowcount > 0
+            self._conn.commit()
+        return changed
+
+    def ids_with_status(self, *statuses: str) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT job_id FROM jobs WHERE status IN ({', '.join('?' for _ in statuses)}) ORDER BY created",
+                statuses
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def add_event(self, job_id: str, event: str, data: Any = None) -> int:
+        with self._lock:
+            seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM events WHERE job_id = ?", (job_id,)).fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO events VALUES (?, ?, ?, ?, ?)",
+                (job_id, seq, time.time(), event, json.dumps(data, default=str))
+            )
+            self._conn.commit()
+        return seq
+
+    def events(self, job_id: str, after: int = 0) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, ts, event, data FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+            ).fetchall()
+        return [{"seq": seq, "ts": ts, "event": event, "data": json.loads(data) if data else None} for seq, ts, event, data in rows]
+
+class JobManager:
+    """
+    Runs jobs on a bounded thread pool.
+
+    Args:
+        runner: Executes one request (see Runner); raising fails the job.
+        store: Where jobs and events are persisted.
+        max_workers: Jobs running at the same time; the others wait queued.
+    """
+
+    def __init__(self, runner: Runner, store: Optional[JobStore] = None, max_workers: int = MAX_JOBS):
+        self.runner = runner
+        self.store = store or JobStore()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="lk-spg-job")
+        self._cancelled: set = set()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def recover(self) -> List[str]:
+        """Queues again the jobs left queued or running by a previous process."""
+        job_ids = self.store.ids_with_status(RUNNING, QUEUED)
+        for job_id in job_ids:
+            if self.store.set_status(job_id, QUEUED, only_if=(RUNNING, QUEUED)):
+                self.store.add_event(job_id, "requeued", {"reason": "server restart"})
+                self._pool.submit(self._run, job_id)
+        if job_ids:
+            print(f"Re-queued {len(job_ids)} unfinished jobs.")
+        return job_ids
+
+    def submit(self, request: Dict[str, Any]) -> str:
+        job_id = self.store.create(request)
+        self.store.add_event(job_id, "queued")
+        self._pool.submit(self._run, job_id)
+        return job_id
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """Cancels a job; returns its status afterwards (None if unknown)."""
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        if job["status"] in TERMINAL:
+            return job["status"]
+        with self._lock:
+            self._cancelled.add(job_id)
+        # A queued job is cancelled right away; a running one stops at its next event.
+        if self.store.set_status(job_id, CANCELLED, only_if=(QUEUED,), finished=time.time()):
+            self.store.add_event(job_id, "cancelled")
+            return CANCELLED
+        self.store.add_event(job_id, "cancel_requested")
+        return self.store.get(job_id)["status"]
+
+    def _is_cancelled(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._cancelled
+
+    def _run(self, job_id: str) -> None:
+        if not self.store.set_status(job_id, RUNNING, only_if=(QUEUED,), started=time.time()):
+            with self._lock:
+                self._cancelled.discard(job_id)  # Cancelled while queued
+            return
+        self.store.add_event(job_id, "started")
+
+        def emit(event: str, data: Any = None) -> None:
+            self.store.add_event(job_id, event, data)
+            if self._is_cancelled(job_id):
+                raise JobCancelled()
+            if self._stopping.is_set():
+                raise JobInterrupted()
+
+        try:
+            request = dict(self.store.get(job_id)["request"], job_id=job_id)
+            result = self.runner(request, emit)
+            if self._is_cancelled(job_id):
+                raise JobCancelled()
+        except JobInterrupted:
+            # Left "running": recover() queues it again on the next start.
+            self.store.add_event(job_id, "interrupted", {"reason": "server shutdown"})
+        except JobCancelled:
+            self.store.set_status(job_id, CANCELLED, finished=time.time())
+            self.store.add_event(job_id, "cancelled")
+        except Exception as e:
+            self.store.set_status(job_id, FAILED, error=str(e), finished=time.time())
+            self.store.add_event(job_id, "failed", {"error": str(e)})
+        else:
+            self.store.set_status(job_id, SUCCEEDED, result=result, finished=time.time())
+            self.store.add_event(job_id, "succeeded")
+        finally:
+            with self._lock:
+                self._cancelled.discard(job_id)
+
+    def shutdown(self) -> None:
+        """
+        Drops the queued jobs and makes the running ones stop at their next event; both
+        are queued again by recover() on the next start. Does not wait for the running
+        jobs, although interpreter exit still does (until their current node ends).
+        """
+        self._stopping.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
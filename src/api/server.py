@@ -1,44 +1,255 @@
+# Imported first: it marks the start of the import-to-ready measurement.
+from src.agent.runtime import WARMUP, Lazy, startup_report, warm_up
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Any, Callable, Dict, Optional, Tuple
 from pydantic import BaseModel
-from src.agent.graph import app as agent_app
+from src.agent.checkpoint import RunFinishedError, run_finished, run_history, run_input, thread_config
+from src.agent.progress import stream_graph_events
+from src.api.jobs import TERMINAL, JobManager
+from src.mcp_server.discovery import tree_dry_run
+from src.agent.graph import get_app as get_agent_app
 from src.agent.state import AgentState
 
-app = FastAPI(title="Linux Kernel Agent API", version="0.1.0")
+def _initial_state(request: str, kernel_dir: Optional[str]) -> AgentState:
+    return AgentState(
+        user_request=request,
+        kernel_dir=kernel_dir,
+        retrieved_docs={},
+        cocci_script="",
+        mock_c_code="",
+        validation_output="",
+        patch_diff="",
+        error_log=[],
+        iteration_count=0,
+        status="start"
+    )
+
+def _prepare_run(request: str, kernel_dir: Optional[str], thread_id: Optional[str]) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    """Graph input and config of a run: an unfinished run of thread_id is resumed (input None)."""
+    config = thread_config(thread_id)
+    return run_input(get_agent_app(), config, dict(_initial_state(request, kernel_dir))), config
+
+def _run_summary(final_state: Dict[str, Any], config: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "thread_id": config["configurable"]["thread_id"],
+        "status": final_state.get("status"),
+        "cocci_script": final_state.get("cocci_script"),
+        "patch_diff": final_state.get("patch_diff"),
+        "error_log": final_state.get("error_log")
+    }
+
+def run_agent_job(request: Dict[str, Any], emit: Callable[[str, Any], None]) -> Dict[str, Any]:
+    """
+    Job runner: streams the graph, recording every node and progress event as a job event.
+    emit raises once the job is cancelled or the server shuts down, stopping the run
+    between nodes.
+    The job id is the run's thread id, so a job re-queued after a restart resumes from its
+    last completed node; one whose run had already finished reports that run's result.
+    """
+    agent_app = get_agent_app()
+    config = thread_config(request["job_id"])
+    if run_finished(agent_app, config):
+        return _run_summary(agent_app.get_state(config).values, config)
+    graph_input, config = _prepare_run(request["request"], request.get("kernel_dir"), request["job_id"])
+    final_state: Dict[str, Any] = {}
+    for event in stream_graph_events(agent_app, graph_input, config):
+        if event["event"] == "done":
+            final_state = event["state"]
+        elif event["event"] != "start":
+            emit(event["event"], {k: v for k, v in event.items() if k != "event"})
+    return _run_summary(final_state, config)
+
+def _sse(event: str, data: Any, seq: int) -> str:
+    return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def _create_job_manager() -> JobManager:
+    manager = JobManager(run_agent_job)
+    manager.recover()
+    return manager
+
+_jobs: Lazy[JobManager] = Lazy(_create_job_manager)
+
+def get_job_manager() -> JobManager:
+    return _jobs.get()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the LLM, retriever and tools before serving, not on the first request.
+    if WARMUP:
+        await run_in_threadpool(warm_up)
+    # Jobs left unfinished by the previous process are queued again.
+    get_job_manager()
+    yield
+    get_job_manager().shutdown()
+    _jobs.reset()
+
+app = FastAPI(title="Linux Kernel Agent API", version="0.1.0", lifespan=lifespan)
+
+# Seconds between event-log polls of a followed job.
+JOB_EVENT_POLL_INTERVAL = 0.2
 
 class UserRequest(BaseModel):
     request: str
+    kernel_dir: Optional[str] = None
+    # Checkpoint thread of the run; passing the id of an unfinished run resumes it.
+    thread_id: Optional[str] = None
 
 @app.post("/agent/run")
 async def run_agent(user_req: UserRequest):
     """
-    Run the agent with the given user request.
+    Run the agent with the given user request and wait for the result.
+    The run happens in a worker thread, so other requests are served meanwhile;
+    use POST /jobs for runs that should not hold the connection open.
+    The response carries the run's thread_id; see GET /runs/{thread_id}/history.
+    Reusing the thread_id of a finished run is rejected with 409.
     """
     try:
-        initial_state = AgentState(
-            user_request=user_req.request,
-            retrieved_docs={},
-            cocci_script="",
-            mock_c_code="",
-            validation_output="",
-            patch_diff="",
-            error_log=[],
-            iteration_count=0,
-            status="start"
-        )
+        graph_input, config = await run_in_threadpool(_prepare_run, user_req.request, user_req.kernel_dir, user_req.thread_id)
         
         # Invoke the graph
         # Note: invoke returns the final state
-        final_state = agent_app.invoke(initial_state)
+        final_state = await run_in_threadpool(get_agent_app().invoke, graph_input, config)
         
-        return {
-            "status": final_state.get("status"),
-            "cocci_script": final_state.get("cocci_script"),
-            "patch_diff": final_state.get("patch_diff"),
-            "error_log": final_state.get("error_log")
-        }
+        return _run_summary(final_state, config)
+    except RunFinishedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/agent/stream")
+def stream_agent(user_req: UserRequest):
+    """
+    Run the agent and stream its progress as server-sent events while it runs.
+    Events: "start"; one "node" per finished graph node (SPG subgraph nodes included,
+    see "namespace") carrying the node's state update and "duration"; "progress" from
+    inside long nodes (speculative candidates, target discovery, apply); then "done"
+    with the run summary, or "error". All events carry "ts" and "elapsed" seconds;
+    "start" carries the run's thread_id.
+    Reusing the thread_id of a finished run is rejected with 409.
+    """
+    try:
+        graph_input, config = _prepare_run(user_req.request, user_req.kernel_dir, user_req.thread_id)
+    except RunFinishedError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    def events():
+        seq = 0
+        try:
+            for event in stream_graph_events(get_agent_app(), graph_input, config):
+                seq += 1
+                data = {k: v for k, v in event.items() if k not in ("event", "state")}
+                if event["event"] == "start":
+                    data["thread_id"] = config["configurable"]["thread_id"]
+                elif event["event"] == "done":
+                    data["result"] = _run_summary(event["state"], config)
+                yield _sse(event["event"], data, seq)
+        except Exception as e:
+            yield _sse("error", {"error": str(e)}, seq + 1)
+
+    # Proxies must not buffer the stream, or the first events arrive with the last.
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+@app.get("/runs/{thread_id}/history")
+async def get_run_history(thread_id: str):
+    """
+    The checkpointed intermediate states of a run (main graph and SPG subgraph), oldest
+    first. They are read from the checkpoint database; no node is executed.
+    """
+    history = await run_in_threadpool(run_history, get_agent_app(), thread_id)
+    if not history:
+        raise HTTPException(status_code=404, detail="Unknown run")
+    return history
+
+@app.post("/jobs", status_code=202)
+async def submit_job(user_req: UserRequest):
+    """Queues an agent run and returns its job id at once."""
+    manager = get_job_manager()
+    job_id = await run_in_threadpool(manager.submit, {"request": user_req.request, "kernel_dir": user_req.kernel_dir})
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, timestamps and (once finished) the result or error of a job."""
+    job = await run_in_threadpool(get_job_manager().store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancels a job: queued jobs at once, running ones at their next node."""
+    status = await run_in_threadpool(get_job_manager().cancel, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return {"job_id": job_id, "status": status}
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, after: int = 0, follow: bool = True):
+    """
+    Streams the events of a job as newline-delimited JSON (queued, started, one per
+    graph node or progress report, then succeeded / failed / cancelled). Without `follow`, only the events
+    recorded so far are returned; `after` skips events up to that sequence number.
+    """
+    store = get_job_manager().store
+    if await run_in_threadpool(store.get, job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+
+    async def events():
+        last = after
+        while True:
+            batch = await run_in_threadpool(store.events, job_id, last)
+            for event in batch:
+                last = event["seq"]
+                yield json.dumps(event) + "\n"
+            if not follow:
+                return
+            if not batch:
+                job = await run_in_threadpool(store.get, job_id)
+                if job["status"] in TERMINAL and not await run_in_threadpool(store.events, job_id, last):
+                    return
+                await asyncio.sleep(JOB_EVENT_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+class TreeDryRunRequest(BaseModel):
+    script: str
+    kernel_dir: Optional[str] = None
+    max_workers: Optional[int] = None
+
+@app.post("/dry-run/tree")
+def run_tree_dry_run(req: TreeDryRunRequest):
+    """
+    Run a Coccinelle script read-only across a kernel tree.
+    Streams newline-delimited JSON events: per-file diffs with running counts
+    (files matched, hunks, errors, elapsed time), then a final summary.
+    The patches are also written to a new patch-series directory under
+    $LK_SPG_CACHE_DIR/dry-runs (see the "start" event).
+    """
+    kernel_dir = req.kernel_dir or os.environ.get("LK_SPG_KERNEL_DIR")
+    if not kernel_dir or not os.path.isdir(kernel_dir):
+        raise HTTPException(status_code=400, detail="kernel_dir is not a directory (set it or LK_SPG_KERNEL_DIR).")
+
+    def events():
+        try:
+            for event in tree_dry_run(req.script, kernel_dir, max_workers=req.max_workers):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            yield json.dumps({"event": "failed", "error": str(e)}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
+
+@app.get("/ready")
+async def ready_check():
+    """Whether the warm-up has run, with its per-resource and import-to-ready timings and the LLM cache statistics."""
+    return startup_report()
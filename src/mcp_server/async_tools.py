@@ -0,0 +1,276 @@
+import asyncio
+import os
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from src.mcp_server.cache import get_spatch_cache
+from src.mcp_server.symbol_index import SymbolIndex
+from src.mcp_server.trigram_index import GREP_BATCH, TrigramIndex
+from src.mcp_server.tool_helpers import (
+    DEFAULT_SHARD_SIZE,
+    apply_output,
+    dry_run_output,
+    expire_indexes,
+    grep_output,
+    log_apply_progress,
+    merge_grep_results,
+    prefilter_targets,
+    read_text,
+    record_shard,
+    shard_diffs,
+    split_shards,
+    symbol_grep_output,
+    symbol_index_output,
+    symbol_patterns,
+    syntax_check_output,
+)
+from src.mcp_server.tools import list_tree, read_window, read_windows
+
+# Asyncio-native counterparts of the tools in src/mcp_server/tools.py.
+# Subprocesses are started with asyncio.create_subprocess_exec so concurrent callers
+# overlap instead of blocking the event loop. Every call honours a per-call timeout,
+# kills its child process when cancelled, and holds a slot of a process-wide semaphore
+# while its subprocess runs, so the cap holds across event loops and threads (e.g. the
+# API's job workers). Blocking cache lookups run in worker threads.
+
+# Maximum number of tool subprocesses running at once in this process.
+MAX_CONCURRENT_SUBPROCESSES = int(os.environ.get("LK_SPG_MAX_SUBPROCESSES", os.cpu_count() or 4))
+# Default per-call timeout in seconds.
+DEFAULT_TIMEOUT = float(os.environ.get("LK_SPG_TOOL_TIMEOUT", "300"))
+
+# Longest pause in seconds between attempts to take a slot while all are in use.
+SLOT_POLL_MAX = 0.05
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT_SUBPROCESSES)
+
+async def _acquire_slot() -> None:
+    """
+    Waits for a subprocess slot without holding an executor thread: the semaphore is polled
+    with non-blocking acquires, backing off up to SLOT_POLL_MAX seconds between attempts.
+    A cancelled wait never owns a slot, so there is nothing to give back.
+    """
+    delay = 0.001
+    while not _slots.acquire(blocking=False):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, SLOT_POLL_MAX)
+
+@contextmanager
+def subprocess_slot(cancelled: Optional[threading.Event] = None) -> Iterator[bool]:
+    """
+    Holds a slot of the process-wide subprocess cap in blocking code (e.g. a worker thread).
+    Yields True once the slot is held, or False without a slot if cancelled is set first.
+    """
+    while not _slots.acquire(timeout=SLOT_POLL_MAX):
+        if cancelled is not None and cancelled.is_set():
+            yield False
+            return
+    try:
+        yield True
+    finally:
+        _slots.release()
+
+async def _exec(cmd: List[str], timeout: Optional[float]) -> subprocess.CompletedProcess:
+    """
+    Runs a command under the process-wide subprocess cap and returns its decoded result.
+    Raises asyncio.TimeoutError on timeout; the child is killed on timeout or cancellation.
+    """
+    await _acquire_slot()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout or DEFAULT_TIMEOUT)
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    finally:
+        _slots.release()
+    return subprocess.CompletedProcess(
+        args=cmd,
+        returncode=proc.returncode,
+        stdout=stdout.decode('utf-8', errors='replace'),
+        stderr=stderr.decode('utf-8', errors='replace')
+    )
+
+def _write_temp(content: str, suffix: str) -> str:
+    with tempfile.NamedTemporaryFile(mode='w', suffix=suffix, delete=False) as tmp:
+        tmp.write(content)
+        return tmp.name
+
+def _remove(*paths: str) -> None:
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+async def arun_spatch_syntax_check(script_content: str, timeout: Optional[float] = None) -> str:
+    """
+    Async version of run_spatch_syntax_check.
+    Returns "OK" if the script parses, otherwise the error message.
+    """
+    # make_key may run `spatch --version` and get/put hit SQLite: keep them off the loop.
+    cache = get_spatch_cache()
+    cache_key = await asyncio.to_thread(cache.make_key, "syntax_check", script_content) if cache else None
+    if cache_key:
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        if cached is not None:
+            return cached
+
+    tmp_path = _write_temp(script_content, '.cocci')
+    try:
+        output = syntax_check_output(await _exec(['spatch', '--parse-cocci', tmp_path], timeout))
+        if cache_key:
+            await asyncio.to_thread(cache.put, cache_key, output)
+        return output
+    except FileNotFoundError:
+        return "Error: 'spatch' command not found. Please ensure Coccinelle is installed."
+    except asyncio.TimeoutError:
+        return f"Error: spatch timed out after {timeout or DEFAULT_TIMEOUT}s"
+    except Exception as e:
+        return f"System Error: {str(e)}"
+    finally:
+        _remove(tmp_path)
+
+async def arun_spatch_dry_run(script_content: str, mock_c_code: str, timeout: Optional[float] = None) -> str:
+    """
+    Async version of run_spatch_dry_run.
+    Returns the generated patch (diff) or the error message.
+    """
+    cache = get_spatch_cache()
+    cache_key = await asyncio.to_thread(cache.make_key, "dry_run", script_content, mock_c_code) if cache else None
+    if cache_key:
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        if cached is not None:
+            return cached
+
+    cocci_path = _write_temp(script_content, '.cocci')
+    c_path = _write_temp(mock_c_code, '.c')
+    try:
+        output = dry_run_output(await _exec(['spatch', '--sp-file', cocci_path, c_path], timeout))
+        if cache_key:
+            await asyncio.to_thread(cache.put, cache_key, output)
+        return output
+    except FileNotFoundError:
+        return "Error: 'spatch' command not found."
+    except asyncio.TimeoutError:
+        return f"Error: spatch timed out after {timeout or DEFAULT_TIMEOUT}s"
+    except Exception as e:
+        return f"System Error: {str(e)}"
+    finally:
+        _remove(cocci_path, c_path)
+
+async def akernel_grep(pattern: str, path: str, timeout: Optional[float] = None) -> str:
+    """
+    Async version of kernel_grep. Uses the trigram index when one covers the path
+    and greps the candidate files in concurrent batches.
+    """
+    try:
+        index = await asyncio.to_thread(TrigramIndex.find, path) if os.path.isdir(path) else None
+        candidates = await asyncio.to_thread(index.candidates, pattern, path) if index else None
+
+        if candidates is None:
+            result = await _exec(['grep', '-rn', pattern, path], timeout)
+        elif not candidates:
+            return "No matches found."
+        else:
+            batches = [candidates[i:i + GREP_BATCH] for i in range(0, len(candidates), GREP_BATCH)]
+            result = merge_grep_results(await asyncio.gather(*[
+                _exec(['grep', '-Hn', '-e', pattern, '--'] + batch, timeout) for batch in batches
+            ]))
+        return grep_output(result)
+    except asyncio.TimeoutError:
+        return f"Error: grep timed out after {timeout or DEFAULT_TIMEOUT}s"
+    except Exception as e:
+        return f"System Error: {str(e)}"
+
+async def alookup_symbol_def(symbol: str, path: str, timeout: Optional[float] = None) -> str:
+    """
+    Async version of lookup_symbol_def. Without a symbol index the three heuristic
+    greps run concurrently.
+    """
+    try:
+        index = await asyncio.to_thread(SymbolIndex.find, path) if os.path.isdir(path) else None
+        if index is not None:
+            return symbol_index_output(symbol, await asyncio.to_thread(index.lookup, symbol, path))
+
+        patterns = symbol_patterns(symbol)
+        outputs = await asyncio.gather(*[akernel_grep(p, path, timeout) for p in patterns])
+        return symbol_grep_output(patterns, list(outputs))
+    except Exception as e:
+        return f"System Error: {str(e)}"
+
+async def alist_tree(path: str, max_depth: int = 2) -> str:
+    """Async version of list_tree (runs in a worker thread)."""
+    return await asyncio.to_thread(list_tree, path, max_depth)
+
+async def aread_window(file_path: str, line_number: int, window_size: int = 20) -> str:
+    """Async version of read_window (runs in a worker thread)."""
+    return await asyncio.to_thread(read_window, file_path, line_number, window_size)
+
+async def aread_windows(windows: List[Dict[str, Any]]) -> str:
+    """Async version of read_windows (runs in a worker thread)."""
+    return await asyncio.to_thread(read_windows, windows)
+
+async def _aapply_shard(script_path: str, shard: List[str], timeout: Optional[float]) -> Dict[str, Any]:
+    before = await asyncio.to_thread(lambda: {path: read_text(path) for path in shard})
+    error = None
+    try:
+        result = await _exec(['spatch', '--sp-file', script_path, '--in-place'] + shard, timeout)
+        if result.returncode != 0:
+            error = f"spatch exited with code {result.returncode}:\n{result.stderr}"
+    except FileNotFoundError:
+        error = "Error: 'spatch' command not found."
+    except asyncio.TimeoutError:
+        error = f"spatch timed out after {timeout or DEFAULT_TIMEOUT}s"
+    except Exception as e:
+        error = f"System Error: {str(e)}"
+    diffs = await asyncio.to_thread(shard_diffs, before)
+    return {"files": shard, "diffs": diffs, "error": error}
+
+async def aspatch_apply_sharded(
+    script_content: str,
+    target_files: List[str],
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    timeout: Optional[float] = None,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    prefilter: bool = True
+) -> Dict[str, Any]:
+    """
+    Async version of spatch_apply_sharded. Shards run as concurrent tasks; the process-wide
+    subprocess cap bounds how many spatch processes run at once.
+    """
+    report = {"diffs": {}, "unchanged": [], "pruned": [], "errors": [], "shards": 0}
+    targets = list(dict.fromkeys(target_files))
+    if prefilter:
+        targets = await asyncio.to_thread(prefilter_targets, script_content, targets, report)
+    if not targets:
+        return report
+
+    script_path = _write_temp(script_content, '.cocci')
+    shards = split_shards(targets, shard_size)
+    report["shards"] = len(shards)
+    tasks = [asyncio.ensure_future(_aapply_shard(script_path, shard, timeout)) for shard in shards]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            record_shard(report, await next_done, on_progress)
+    finally:
+        # On cancellation, stop the remaining shards (killing their spatch processes) before cleanup.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _remove(script_path)
+        expire_indexes(report)
+    return report
+
+async def arun_spatch_apply(script_content: str, target_files: list[str], timeout: Optional[float] = None) -> str:
+    """Async version of run_spatch_apply."""
+    if not target_files:
+        return "No target files specified."
+    report = await aspatch_apply_sharded(script_content, target_files, timeout=timeout, on_progress=log_apply_progress)
+    return apply_output(report, target_files)
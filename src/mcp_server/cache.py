@@ -0,0 +1,176 @@
+import hashlib
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# Maximum number of results kept in the SQLite tier (least recently used are evicted).
+SPATCH_CACHE_MAX_ENTRIES = int(os.environ.get("LK_SPG_SPATCH_CACHE_MAX_ENTRIES", "20000"))
+
+# Directories spatch reads its default standard.iso / standard.h from.
+COCCINELLE_HOME_CANDIDATES = ["/usr/lib/coccinelle", "/usr/local/lib/coccinelle", "/usr/share/coccinelle"]
+
+def get_cache_dir(*parts: str) -> str:
+    """
+    Returns (and creates) a directory under the LK-SPG cache root.
+    The root is $LK_SPG_CACHE_DIR, or ~/.cache/lk-spg by default.
+    """
+    base = os.environ.get("LK_SPG_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "lk-spg")
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _spatch_config_files() -> list:
+    homes = [os.environ["COCCINELLE_HOME"]] if os.environ.get("COCCINELLE_HOME") else COCCINELLE_HOME_CANDIDATES
+    files = []
+    for home in homes:
+        for name in ("standard.iso", "standard.h"):
+            path = os.path.join(home, name)
+            if os.path.isfile(path):
+                files.append(path)
+    return files
+
+_fingerprint: Optional[str] = None
+
+def spatch_fingerprint() -> str:
+    """
+    Hashes the spatch version banner together with the default iso/macro files,
+    so cached results are invalidated when Coccinelle is upgraded or reconfigured.
+    The fingerprint is computed once per process, unless spatch is not found yet.
+    """
+    global _fingerprint
+    if _fingerprint is not None:
+        return _fingerprint
+    h = hashlib.sha256()
+    try:
+        result = subprocess.run(['spatch', '--version'], capture_output=True, text=True)
+        h.update(result.stdout.encode())
+        found = True
+    except (FileNotFoundError, OSError):
+        h.update(b"spatch-not-found")
+        found = False
+    for path in _spatch_config_files():
+        h.update(path.encode())
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    if found:
+        _fingerprint = h.hexdigest()
+    return h.hexdigest()
+
+class SpatchResultCache:
+    """
+    Content-addressed cache for spatch results.
+    Entries live in an in-memory LRU and in a SQLite file so they survive restarts.
+    The SQLite tier is bounded too: past max_disk_entries the least recently used go.
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[str] = None,
+        max_memory_entries: int = 1024,
+        max_disk_entries: int = SPATCH_CACHE_MAX_ENTRIES
+    ):
+        self.db_path = db_path or os.path.join(get_cache_dir(), "spatch_results.sqlite3")
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        # Last use of an entry; added after the table was first released.
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(results)")]
+        if "used" not in columns:
+            self._conn.execute("ALTER TABLE results ADD COLUMN used REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self._conn.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(kind: str, *parts: str) -> str:
+        """Builds a key from the operation kind, its inputs and the spatch fingerprint."""
+        h = hashlib.sha256()
+        for part in (kind, spatch_fingerprint()) + parts:
+            data = part.encode('utf-8', errors='surrogateescape')
+            h.update(len(data).to_bytes(8, 'little'))
+            h.update(data)
+        return h.hexdigest()
+
+    def _remember(self, key: str, value: str) -> None:
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+            row = self._conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            # Memory hits do not touch the file; an entry read from disk counts as used again.
+            self._conn.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._remember(key, value)
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, created, used) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            excess = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_disk_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)", (excess,)
+                )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM results")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            disk_entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
+
+_spatch_cache: Optional[SpatchResultCache] = None
+_spatch_cache_lock = threading.Lock()
+
+def get_spatch_cache() -> Optional[SpatchResultCache]:
+    """
+    Returns the process-wide spatch result cache, or None when disabled
+    with LK_SPG_SPATCH_CACHE=0.
+    """
+    global _spatch_cache
+    if os.environ.get("LK_SPG_SPATCH_CACHE", "1") == "0":
+        return None
+    with _spatch_cache_lock:
+        if _spatch_cache is None:
+            _spatch_cache = SpatchResultCache()
+        return _spatch_cache
@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, Set
+from src.mcp_server.async_tools import subprocess_slot
+from src.mcp_server.cache import get_cache_dir, spatch_fingerprint
+from src.mcp_server.prefilter import prefilter_files
+from src.mcp_server.tool_helpers import DEFAULT_SHARD_SIZE, split_shards
+from src.mcp_server.trigram_index import git_output
+
+# Target discovery for a validated Coccinelle script: finds every file of a kernel tree
+# the script would change, without modifying the tree.
+# The prefilter prunes files lacking the script's identifiers, the remaining candidates
+# are dry-run by a pool of read-only spatch processes (each holding a slot of the
+# process-wide subprocess cap, see async_tools), and the resulting file list is
+# cached per (tree commit, script hash) under the LK-SPG cache directory.
+# tree_dry_run uses the same pipeline to stream a tree-wide impact report.
+
+def _tree_state(root: str) -> Optional[str]:
+    """
+    Identifies the tree content: HEAD plus a hash of the working-tree status.
+    Returns None for trees that are not git checkouts (their results are not cached).
+    """
+    commit = git_output(root, 'rev-parse', 'HEAD')
+    if commit is None:
+        return None
+    status = git_output(root, 'status', '--porcelain', '-z', '--untracked-files=normal') or ""
+    if status:
+        diff = git_output(root, 'diff', 'HEAD') or ""
+        status = hashlib.sha256((status + diff).encode('utf-8', errors='surrogateescape')).hexdigest()
+    return f"{commit.strip()}:{status}"
+
+def _cache_path(root: str, tree_state: str, script_content: str) -> str:
+    h = hashlib.sha256()
+    for part in (os.path.realpath(root), tree_state, spatch_fingerprint(), script_content):
+        data = part.encode('utf-8', errors='surrogateescape')
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return os.path.join(get_cache_dir("targets"), f"{h.hexdigest()}.json")
+
+def _match_path(name: str, by_path: Dict[str, str]) -> Optional[str]:
+    names = [name]
+    if name.startswith('a/'):
+        names += [name[2:], '/' + name[2:]]  # --patch style prefixes
+    for candidate in names:
+        path = by_path.get(os.path.abspath(candidate))
+        if path is not None:
+            return path
+    return None
+
+def _split_diffs(stdout: str, shard: List[str], root: Optional[str] = None) -> Dict[str, str]:
+    """
+    Splits spatch's diff output into one diff per shard file, keyed by the shard's paths.
+    Headers are rewritten to a/<path> b/<path>, relative to root when given.
+    """
+    by_path = {os.path.abspath(path): path for path in shard}
+    diffs: Dict[str, List[str]] = {}
+    current = None
+    lines = stdout.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith('--- ') and i + 1 < len(lines) and lines[i + 1].startswith('+++ '):
+            current = _match_path(line[4:].split('\t')[0].strip(), by_path)
+            if current is not None:
+                display = os.path.relpath(current, root) if root else current.lstrip('/')
+                diffs[current] = [f"--- a/{display}\n", f"+++ b/{display}\n"]
+            i += 2
+            continue
+        if line.startswith('diff '):
+            current = None
+        elif current is not None:
+            diffs[current].append(line)
+        i += 1
+    return {path: "".join(body) for path, body in diffs.items()}
+
+class _ShardRunner:
+    """
+    Runs read-only spatch processes over shards of a tree. stop() kills the running
+    processes and keeps queued shards from starting, so an abandoned scan ends promptly.
+    """
+
+    def __init__(self, script_path: str, timeout: Optional[float], root: Optional[str] = None):
+        self.script_path = script_path
+        self.timeout = timeout
+        self.root = root
+        self.stopped = threading.Event()
+        self._procs: Set[subprocess.Popen] = set()
+        self._lock = threading.Lock()
+
+    def run(self, shard: List[str]) -> Dict[str, Any]:
+        """Runs one read-only spatch over a shard and returns the diffs it would produce."""
+        with subprocess_slot(self.stopped) as acquired:
+            if not acquired or self.stopped.is_set():
+                return {"files": shard, "diffs": {}, "error": "Cancelled."}
+            try:
+                proc = subprocess.Popen(
+                    ['spatch', '--sp-file', self.script_path] + shard,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    errors='replace'
+                )
+            except FileNotFoundError:
+                return {"files": shard, "diffs": {}, "error": "Error: 'spatch' command not found."}
+            except Exception as e:
+                return {"files": shard, "diffs": {}, "error": f"System Error: {str(e)}"}
+            with self._lock:
+                self._procs.add(proc)
+                if self.stopped.is_set():
+                    proc.kill()
+            try:
+                stdout, stderr = proc.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                return {"files": shard, "diffs": {}, "error": f"spatch timed out after {self.timeout}s"}
+            finally:
+                with self._lock:
+                    self._procs.discard(proc)
+        error = None
+        if proc.returncode != 0:
+            error = f"spatch exited with code {proc.returncode}:\n{stderr}"
+        return {"files": shard, "diffs": _split_diffs(stdout, shard, self.root), "error": error}
+
+    def stop(self) -> None:
+        with self._lock:
+            self.stopped.set()
+            for proc in self._procs:
+                proc.kill()
+
+def _worker_count(max_workers: Optional[int], shards: int) -> int:
+    """Pool size: max_workers (never more than the CPU count) and no more than one per shard."""
+    cpus = os.cpu_count() or 1
+    return max(1, min(max_workers or cpus, cpus, shards))
+
+def discover_target_files(
+    script_content: str,
+    root: str,
+    max_workers: Optional[int] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    timeout: Optional[float] = None,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Finds the files of a source tree that a Coccinelle script would modify.
+
+    Args:
+        script_content: The content of the (validated) .cocci script.
+        root: Root of the kernel tree.
+        max_workers: Maximum number of concurrent spatch processes (defaults to, and is capped
+            at, the CPU count).
+        shard_size: Maximum number of files handed to one spatch process.
+        timeout: Optional per-shard timeout in seconds.
+        use_cache: Reuse/record results keyed by the tree state and the script.
+    Returns:
+        A dict with "targets" (sorted file paths under root), "total" (source files in the
+        tree), "candidates" (files left after the prefilter), "errors" (one entry per failed
+        shard), "cached" and "elapsed" (seconds).
+    """
+    start = time.time()
+    root = os.path.realpath(root)
+    tree_state = _tree_state(root) if use_cache else None
+    cache_path = _cache_path(root, tree_state, script_content) if tree_state else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            report = json.load(f)
+        report.update(cached=True, elapsed=time.time() - start)
+        return report
+
+    filtered = prefilter_files(script_content, root=root)
+    candidates = filtered["candidates"]
+    print(f"[discovery] prefilter kept {len(candidates)} of {filtered['total']} files")
+
+    targets: Set[str] = set()
+    errors = []
+    if candidates:
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.cocci', delete=False) as tmp:
+            tmp.write(script_content)
+            script_path = tmp.name
+        shards = split_shards(candidates, shard_size)
+        runner = _ShardRunner(script_path, timeout)
+        try:
+            with ThreadPoolExecutor(max_workers=_worker_count(max_workers, len(shards))) as pool:
+                futures = [pool.submit(runner.run, shard) for shard in shards]
+                for future in as_completed(futures):
+                    shard_result = future.result()
+                    targets.update(shard_result["diffs"])
+                    if shard_result["error"]:
+                        errors.append({"files": shard_result["files"], "error": shard_result["error"]})
+        finally:
+            os.remove(script_path)
+
+    report = {
+        "targets": sorted(targets),
+        "total": filtered["total"],
+        "candidates": len(candidates),
+        "errors": errors,
+        "cached": False,
+    }
+    # Failed shards may hide targets, so only complete results are cached.
+    if cache_path and not errors:
+        tmp_cache = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_cache, 'w') as f:
+            json.dump(report, f)
+        os.replace(tmp_cache, cache_path)
+    report["elapsed"] = time.time() - start
+    print(f"[discovery] {len(report['targets'])} target files found in {report['elapsed']:.1f}s")
+    return report
+
+def _count_hunks(diff: str) -> int:
+    return sum(1 for line in diff.splitlines() if line.startswith('@@ '))
+
+def tree_dry_run(
+    script_content: str,
+    root: str,
+    output_dir: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    timeout: Optional[float] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Runs a Coccinelle script read-only across a whole tree and yields progress events
+    as shards complete. The per-file patches are also written to a patch-series
+    directory (one <path>.patch per file, a quilt-style `series` file and summary.json).
+
+    Args:
+        script_content: The content of the .cocci script.
+        root: Root of the kernel tree.
+        output_dir: Patch-series directory (defaults to a new directory under
+            $LK_SPG_CACHE_DIR/dry-runs).
+        max_workers: Maximum number of concurrent spatch processes (defaults to, and is
+            capped at, the CPU count).
+        shard_size: Maximum number of files handed to one spatch process.
+        timeout: Optional per-shard timeout in seconds.
+    Yields:
+        Event dicts with an "event" key: "start", then one "file" (with "file", "diff",
+        "hunks") per matched file and one "error" per failed shard, each carrying the
+        running "counts", and finally "done".
+    """
+    start = time.time()
+    root = os.path.realpath(root)
+    if output_dir is None:
+        output_dir = get_cache_dir("dry-runs", time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    filtered = prefilter_files(script_content, root=root)
+    candidates = filtered["candidates"]
+    counts = {"scanned": 0, "files_matched": 0, "hunks": 0, "errors": 0, "elapsed": 0.0}
+    yield {
+        "event": "start",
+        "root": root,
+        "total": filtered["total"],
+        "candidates": len(candidates),
+        "output_dir": output_dir,
+    }
+
+    series = []
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.cocci', delete=False) as tmp:
+        tmp.write(script_content)
+        script_path = tmp.name
+    shards = split_shards(candidates, shard_size)
+    runner = _ShardRunner(script_path, timeout, root)
+    pool = ThreadPoolExecutor(max_workers=_worker_count(max_workers, len(shards)))
+    try:
+        futures = [pool.submit(runner.run, shard) for shard in shards]
+        for future in as_completed(futures):
+            shard_result = future.result()
+            counts["scanned"] += len(shard_result["files"])
+            for path in sorted(shard_result["diffs"]):
+                diff = shard_result["diffs"][path]
+                rel = os.path.relpath(path, root)
+                patch_path = os.path.join(output_dir, rel + ".patch")
+                os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+                with open(patch_path, 'w', errors='surrogateescape') as f:
+                    f.write(diff)
+                series.append(rel + ".patch")
+                hunks = _count_hunks(diff)
+                counts["files_matched"] += 1
+                counts["hunks"] += hunks
+                counts["elapsed"] = time.time() - start
+                yield {"event": "file", "file": rel, "diff": diff, "hunks": hunks, "counts": dict(counts)}
+            if shard_result["error"]:
+                counts["errors"] += 1
+                counts["elapsed"] = time.time() - start
+                yield {
+                    "event": "error",
+                    "files": [os.path.relpath(p, root) for p in shard_result["files"]],
+                    "error": shard_result["error"],
+                    "counts": dict(counts),
+                }
+    finally:
+        # Also reached when the consumer stops early (e.g. the HTTP client disconnects):
+        # running spatch processes are killed and waited for before the script is removed.
+        runner.stop()
+        pool.shutdown(wait=True, cancel_futures=True)
+        os.remove(script_path)
+        with open(os.path.join(output_dir, "series"), 'w') as f:
+            f.writelines(name + "\n" for name in sorted(series))
+
+    counts["elapsed"] = time.time() - start
+    with open(os.path.join(output_dir, "summary.json"), 'w') as f:
+        json.dump({"root": root, "total": filtered["total"], "candidates": len(candidates), **counts}, f, indent=2)
+    yield {"event": "done", "counts": counts, "output_dir": output_dir}
@@ -0,0 +1,244 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, FrozenSet, List, Optional, Set
+from src.mcp_server.trigram_index import GREP_BATCH, TrigramIndex, list_indexable_files
+
+# Candidate-file prefilter for Coccinelle scripts.
+# The identifiers a script needs to find in a file (function names, struct fields,
+# constants on minus/context lines) are extracted per rule as CNF clauses: a file can
+# only match a rule if it contains at least one token of every clause. The candidate
+# set is the union over the script's entry rules, so it is always a superset of the
+# files spatch would change.
+
+SOURCE_SUFFIXES = ('.c', '.h')
+
+_TOKEN_RE = re.compile(r'\\[(|&)]|<\+\.\.\.|\.\.\.\+>|<\.\.\.|\.\.\.>|[A-Za-z_]\w*|\d\w*')
+_STRING_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'')
+_HEADER_RE = re.compile(r'^@([^@]*)@\s*$')
+_WHEN_RE = re.compile(r'\bwhen\b.*$')
+
+# Words that never narrow the search: C keywords, SmPL keywords, and identifiers
+# that standard isomorphisms can make disappear from the matched code.
+_IGNORED = {
+    "auto", "break", "case", "char", "const", "continue", "default", "do", "double", "else",
+    "enum", "extern", "float", "for", "goto", "if", "inline", "int", "long", "register",
+    "return", "short", "signed", "sizeof", "static", "struct", "switch", "typedef", "union",
+    "unsigned", "void", "volatile", "while", "bool", "NULL", "true", "false",
+    "when", "any", "exists", "forall", "strict", "depends", "on", "ever", "never",
+    "include", "define",
+}
+
+Clause = FrozenSet[str]
+
+class _Frame:
+    """Requirement accumulator for one (branch of a) SmPL disjunction/conjunction."""
+
+    def __init__(self, kind: str = "&"):
+        self.kind = kind
+        self.clauses: List[Clause] = []
+        self.branches: List[List[Clause]] = []
+
+    def close_branch(self) -> None:
+        self.branches.append(self.clauses)
+        self.clauses = []
+
+def _representative(clauses: List[Clause]) -> Optional[Clause]:
+    """Smallest clause of a branch, preferring longer (more selective) tokens."""
+    if not clauses:
+        return None
+    return min(clauses, key=lambda c: (len(c), -max(len(t) for t in c)))
+
+def _parse_rules(script_content: str) -> List[Dict[str, Any]]:
+    """Splits a .cocci script into rules with their header, metavariable section and body lines."""
+    rules = []
+    current = None
+    state = None
+    for line in script_content.splitlines():
+        m = _HEADER_RE.match(line)
+        if m:
+            if state == "decls":
+                state = "body"
+                continue
+            current = {"header": m.group(1).strip(), "decls": [], "body": []}
+            rules.append(current)
+            state = "decls"
+            continue
+        if current is None:
+            continue
+        current["decls" if state == "decls" else "body"].append(line)
+    return rules
+
+def _rule_clauses(rule: Dict[str, Any]) -> List[Clause]:
+    """Computes the CNF requirement of one rule's body."""
+    decls = _STRING_RE.sub(' ', re.sub(r'//.*', '', "\n".join(rule["decls"])))
+    metavars = set(re.findall(r'[A-Za-z_]\w*', decls))
+
+    body = re.sub(r'/\*.*?\*/', ' ', "\n".join(rule["body"]), flags=re.DOTALL)
+    stack = [_Frame()]
+    optional_depth = 0
+    # Open inline \( ... \| ... \) groups: one token list per branch.
+    inline: List[List[List[str]]] = []
+    for raw in body.splitlines():
+        if not raw.strip() or raw.lstrip().startswith('//'):
+            continue
+        marker = raw[0]
+        if marker in '(|)&' and optional_depth == 0 and not inline:
+            if marker == '(':
+                stack.append(_Frame("|"))
+            elif marker in '|&' and len(stack) > 1:
+                if marker == '&':
+                    stack[-1].kind = '&'
+                stack[-1].close_branch()
+            elif marker == ')' and len(stack) > 1:
+                frame = stack.pop()
+                frame.close_branch()
+                if frame.kind == '&':
+                    for branch in frame.branches:
+                        stack[-1].clauses.extend(branch)
+                else:
+                    reps = [_representative(b) for b in frame.branches]
+                    if reps and all(reps):
+                        stack[-1].clauses.append(frozenset().union(*reps))
+            marker = ' '
+            raw = ' ' + raw[1:]
+        if marker in '+?':
+            continue
+        text = raw[1:] if marker in '-*' else raw
+        text = _WHEN_RE.sub('', _STRING_RE.sub(' ', re.sub(r'//.*', '', text)))
+
+        for m in _TOKEN_RE.finditer(text):
+            token = m.group(0)
+            if token == '<...':
+                optional_depth += 1
+            elif token == '...>':
+                optional_depth = max(0, optional_depth - 1)
+            elif optional_depth or token in ('<+...', '...+>'):
+                continue
+            elif token == '\\(':
+                inline.append([[]])
+            elif token in ('\\|', '\\&'):
+                if inline:
+                    inline[-1].append([])
+            elif token == '\\)':
+                if not inline:
+                    continue
+                branches = inline.pop()
+                if inline or not all(branches):
+                    continue  # Nested or possibly empty alternatives: no constraint
+                clause = frozenset(max(b, key=len) for b in branches)
+                stack[-1].clauses.append(clause)
+            elif token[0].isdigit() or token in metavars or token in _IGNORED:
+                continue
+            elif inline:
+                inline[-1][-1].append(token)
+            else:
+                stack[-1].clauses.append(frozenset([token]))
+
+    # Unbalanced disjunctions are dropped along with their constraints.
+    return list(dict.fromkeys(stack[0].clauses))
+
+def extract_required_tokens(script_content: str) -> Optional[List[List[Clause]]]:
+    """
+    Returns the CNF requirement of each entry rule of the script, or None when some
+    rule can match without any identifier (then no file can be pruned).
+    Script rules and rules that only depend on other matching rules are skipped,
+    since they cannot add candidates of their own.
+    """
+    rules = _parse_rules(script_content)
+    names = {}
+    for rule in rules:
+        head = rule["header"].split()
+        if head and not head[0].startswith(("script:", "initialize:", "finalize:")) and head[0] not in ("depends",):
+            names[head[0]] = rule
+
+    requirements = []
+    for rule in rules:
+        header = rule["header"]
+        if header.startswith(("script:", "initialize:", "finalize:")):
+            continue
+        dep = re.search(r'\bdepends\s+on\s+(.*?)(?:\b(?:exists|forall|strict|disable|using)\b|$)', header)
+        if dep:
+            terms = [t.strip() for t in dep.group(1).split('&&')]
+            if all(re.fullmatch(r'\w+', t) for t in terms) and any(t in names for t in terms):
+                continue  # Only applies where an already-counted rule matched
+        clauses = _rule_clauses(rule)
+        if not clauses:
+            return None
+        requirements.append(clauses)
+    return requirements or None
+
+def _grep_words(tokens: Clause, files: List[str]) -> Set[str]:
+    """Returns the files containing at least one of the tokens as a whole word."""
+    if not files:
+        return set()
+    patterns = []
+    for token in sorted(tokens):
+        patterns += ['-e', token]
+    batches = [files[i:i + GREP_BATCH] for i in range(0, len(files), GREP_BATCH)]
+
+    def _run(batch):
+        result = subprocess.run(['grep', '-lwF'] + patterns + ['--'] + batch, capture_output=True, text=True)
+        return result.stdout.splitlines()
+
+    with ThreadPoolExecutor(max_workers=min(len(batches), os.cpu_count() or 1)) as pool:
+        return {path for found in pool.map(_run, batches) for path in found}
+
+def _files_matching(clauses: List[Clause], files: List[str], index: Optional[TrigramIndex], root: Optional[str]) -> Set[str]:
+    remaining = files
+    if index is not None and root is not None:
+        # Narrow with the trigram index first: any single-token clause is a literal pattern.
+        by_path = {os.path.abspath(f): f for f in files}
+        for clause in sorted(clauses, key=lambda c: -max(len(t) for t in c)):
+            if len(clause) == 1:
+                candidates = index.candidates(next(iter(clause)), root)
+                if candidates is not None:
+                    found = (by_path.get(os.path.abspath(c)) for c in candidates)
+                    remaining = [f for f in found if f is not None]
+                    break
+    # Confirm every clause with word-level grep, most selective first.
+    for clause in sorted(clauses, key=lambda c: (len(c), -max(len(t) for t in c))):
+        if not remaining:
+            break
+        remaining = sorted(_grep_words(clause, remaining))
+    return set(remaining)
+
+def prefilter_files(
+    script_content: str,
+    files: Optional[List[str]] = None,
+    root: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Reduces a list of files (or all .c/.h files of a tree) to those that can match the script.
+
+    Args:
+        script_content: The content of the .cocci script.
+        files: Explicit candidate files. If omitted, all .c/.h files under root are used.
+        root: Tree root; enables the trigram index (src/mcp_server/trigram_index.py) when one exists.
+    Returns:
+        A dict with "candidates" (kept files, in input order), "total", "pruned" and
+        "tokens" (the CNF requirement per rule, or None if nothing could be pruned).
+    """
+    if files is None:
+        if root is None:
+            raise ValueError("Either files or root must be given.")
+        rels, _ = list_indexable_files(os.path.realpath(root))
+        files = [os.path.join(root, rel) for rel in rels if rel.endswith(SOURCE_SUFFIXES)]
+
+    requirements = extract_required_tokens(script_content)
+    if requirements is None:
+        return {"candidates": list(files), "total": len(files), "pruned": 0, "tokens": None}
+
+    index = TrigramIndex.find(root) if root and os.path.isdir(root) else None
+    keep: Set[str] = set()
+    for clauses in requirements:
+        keep |= _files_matching(clauses, [f for f in files if f not in keep], index, root)
+
+    candidates = [f for f in files if f in keep]
+    return {
+        "candidates": candidates,
+        "total": len(files),
+        "pruned": len(files) - len(candidates),
+        "tokens": [[sorted(c) for c in clauses] for clauses in requirements],
+    }
@@ -1,11 +1,13 @@
 from mcp.server.fastmcp import FastMCP
-from src.mcp_server.tools import run_spatch_syntax_check, run_spatch_dry_run
+import json
+from src.mcp_server.async_tools import arun_spatch_syntax_check, arun_spatch_dry_run
+from src.mcp_server.cache import get_spatch_cache
 
 # Initialize FastMCP server
 mcp = FastMCP("LK-SPG-Server")
 
 @mcp.tool()
-def syntax_check(script_content: str) -> str:
+async def syntax_check(script_content: str) -> str:
     """
     Check the syntax of a Coccinelle (SmPL) script.
     
@@ -15,10 +17,10 @@ def syntax_check(script_content: str) -> str:
     Returns:
         "OK" if syntax is correct, otherwise the error message.
     """
-    return run_spatch_syntax_check(script_content)
+    return await arun_spatch_syntax_check(script_content)
 
 @mcp.tool()
-def dry_run_verification(script_content: str, mock_c_code: str) -> str:
+async def dry_run_verification(script_content: str, mock_c_code: str) -> str:
     """
     Run a dry run of the Coccinelle script against a mock C file to verify it generates the expected patch.
     
@@ -29,7 +31,20 @@ def dry_run_verification(script_content: str, mock_c_code: str) -> str:
     Returns:
         The generated patch (diff) or error message.
     """
-    return run_spatch_dry_run(script_content, mock_c_code)
+    return await arun_spatch_dry_run(script_content, mock_c_code)
+
+@mcp.tool()
+def spatch_cache_stats() -> str:
+    """
+    Report hit/miss counters of the spatch syntax-check / dry-run result cache.
+    
+    Returns:
+        A JSON object with memory/disk hits, misses, hit rate and entry counts.
+    """
+    cache = get_spatch_cache()
+    if cache is None:
+        return "Spatch result cache is disabled (LK_SPG_SPATCH_CACHE=0)."
+    return json.dumps(cache.stats(), indent=2)
 
 def main():
     mcp.run()
@@ -0,0 +1,293 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from src.mcp_server.cache import get_cache_dir
+from src.mcp_server.trigram_index import REFRESH_INTERVAL, changed_files, list_indexable_files
+
+# Prebuilt table of C symbol definitions for a kernel tree, used by lookup_symbol_def.
+# Symbols are stored in SQLite with a B-tree index on the name, so a lookup is O(log n).
+# Like the trigram index, the table is checked against the tree at query time (git diff
+# from the indexed commit, else mtime/size); files changed since the build, e.g. by an
+# in-place apply, are re-scanned and their rows replace the stored ones.
+
+INDEX_VERSION = 2
+CHUNK_FILES = 1000
+SOURCE_SUFFIXES = ('.c', '.h')
+
+# Kinds, in the order lookup results are reported, with the label used in the output.
+KIND_LABELS = [
+    ("struct", "struct {}"),
+    ("union", "union {}"),
+    ("enum", "enum {}"),
+    ("typedef", "typedef {}"),
+    ("macro", "#define {}"),
+    ("function", "{}("),
+    ("prototype", "{}("),
+]
+
+_DEFINE_RE = re.compile(r'^\s*#\s*define\s+([A-Za-z_]\w*)')
+_TAG_RE = re.compile(r'^(typedef\s+)?(struct|union|enum)\s+([A-Za-z_]\w*)\s*(\{.*)?$')
+_TYPEDEF_CLOSE_RE = re.compile(r'^\}\s*(?:__\w+(?:\(\([^)]*\)\))?\s*)*([A-Za-z_]\w*)\s*(?:\[[^\]]*\]\s*)*;')
+_TYPEDEF_FNPTR_RE = re.compile(r'\(\s*\*\s*([A-Za-z_]\w*)\s*\)')
+_TYPEDEF_NAME_RE = re.compile(r'([A-Za-z_]\w*)\s*(?:\[[^\]]*\]\s*)*;')
+_FUNC_RE = re.compile(r'^([A-Za-z_][^#;{}=()]*?)?\b([A-Za-z_]\w*)\s*\(')
+_TYPE_LINE_RE = re.compile(r'^[A-Za-z_][\w\s\*]*$')
+
+_STORAGE_WORDS = {"static", "extern", "inline", "__always_inline", "noinline", "__init", "__exit",
+                  "__cold", "__weak", "asmlinkage", "notrace", "__must_check", "STATIC"}
+_NOT_FUNCTIONS = {"if", "for", "while", "switch", "return", "sizeof", "typeof", "do", "else",
+                  "case", "goto", "__attribute__", "defined"}
+
+def _index_path(root: str) -> str:
+    digest = hashlib.sha1(os.path.realpath(root).encode()).hexdigest()[:16]
+    return os.path.join(get_cache_dir("symbols"), f"{digest}.sqlite3")
+
+def _has_type(prefix: str) -> bool:
+    words = re.findall(r'[A-Za-z_]\w*', prefix)
+    return any(w not in _STORAGE_WORDS for w in words)
+
+def scan_symbols(text: str) -> List[Tuple[str, str, int, str]]:
+    """
+    Heuristically extracts top-level definitions from kernel-style C source.
+    Returns (name, kind, line, text) tuples; line numbers are 1-indexed.
+    """
+    lines = text.splitlines()
+    symbols = []
+    typedef_block = False
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        lineno = i + 1
+
+        m = _DEFINE_RE.match(line)
+        if m:
+            symbols.append((m.group(1), "macro", lineno, line.rstrip()))
+            i += 1
+            continue
+
+        if typedef_block:
+            m = _TYPEDEF_CLOSE_RE.match(line)
+            if m:
+                symbols.append((m.group(1), "typedef", lineno, line.rstrip()))
+                typedef_block = False
+                i += 1
+                continue
+            if line.startswith('}'):
+                typedef_block = False
+
+        if not line or line[0] in ' \t#/*}{':
+            i += 1
+            continue
+
+        m = _TAG_RE.match(line)
+        if m:
+            opens = m.group(4) or (i + 1 < len(lines) and lines[i + 1].startswith('{'))
+            if opens:
+                symbols.append((m.group(3), m.group(2), lineno, line.rstrip()))
+            if m.group(1) and opens:
+                typedef_block = True
+            i += 1
+            continue
+
+        if line.startswith('typedef'):
+            if '{' in line:
+                typedef_block = True
+            elif line.rstrip().endswith(';'):
+                m = _TYPEDEF_FNPTR_RE.search(line) or _TYPEDEF_NAME_RE.search(line)
+                if m:
+                    symbols.append((m.group(1), "typedef", lineno, line.rstrip()))
+            i += 1
+            continue
+
+        m = _FUNC_RE.match(line)
+        if m and m.group(2) not in _NOT_FUNCTIONS:
+            prefix = m.group(1) or ""
+            if not prefix.strip() and i > 0 and _TYPE_LINE_RE.match(lines[i - 1].rstrip()):
+                prefix = lines[i - 1]  # Return type on its own line
+            if _has_type(prefix):
+                # Find whether the declarator ends in a body or a semicolon.
+                depth = 0
+                kind = None
+                for j in range(i, min(i + 20, len(lines))):
+                    for ch in lines[j][m.start(2) if j == i else 0:]:
+                        if ch == '(':
+                            depth += 1
+                        elif ch == ')':
+                            depth -= 1
+                        elif depth == 0 and ch in ';{=,':
+                            kind = {'{': "function", ';': "prototype"}.get(ch)
+                            break
+                    else:
+                        if depth == 0 and j + 1 < len(lines) and lines[j + 1].startswith('{'):
+                            kind = "function"
+                            break
+                        continue
+                    break
+                if kind:
+                    symbols.append((m.group(2), kind, lineno, line.rstrip()))
+        i += 1
+    return symbols
+
+def _stat_key(path: str) -> Tuple[int, int]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (0, 0)
+    return (st.st_mtime_ns, st.st_size)
+
+def _scan_chunk(root: str, relpaths: List[str]) -> List[Tuple[str, str, str, int, str]]:
+    """Worker: scans a batch of files and returns (name, kind, file, line, text) rows."""
+    rows = []
+    for rel in relpaths:
+        try:
+            with open(os.path.join(root, rel), 'r', errors='replace') as f:
+                text = f.read()
+        except OSError:
+            continue
+        for name, kind, line, snippet in scan_symbols(text):
+            rows.append((name, kind, rel, line, snippet))
+    return rows
+
+class SymbolIndex:
+    """SQLite-backed symbol table for one source tree."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        meta = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        self.root = meta["root"]
+        self.commit = meta.get("commit")
+        has_files = self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone()
+        self.files = [list(r) for r in self._conn.execute("SELECT file, mtime, size FROM files")] if has_files else None
+        # Re-scanned files: relpath -> ((mtime_ns, size), rows).
+        self._rescanned: Dict[str, Tuple[Tuple[int, int], List[Tuple[str, str, str, int, str]]]] = {}
+        self._last_refresh = 0.0
+
+    @classmethod
+    def build(cls, root: str, jobs: Optional[int] = None) -> "SymbolIndex":
+        """Scans all .c/.h files of a tree with a pool of worker processes and writes the table."""
+        root = os.path.realpath(root)
+        start = time.time()
+        files, commit = list_indexable_files(root)
+        files = [f for f in files if f.endswith(SOURCE_SUFFIXES)]
+
+        db_path = _index_path(root)
+        tmp_path = db_path + ".building"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE symbols (name TEXT NOT NULL, kind TEXT NOT NULL, file TEXT NOT NULL, line INTEGER NOT NULL, text TEXT)")
+        conn.execute("CREATE TABLE files (file TEXT PRIMARY KEY, mtime INTEGER NOT NULL, size INTEGER NOT NULL)")
+        conn.executemany("INSERT INTO files VALUES (?, ?, ?)", [(rel,) + _stat_key(os.path.join(root, rel)) for rel in files])
+
+        chunks = [files[i:i + CHUNK_FILES] for i in range(0, len(files), CHUNK_FILES)]
+        count = 0
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            for rows in pool.map(_scan_chunk, [root] * len(chunks), chunks):
+                conn.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?, ?)", rows)
+                count += len(rows)
+
+        # Building the index after the bulk insert is much faster than maintaining it.
+        conn.execute("CREATE INDEX symbols_name ON symbols (name)")
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("version", str(INDEX_VERSION)),
+            ("root", root),
+            ("commit", commit or ""),
+            ("built", str(time.time())),
+        ])
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, db_path)
+        print(f"Indexed {count} symbols from {len(files)} files under {root} in {time.time() - start:.1f}s")
+        return cls(db_path)
+
+    @classmethod
+    def find(cls, path: str) -> Optional["SymbolIndex"]:
+        """Returns the symbol index covering path (the path itself or one of its ancestors), if any."""
+        current = os.path.realpath(path)
+        while True:
+            db_path = _index_path(current)
+            if os.path.exists(db_path):
+                mtime = os.path.getmtime(db_path)
+                with _open_indexes_lock:
+                    cached = _open_indexes.get(db_path)
+                    if cached is None or cached[0] != mtime:
+                        cached = (mtime, cls(db_path))
+                        _open_indexes[db_path] = cached
+                return cached[1]
+            parent = os.path.dirname(current)
+            if parent == current:
+                return None
+            current = parent
+
+    def _refresh(self) -> None:
+        """Re-scans the source files changed since the build (at most every REFRESH_INTERVAL)."""
+        with self._lock:
+            if time.time() - self._last_refresh < REFRESH_INTERVAL:
+                return
+            self._last_refresh = time.time()
+        if not self.commit and self.files is None:
+            return  # Built before file stats were recorded
+        dirty = {rel for rel in changed_files(self.root, self.commit, self.files or []) if rel.endswith(SOURCE_SUFFIXES)}
+        rescanned = {}
+        for rel in dirty:
+            key = _stat_key(os.path.join(self.root, rel))
+            previous = self._rescanned.get(rel)
+            rows = previous[1] if previous and previous[0] == key else _scan_chunk(self.root, [rel])
+            rescanned[rel] = (key, rows)
+        with self._lock:
+            self._rescanned = rescanned
+
+    def lookup(self, name: str, path: str) -> Dict[str, List[str]]:
+        """
+        Returns the definitions of name under path, grouped by kind.
+        Each entry is a grep-style `file:line:text` string with file spelled relative to path.
+        """
+        self._refresh()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, file, line, text FROM symbols WHERE name = ? ORDER BY file, line", (name,)
+            ).fetchall()
+            rescanned = self._rescanned
+        if rescanned:
+            rows = [r for r in rows if r[1] not in rescanned] + [
+                (kind, rel, line, text)
+                for _, rows_of_file in rescanned.values()
+                for symbol, kind, rel, line, text in rows_of_file if symbol == name
+            ]
+            rows.sort(key=lambda r: (r[1], r[2]))
+
+        prefix = os.path.relpath(os.path.realpath(path), self.root)
+        grouped: Dict[str, List[str]] = {}
+        for kind, rel, line, text in rows:
+            if prefix != '.':
+                if rel != prefix and not rel.startswith(prefix + os.sep):
+                    continue
+                rel = rel[len(prefix) + 1:]
+            display = os.path.join(path, rel) if rel else path
+            grouped.setdefault(kind, []).append(f"{display}:{line}:{text}")
+        return grouped
+
+_open_indexes: Dict[str, Tuple[float, SymbolIndex]] = {}
+_open_indexes_lock = threading.Lock()
+
+def expire_refresh() -> None:
+    """Makes the next lookup of every open index re-check the tree (after files were rewritten)."""
+    with _open_indexes_lock:
+        for _, index in _open_indexes.values():
+            index._last_refresh = 0.0
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the symbol definition index used by lookup_symbol_def.")
+    parser.add_argument("path", help="Root of the kernel tree")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+    SymbolIndex.build(args.path, jobs=args.jobs)
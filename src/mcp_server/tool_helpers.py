@@ -0,0 +1,173 @@
+import difflib
+import os
+import subprocess
+from typing import Any, Callable, Dict, List, Optional
+from src.mcp_server import symbol_index, trigram_index
+from src.mcp_server.prefilter import prefilter_files
+from src.mcp_server.symbol_index import KIND_LABELS
+
+# Helpers shared by the blocking tools (src/mcp_server/tools.py), their asyncio
+# counterparts (src/mcp_server/async_tools.py) and target discovery: turning
+# subprocess results into tool output, and sharding / diffing / reporting of
+# in-place applies.
+
+# Default number of files handed to a single spatch process when sharding.
+DEFAULT_SHARD_SIZE = 32
+
+def syntax_check_output(result: subprocess.CompletedProcess) -> str:
+    if result.returncode == 0:
+        return "OK"
+    # Combine stdout and stderr for full context, though errors are usually in stderr
+    return f"Syntax Error:\n{result.stderr}\n{result.stdout}"
+
+def dry_run_output(result: subprocess.CompletedProcess) -> str:
+    if result.returncode == 0:
+        # spatch outputs the diff to stdout
+        return result.stdout
+    # If spatch fails (e.g. syntax error in C file or runtime error), return error as output
+    return f"Runtime Error:\n{result.stderr}"
+
+def grep_output(result: subprocess.CompletedProcess) -> str:
+    if result.returncode == 0:
+        # Limit output to first 50 lines to prevent context overflow
+        lines = result.stdout.splitlines()
+        if len(lines) > 50:
+            return "\n".join(lines[:50]) + f"\n... (and {len(lines) - 50} more matches)"
+        return result.stdout
+    elif result.returncode == 1:
+        return "No matches found."
+    else:
+        return f"Error: {result.stderr}"
+
+def merge_grep_results(results: List[subprocess.CompletedProcess]) -> subprocess.CompletedProcess:
+    """Combines per-batch grep runs into one result with grep's exit status semantics."""
+    codes = [r.returncode for r in results]
+    returncode = 2 if 2 in codes and 0 not in codes else (0 if 0 in codes else 1)
+    return subprocess.CompletedProcess(
+        args=['grep'],
+        returncode=returncode,
+        stdout="".join(r.stdout for r in results),
+        stderr="".join(r.stderr for r in results)
+    )
+
+def symbol_index_output(symbol: str, grouped: Dict[str, List[str]]) -> str:
+    sections: Dict[str, List[str]] = {}
+    for kind, label in KIND_LABELS:
+        if kind in grouped:
+            sections.setdefault(label.format(symbol), []).extend(grouped[kind])
+    results = [f"--- Matches for '{label}' ---\n" + "\n".join(lines) for label, lines in sections.items()]
+    if not results:
+        return "No definition found (symbol index)."
+    return "\n\n".join(results)
+
+def symbol_patterns(symbol: str) -> List[str]:
+    return [
+        f"struct {symbol}",
+        f"#define {symbol}",
+        f"{symbol}(",
+    ]
+
+def symbol_grep_output(patterns: List[str], outputs: List[str]) -> str:
+    results = []
+    for p, res in zip(patterns, outputs):
+        if "No matches found" not in res:
+            results.append(f"--- Matches for '{p}' ---\n{res}")
+    
+    if not results:
+        return "No definition found (heuristics failed)."
+    return "\n\n".join(results)
+
+def split_shards(files: List[str], shard_size: int) -> List[List[str]]:
+    """Splits the target list into contiguous shards of at most shard_size files."""
+    shard_size = max(1, shard_size)
+    return [files[i:i + shard_size] for i in range(0, len(files), shard_size)]
+
+def read_text(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r', errors='surrogateescape') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def file_diff(path: str, before: str, after: str) -> str:
+    """Builds a unified diff (a/ b/ prefixed) for a single file."""
+    return "".join(difflib.unified_diff(
+        before.splitlines(keepends=True),
+        after.splitlines(keepends=True),
+        fromfile=f"a/{path.lstrip('/')}",
+        tofile=f"b/{path.lstrip('/')}",
+    ))
+
+def shard_diffs(before: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """Diffs the current content of each file against its snapshot."""
+    diffs = {}
+    for path, old in before.items():
+        after = read_text(path)
+        if old is not None and after is not None and after != old:
+            diffs[path] = file_diff(path, old, after)
+    return diffs
+
+def record_shard(
+    report: Dict[str, Any],
+    shard_result: Dict[str, Any],
+    on_progress: Optional[Callable[[Dict[str, Any]], None]]
+) -> None:
+    """Folds one shard's outcome into the aggregate report and emits per-file progress."""
+    if shard_result["error"]:
+        report["errors"].append({"files": shard_result["files"], "error": shard_result["error"]})
+    for path in shard_result["files"]:
+        diff = shard_result["diffs"].get(path)
+        if diff:
+            report["diffs"][path] = diff
+            status = "changed"
+        elif shard_result["error"]:
+            status = "error"
+        else:
+            report["unchanged"].append(path)
+            status = "unchanged"
+        if on_progress:
+            on_progress({
+                "file": path,
+                "status": status,
+                "diff": diff,
+                "error": shard_result["error"] if status == "error" else None
+            })
+
+def expire_indexes(report: Dict[str, Any]) -> None:
+    """Rewritten files make the grep/symbol indexes re-check the tree on their next query."""
+    if report["diffs"]:
+        trigram_index.expire_refresh(report["diffs"])
+        symbol_index.expire_refresh()
+
+def prefilter_targets(script_content: str, target_files: List[str], report: Dict[str, Any]) -> List[str]:
+    """Drops the files the script cannot match, recording them in report["pruned"]."""
+    if not target_files:
+        return target_files
+    try:
+        roots = [os.path.dirname(os.path.abspath(path)) for path in target_files]
+        result = prefilter_files(script_content, target_files, root=os.path.commonpath(roots))
+    except Exception as e:
+        print(f"[spatch apply] prefilter failed, applying to all targets: {e}")
+        return target_files
+    kept = set(result["candidates"])
+    report["pruned"] = [path for path in target_files if path not in kept]
+    if report["pruned"]:
+        print(f"[spatch apply] prefilter pruned {result['pruned']} of {result['total']} files")
+    return result["candidates"]
+
+def log_apply_progress(event: Dict[str, Any]) -> None:
+    print(f"[spatch apply] {event['status']}: {event['file']}")
+
+def apply_output(report: Dict[str, Any], target_files: List[str]) -> str:
+    target_files = list(dict.fromkeys(target_files))
+    output = [report["diffs"][path] for path in target_files if path in report["diffs"]]
+    for failure in report["errors"]:
+        output.append(f"Error in shard ({len(failure['files'])} files, first: {failure['files'][0]}): {failure['error']}")
+    pruned = len(report.get("pruned", []))
+    failed = len(target_files) - len(report["diffs"]) - len(report["unchanged"]) - pruned
+    output.append(
+        f"Summary: {len(report['diffs'])} changed, {len(report['unchanged'])} unchanged, "
+        f"{failed} failed ({len(report['errors'])}/{report['shards']} shards failed), "
+        f"{pruned} pruned by prefilter."
+    )
+    return "\n".join(output)
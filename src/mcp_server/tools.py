@@ -1,13 +1,52 @@
 import subprocess
 import tempfile
 import os
-from typing import Tuple
+import mmap
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from src.mcp_server.cache import get_spatch_cache
+from src.mcp_server.tool_helpers import (
+    DEFAULT_SHARD_SIZE,
+    apply_output,
+    dry_run_output,
+    expire_indexes,
+    grep_output,
+    log_apply_progress,
+    merge_grep_results,
+    prefilter_targets,
+    read_text,
+    record_shard,
+    shard_diffs,
+    split_shards,
+    symbol_grep_output,
+    symbol_index_output,
+    symbol_patterns,
+    syntax_check_output,
+)
+from src.mcp_server.trigram_index import GREP_BATCH, TrigramIndex
+from src.mcp_server.symbol_index import SymbolIndex
+
+# Number of files whose line-offset index is kept in memory for read_window.
+LINE_INDEX_CACHE_SIZE = 256
+_line_index_cache: "OrderedDict[str, Tuple[tuple, np.ndarray]]" = OrderedDict()
+_line_index_lock = threading.Lock()
 
 def run_spatch_syntax_check(script_content: str) -> str:
     """
     Runs spatch --parse-cocci to check the syntax of the Coccinelle script.
     Returns "OK" if successful, otherwise returns the error message.
+    Results are served from the spatch result cache when the same script was checked before.
     """
+    cache = get_spatch_cache()
+    cache_key = cache.make_key("syntax_check", script_content) if cache else None
+    if cache_key:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     with tempfile.NamedTemporaryFile(mode='w', suffix='.cocci', delete=False) as tmp:
         tmp.write(script_content)
         tmp_path = tmp.name
@@ -20,13 +59,12 @@ def run_spatch_syntax_check(script_content: str) -> str:
             capture_output=True,
             text=True
         )
-        
-        if result.returncode == 0:
-            return "OK"
-        else:
-            # Combine stdout and stderr for full context, though errors are usually in stderr
-            return f"Syntax Error:\n{result.stderr}\n{result.stdout}"
-            
+        output = syntax_check_output(result)
+
+        if cache_key:
+            cache.put(cache_key, output)
+        return output
+
     except FileNotFoundError:
         return "Error: 'spatch' command not found. Please ensure Coccinelle is installed."
     except Exception as e:
@@ -39,7 +77,15 @@ def run_spatch_dry_run(script_content: str, mock_c_code: str) -> str:
     """
     Runs spatch --sp-file <script> <mock_c_file> to generate a patch.
     Returns the generated patch (diff) or an empty string if no match/error.
+    Results are served from the spatch result cache for identical script/mock pairs.
     """
+    cache = get_spatch_cache()
+    cache_key = cache.make_key("dry_run", script_content, mock_c_code) if cache else None
+    if cache_key:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     with tempfile.NamedTemporaryFile(mode='w', suffix='.cocci', delete=False) as tmp_cocci:
         tmp_cocci.write(script_content)
         cocci_path = tmp_cocci.name
@@ -55,14 +101,12 @@ def run_spatch_dry_run(script_content: str, mock_c_code: str) -> str:
             capture_output=True,
             text=True
         )
-        
-        if result.returncode == 0:
-            # spatch outputs the diff to stdout
-            return result.stdout
-        else:
-            # If spatch fails (e.g. syntax error in C file or runtime error), return error as output
-            return f"Runtime Error:\n{result.stderr}"
-            
+        output = dry_run_output(result)
+
+        if cache_key:
+            cache.put(cache_key, output)
+        return output
+
     except FileNotFoundError:
         return "Error: 'spatch' command not found."
     except Exception as e:
@@ -73,9 +117,28 @@ def run_spatch_dry_run(script_content: str, mock_c_code: str) -> str:
         if os.path.exists(c_path):
             os.remove(c_path)
 
+def _grep_files(pattern: str, files: List[str]) -> subprocess.CompletedProcess:
+    """
+    Greps an explicit list of files in parallel batches, producing the same
+    `path:line:text` output (and exit status) as a recursive grep.
+    """
+    batches = [files[i:i + GREP_BATCH] for i in range(0, len(files), GREP_BATCH)]
+
+    def _run(batch):
+        return subprocess.run(
+            ['grep', '-Hn', '-e', pattern, '--'] + batch,
+            capture_output=True,
+            text=True
+        )
+
+    with ThreadPoolExecutor(max_workers=min(len(batches), os.cpu_count() or 1)) as pool:
+        return merge_grep_results(list(pool.map(_run, batches)))
+
 def kernel_grep(pattern: str, path: str) -> str:
     """
     Searches for a pattern in the specified path using grep.
+    When a trigram index exists for the tree (see src/mcp_server/trigram_index.py),
+    only the candidate files it yields are grepped.
     Args:
         pattern: The regex pattern to search for.
         path: The directory or file path to search in.
@@ -83,22 +146,22 @@ def kernel_grep(pattern: str, path: str) -> str:
         The output of the grep command (matching lines).
     """
     try:
-        # grep -rn "pattern" path
-        result = subprocess.run(
-            ['grep', '-rn', pattern, path],
-            capture_output=True,
-            text=True
-        )
-        if result.returncode == 0:
-            # Limit output to first 50 lines to prevent context overflow
-            lines = result.stdout.splitlines()
-            if len(lines) > 50:
-                return "\n".join(lines[:50]) + f"\n... (and {len(lines) - 50} more matches)"
-            return result.stdout
-        elif result.returncode == 1:
+        index = TrigramIndex.find(path) if os.path.isdir(path) else None
+        candidates = index.candidates(pattern, path) if index else None
+
+        if candidates is None:
+            # grep -rn "pattern" path
+            result = subprocess.run(
+                ['grep', '-rn', pattern, path],
+                capture_output=True,
+                text=True
+            )
+        elif not candidates:
             return "No matches found."
         else:
-            return f"Error: {result.stderr}"
+            result = _grep_files(pattern, candidates)
+
+        return grep_output(result)
     except Exception as e:
         return f"System Error: {str(e)}"
 
@@ -128,6 +191,57 @@ def list_tree(path: str, max_depth: int = 2) -> str:
     except Exception as e:
         return f"Error listing directory: {str(e)}"
 
+def _line_offsets(file_path: str, st: os.stat_result, mm: mmap.mmap) -> np.ndarray:
+    """
+    Returns the byte offset of every line start plus a trailing end-of-file sentinel.
+    Offsets are cached per file and invalidated when its mtime, size or inode changes.
+    """
+    key = os.path.abspath(file_path)
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    with _line_index_lock:
+        cached = _line_index_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            _line_index_cache.move_to_end(key)
+            return cached[1]
+
+    starts = np.flatnonzero(np.frombuffer(mm, dtype=np.uint8) == ord('\n')) + 1
+    offsets = np.concatenate(([0], starts))
+    if offsets[-1] != st.st_size:
+        offsets = np.append(offsets, st.st_size)
+
+    with _line_index_lock:
+        _line_index_cache[key] = (stamp, offsets)
+        _line_index_cache.move_to_end(key)
+        while len(_line_index_cache) > LINE_INDEX_CACHE_SIZE:
+            _line_index_cache.popitem(last=False)
+    return offsets
+
+def _read_file_windows(file_path: str, windows: List[Tuple[int, int]]) -> List[str]:
+    """
+    Reads several (line_number, window_size) windows from one file through a single mmap.
+    Only the bytes of the requested lines are touched.
+    """
+    st = os.stat(file_path)
+    if st.st_size == 0:
+        return ["" for _ in windows]
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets = _line_offsets(file_path, st, mm)
+        num_lines = len(offsets) - 1
+        rendered = []
+        for line_number, window_size in windows:
+            start_line = max(0, line_number - 1 - window_size)
+            end_line = min(num_lines, line_number + window_size)
+            if start_line >= end_line:
+                rendered.append("")
+                continue
+            chunk = mm[offsets[start_line]:offsets[end_line]].decode('utf-8', errors='replace')
+            lines = chunk.split('\n')
+            output = []
+            for i in range(start_line, end_line):
+                output.append(f"{i+1}: {lines[i - start_line].rstrip()}")
+            rendered.append("\n".join(output))
+        return rendered
+
 def read_window(file_path: str, line_number: int, window_size: int = 20) -> str:
     """
     Reads a window of code around a specific line number.
@@ -139,78 +253,151 @@ def read_window(file_path: str, line_number: int, window_size: int = 20) -> str:
         The file content with line numbers.
     """
     try:
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-        
-        start_line = max(0, line_number - 1 - window_size)
-        end_line = min(len(lines), line_number + window_size)
-        
-        output = []
-        for i in range(start_line, end_line):
-            output.append(f"{i+1}: {lines[i].rstrip()}")
-            
-        return "\n".join(output)
+        return _read_file_windows(file_path, [(line_number, window_size)])[0]
     except Exception as e:
         return f"Error reading file: {str(e)}"
 
+def read_windows(windows: List[Dict[str, Any]]) -> str:
+    """
+    Reads several windows of code, from one or more files, in a single call.
+    Args:
+        windows: List of {"file_path": str, "line_number": int, "window_size": int (optional, default 20)}.
+    Returns:
+        One "==> file:line <==" section per requested window, in request order.
+    """
+    sections: List[str] = [""] * len(windows)
+    by_file: Dict[str, List[Tuple[int, int, int]]] = {}
+    for i, window in enumerate(windows):
+        try:
+            requested = (int(window["line_number"]), int(window.get("window_size", 20)))
+            by_file.setdefault(window.get("file_path", ""), []).append((i,) + requested)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            sections[i] = f"==> window {i} <==\nError: invalid window {window!r}: {e!r}"
+
+    for file_path, entries in by_file.items():
+        try:
+            rendered = _read_file_windows(file_path, [(line, size) for _, line, size in entries])
+        except Exception as e:
+            rendered = [f"Error reading file: {str(e)}"] * len(entries)
+        for (i, line, _), text in zip(entries, rendered):
+            sections[i] = f"==> {file_path}:{line} <==\n{text}"
+    return "\n\n".join(sections)
+
 def lookup_symbol_def(symbol: str, path: str) -> str:
     """
-    Attempts to find the definition of a symbol using grep (fallback for ctags/global).
-    Heuristic: Looks for "struct symbol {" or "type symbol(" or "symbol ="
+    Finds the definition of a symbol.
+    Uses the prebuilt symbol index (see src/mcp_server/symbol_index.py) when one covers
+    the path; otherwise falls back to grep heuristics:
+    "struct symbol", "#define symbol" or "symbol(".
     """
     try:
+        index = SymbolIndex.find(path) if os.path.isdir(path) else None
+        if index is not None:
+            return symbol_index_output(symbol, index.lookup(symbol, path))
+
         # Simple heuristic regex for C definitions
         # 1. struct definition: "struct symbol {"
         # 2. function definition: "type symbol(" - hard to catch all, but let's try "symbol(" at start of line or after type
         # Let's just grep for the symbol and let the agent filter.
         # Better: grep for "struct symbol" or "#define symbol"
         
-        patterns = [
-            f"struct {symbol}",
-            f"#define {symbol}",
-            f"{symbol}(",
-        ]
-        
-        results = []
-        for p in patterns:
-            res = kernel_grep(p, path)
-            if "No matches found" not in res:
-                results.append(f"--- Matches for '{p}' ---\n{res}")
-        
-        if not results:
-            return "No definition found (heuristics failed)."
-        return "\n\n".join(results)
+        patterns = symbol_patterns(symbol)
+        return symbol_grep_output(patterns, [kernel_grep(p, path) for p in patterns])
     except Exception as e:
         return f"System Error: {str(e)}"
 
+def _apply_shard(script_path: str, shard: List[str], timeout: Optional[float]) -> Dict[str, Any]:
+    """
+    Runs one blocking `spatch --in-place` over a shard of files.
+    The per-file diffs are computed from snapshots taken before and after the run,
+    so files that were already rewritten are reported even if spatch fails later on.
+    """
+    before = {path: read_text(path) for path in shard}
+    error = None
+    try:
+        result = subprocess.run(
+            ['spatch', '--sp-file', script_path, '--in-place'] + shard,
+            capture_output=True,
+            text=True,
+            timeout=timeout
+        )
+        if result.returncode != 0:
+            error = f"spatch exited with code {result.returncode}:\n{result.stderr}"
+    except FileNotFoundError:
+        error = "Error: 'spatch' command not found."
+    except subprocess.TimeoutExpired:
+        error = f"spatch timed out after {timeout}s"
+    except Exception as e:
+        error = f"System Error: {str(e)}"
+
+    return {"files": shard, "diffs": shard_diffs(before), "error": error}
 
-def run_spatch_apply(script_content: str, target_files: list[str]) -> str:
+def spatch_apply_sharded(
+    script_content: str,
+    target_files: List[str],
+    max_workers: Optional[int] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    timeout: Optional[float] = None,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    prefilter: bool = True
+) -> Dict[str, Any]:
     """
-    Applies a Coccinelle script to the specified target files in-place.
-    Returns a summary of the operation.
+    Applies a Coccinelle script in-place, splitting the targets into shards that are
+    processed by a bounded pool of concurrent spatch processes.
+    Unless disabled, files that lack the identifiers the script requires are pruned
+    before any spatch process is started (see src/mcp_server/prefilter.py).
+
+    Args:
+        script_content: The content of the .cocci script.
+        target_files: Files to rewrite (duplicates are applied once).
+        max_workers: Maximum number of concurrent spatch processes (defaults to the CPU count).
+        shard_size: Maximum number of files handed to one spatch process.
+        timeout: Optional per-shard timeout in seconds.
+        on_progress: Optional callback invoked once per file with an event dict
+            {"file", "status" ("changed"/"unchanged"/"error"), "diff", "error"}.
+        prefilter: Skip files that cannot match the script's required identifiers.
+    Returns:
+        A dict with "diffs" (file -> unified diff), "unchanged" (files left untouched by a
+        successful shard), "pruned" (files skipped by the prefilter), "errors" (one entry
+        per failed shard) and "shards".
     """
-    if not target_files:
-        return "No target files specified."
+    report = {"diffs": {}, "unchanged": [], "pruned": [], "errors": [], "shards": 0}
+    # A file listed twice must not end up in two concurrent --in-place shards.
+    targets = list(dict.fromkeys(target_files))
+    if prefilter:
+        targets = prefilter_targets(script_content, targets, report)
+    if not targets:
+        return report
 
     with tempfile.NamedTemporaryFile(mode='w', suffix='.cocci', delete=False) as tmp:
         tmp.write(script_content)
         script_path = tmp.name
-        
-    applied_diffs = []
-    
+
+    shards = split_shards(targets, shard_size)
+    report["shards"] = len(shards)
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(shards)))
+
     try:
-        # cmd: spatch --sp-file script --in-place file1 file2 ...
-        cmd = ['spatch', '--sp-file', script_path, '--in-place'] + target_files
-        
-        subprocess.run(cmd, check=True)
-        
-        applied_diffs.append("Applied to " + str(target_files))
-        return "\n".join(applied_diffs)
-        
-    except subprocess.CalledProcessError as e:
-        return f"Error running spatch: {e}"
-    except Exception as e:
-        return f"System Error: {str(e)}"
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_apply_shard, script_path, shard, timeout) for shard in shards]
+            for future in as_completed(futures):
+                record_shard(report, future.result(), on_progress)
     finally:
         if os.path.exists(script_path):
             os.remove(script_path)
+        expire_indexes(report)
+    return report
+
+def run_spatch_apply(script_content: str, target_files: list[str], max_workers: Optional[int] = None) -> str:
+    """
+    Applies a Coccinelle script to the specified target files in-place.
+    Targets are sharded across concurrent spatch processes; a failing shard does not
+    discard the results of the others.
+    Returns the per-file unified diffs followed by an aggregate summary.
+    """
+    if not target_files:
+        return "No target files specified."
+
+    report = spatch_apply_sharded(script_content, target_files, max_workers=max_workers, on_progress=log_apply_progress)
+    return apply_output(report, target_files)
+
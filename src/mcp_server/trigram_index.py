@@ -0,0 +1,477 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from src.mcp_server.cache import get_cache_dir
+
+# On-disk trigram index over a source tree, used to narrow the set of files that
+# kernel_grep hands to grep. Layout of an index directory:
+#   meta.json     - root, indexed git commit, build time
+#   files.json    - [relpath, mtime_ns, size] per file id
+#   lexicon.bin   - sorted (trigram, offset, count) entries, little-endian uint32
+#   postings.bin  - concatenated file-id lists (uint32), referenced by the lexicon
+#   dirty.json    - files changed since the build; always treated as candidates
+# Binary files (a NUL byte in the first 8 KiB) and oversized files are not indexed but
+# are always candidates, so grep still reports them as it would without the index.
+
+INDEX_VERSION = 1
+CHUNK_FILES = 2000            # Files scanned per worker task / segment
+MAX_FILE_SIZE = 8 << 20       # Larger files are not indexed and always searched
+REFRESH_INTERVAL = 30.0       # Seconds between automatic staleness checks of git trees at query time
+MAX_DIRTY_FRACTION = 0.1      # update() rebuilds once this fraction of files changed
+GREP_BATCH = 1000             # Files per confirming grep process
+MERGE_PARTITIONS = 64         # Trigram key ranges merged independently
+
+_LEX_ENTRY = struct.Struct('<III')
+_SEG_HEADER = struct.Struct('<Q')
+
+def _index_dir(root: str) -> str:
+    digest = hashlib.sha1(os.path.realpath(root).encode()).hexdigest()[:16]
+    return os.path.join(get_cache_dir("trigram"), digest)
+
+def git_output(root: str, *args: str) -> Optional[str]:
+    """Runs git in root and returns its stdout, or None if git is missing or the command fails."""
+    try:
+        result = subprocess.run(['git', '-C', root] + list(args), capture_output=True, text=True)
+    except (FileNotFoundError, OSError):
+        return None
+    return result.stdout if result.returncode == 0 else None
+
+def list_indexable_files(root: str) -> Tuple[List[str], Optional[str]]:
+    """
+    Lists files to index and the commit they belong to. For git trees these are the
+    tracked plus untracked-but-not-ignored files, so build artefacts are skipped.
+    """
+    commit = git_output(root, 'rev-parse', 'HEAD')
+    listing = git_output(root, 'ls-files', '-z', '--cached', '--others', '--exclude-standard') if commit else None
+    if listing is not None:
+        files = [p for p in listing.split('\0') if p and os.path.isfile(os.path.join(root, p))]
+        return sorted(files), commit.strip()
+
+    files = []
+    for dirpath, dirs, names in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for name in names:
+            full = os.path.join(dirpath, name)
+            if os.path.isfile(full):
+                files.append(os.path.relpath(full, root))
+    return sorted(files), None
+
+def changed_files(root: str, commit: Optional[str], known: List[list]) -> Set[str]:
+    """
+    Files added, modified or deleted under root since an index was built: from git when
+    the index recorded a commit, otherwise by comparing the [relpath, mtime_ns, size]
+    entries in known with the tree.
+    """
+    if commit:
+        # --relative: paths relative to root (not the repository top), like ls-files.
+        changed = git_output(root, 'diff', '--name-only', '--relative', '-z', commit, '--')
+        untracked = git_output(root, 'ls-files', '-z', '-o', '--exclude-standard')
+        if changed is not None and untracked is not None:
+            return {p for p in (changed + untracked).split('\0') if p}
+
+    stats = {rel: (mtime, size) for rel, mtime, size in known}
+    current, _ = list_indexable_files(root)
+    dirty = set(stats) - set(current)
+    for rel in current:
+        try:
+            st = os.stat(os.path.join(root, rel))
+        except OSError:
+            continue
+        if stats.get(rel) != (st.st_mtime_ns, st.st_size):
+            dirty.add(rel)
+    return dirty
+
+def _scan_chunk(root: str, first_id: int, relpaths: List[str], segment_path: str) -> Dict[str, list]:
+    """
+    Worker: extracts the trigram set of each file and writes a sorted segment
+    (header, lexicon, postings). Returns per-file stat info plus the ids of files
+    that could not be indexed.
+    """
+    key_parts, id_parts = [], []
+    stats = []
+    unindexed = []
+    for offset, rel in enumerate(relpaths):
+        file_id = first_id + offset
+        full = os.path.join(root, rel)
+        try:
+            st = os.stat(full)
+            stats.append([rel, st.st_mtime_ns, st.st_size])
+            with open(full, 'rb') as f:
+                head = f.read(8192)
+                if b'\0' in head or st.st_size > MAX_FILE_SIZE:
+                    unindexed.append(file_id)
+                    continue
+                data = head + f.read()
+        except OSError:
+            stats.append([rel, 0, 0])
+            unindexed.append(file_id)
+            continue
+        if len(data) < 3:
+            continue
+        buf = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+        grams = np.unique((buf[:-2] << 16) | (buf[1:-1] << 8) | buf[2:])
+        key_parts.append(grams)
+        id_parts.append(np.full(len(grams), file_id, dtype=np.uint32))
+
+    keys = np.concatenate(key_parts) if key_parts else np.empty(0, dtype=np.uint32)
+    ids = np.concatenate(id_parts) if id_parts else np.empty(0, dtype=np.uint32)
+    lexicon, postings = _group_postings(keys, ids)
+    with open(segment_path, 'wb') as f:
+        f.write(_SEG_HEADER.pack(len(lexicon)))
+        f.write(lexicon.tobytes())
+        f.write(postings.tobytes())
+    return {"stats": stats, "unindexed": unindexed}
+
+def _group_postings(keys: np.ndarray, ids: np.ndarray, base: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Groups (trigram, file id) pairs by trigram into a (trigram, offset, count) lexicon
+    and the matching postings. A stable sort keeps each trigram's ids in ascending order.
+    """
+    order = np.argsort(keys, kind='stable')
+    keys, ids = keys[order], ids[order]
+    uniq, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    lexicon = np.empty((len(uniq), 3), dtype='<u4')
+    lexicon[:, 0] = uniq
+    lexicon[:, 1] = starts + base
+    lexicon[:, 2] = counts
+    return lexicon, ids.astype('<u4')
+
+def _load_segment(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    with open(path, 'rb') as f:
+        num_keys = _SEG_HEADER.unpack(f.read(_SEG_HEADER.size))[0]
+    lexicon = np.memmap(path, dtype='<u4', mode='r', offset=_SEG_HEADER.size, shape=(num_keys, 3))
+    postings_offset = _SEG_HEADER.size + num_keys * _LEX_ENTRY.size
+    if os.path.getsize(path) == postings_offset:
+        return lexicon, np.empty(0, dtype='<u4')
+    postings = np.memmap(path, dtype='<u4', mode='r', offset=postings_offset)
+    return lexicon, postings
+
+def _merge_segments(segment_paths: List[str], out_dir: str) -> int:
+    """
+    Merges worker segments into the final lexicon/postings files.
+    The trigram space is processed in MERGE_PARTITIONS key ranges; within a range each
+    segment contributes one contiguous slice, so memory stays bounded by the range size.
+    """
+    segments = [_load_segment(p) for p in segment_paths]
+    lex_path = os.path.join(out_dir, "lexicon.bin")
+    post_path = os.path.join(out_dir, "postings.bin")
+    open(lex_path, 'wb').close()
+    open(post_path, 'wb').close()
+    bounds = np.linspace(0, 1 << 24, MERGE_PARTITIONS + 1).astype(np.int64)
+    num_keys, total = 0, 0
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        key_parts, id_parts = [], []
+        for lexicon, postings in segments:
+            seg_keys = lexicon[:, 0]
+            a, b = np.searchsorted(seg_keys, [lo, hi])
+            if a == b:
+                continue
+            counts = lexicon[a:b, 2].astype(np.int64)
+            start = int(lexicon[a, 1])
+            stop = int(lexicon[b - 1, 1]) + int(counts[-1])
+            # Segments hold ascending, disjoint id ranges, so concatenating in segment order keeps lists sorted.
+            key_parts.append(np.repeat(seg_keys[a:b], counts))
+            id_parts.append(np.asarray(postings[start:stop]))
+        if not key_parts:
+            continue
+        lexicon, ids = _group_postings(np.concatenate(key_parts), np.concatenate(id_parts), base=total)
+        with open(lex_path, 'ab') as f:
+            f.write(lexicon.tobytes())
+        with open(post_path, 'ab') as f:
+            f.write(ids.tobytes())
+        num_keys += len(lexicon)
+        total += len(ids)
+    del segments
+    return num_keys
+
+def pattern_trigrams(pattern: str) -> Optional[Set[int]]:
+    """
+    Extracts the trigrams any line matching a grep basic regex must contain.
+    Returns None when the pattern cannot be narrowed (alternation, groups,
+    or no literal run of at least three bytes).
+    """
+    runs = []
+    current = []
+
+    def flush():
+        if len(current) >= 3:
+            runs.append("".join(current))
+        current.clear()
+
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            nxt = pattern[i + 1]
+            if nxt in '|(':
+                return None
+            if nxt in '?{':
+                # The preceding atom becomes optional
+                if current:
+                    current.pop()
+                flush()
+                if nxt == '{':
+                    end = pattern.find('\\}', i + 2)
+                    i = len(pattern) if end < 0 else end
+            elif nxt in '.*[]^$\\/':
+                current.append(nxt)
+            else:
+                flush()  # \w, \s, \<, \b, \+ ... end the literal run
+            i += 2
+            continue
+        if c == '[':
+            flush()
+            j = i + 1
+            if j < len(pattern) and pattern[j] == '^':
+                j += 1
+            if j < len(pattern) and pattern[j] == ']':
+                j += 1
+            end = pattern.find(']', j)
+            i = len(pattern) if end < 0 else end + 1
+            continue
+        if c == '*':
+            if current:
+                current.pop()
+            flush()
+        elif c in '.^$':
+            flush()
+        else:
+            current.append(c)
+        i += 1
+    flush()
+
+    grams = set()
+    for run in runs:
+        data = run.encode('utf-8')
+        grams.update(int.from_bytes(data[k:k + 3], 'big') for k in range(len(data) - 2))
+    return grams or None
+
+class TrigramIndex:
+    """Read side of an on-disk trigram index; lexicon and postings are memory-mapped."""
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "files.json")) as f:
+            self.files = json.load(f)
+        self.root = self.meta["root"]
+        self.unindexed = set(self.meta.get("unindexed", []))
+        self.dirty: Set[str] = set()
+        dirty_path = os.path.join(index_dir, "dirty.json")
+        if os.path.exists(dirty_path):
+            with open(dirty_path) as f:
+                self.dirty = set(json.load(f))
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._lex = self._map("lexicon.bin")
+        self._postings = self._map("postings.bin")
+        self._num_keys = len(self._lex) // _LEX_ENTRY.size if self._lex else 0
+
+    def _map(self, name: str) -> Optional[mmap.mmap]:
+        path = os.path.join(self.index_dir, name)
+        if os.path.getsize(path) == 0:
+            return None
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def build(cls, root: str, jobs: Optional[int] = None) -> "TrigramIndex":
+        """Builds (or rebuilds) the index for a tree, scanning files in parallel worker processes."""
+        root = os.path.realpath(root)
+        start = time.time()
+        files, commit = list_indexable_files(root)
+        final_dir = _index_dir(root)
+        work_dir = final_dir + ".building"
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+
+        chunks = [(i, files[i:i + CHUNK_FILES]) for i in range(0, len(files), CHUNK_FILES)]
+        segment_paths = [os.path.join(work_dir, f"segment-{n:05d}.bin") for n in range(len(chunks))]
+        stats, unindexed = [], []
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            results = pool.map(
+                _scan_chunk,
+                [root] * len(chunks),
+                [first_id for first_id, _ in chunks],
+                [relpaths for _, relpaths in chunks],
+                segment_paths
+            )
+            for result in results:
+                stats.extend(result["stats"])
+                unindexed.extend(result["unindexed"])
+
+        num_keys = _merge_segments(segment_paths, work_dir)
+        for path in segment_paths:
+            os.remove(path)
+
+        with open(os.path.join(work_dir, "files.json"), 'w') as f:
+            json.dump(stats, f)
+        with open(os.path.join(work_dir, "meta.json"), 'w') as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "root": root,
+                "commit": commit,
+                "built": time.time(),
+                "num_files": len(files),
+                "num_trigrams": num_keys,
+                "unindexed": unindexed,
+            }, f)
+
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.rename(work_dir, final_dir)
+        print(f"Indexed {len(files)} files ({num_keys} trigrams) under {root} in {time.time() - start:.1f}s")
+        return cls(final_dir)
+
+    @classmethod
+    def find(cls, path: str) -> Optional["TrigramIndex"]:
+        """Returns the index covering path (the path itself or one of its ancestors), if any."""
+        current = os.path.realpath(path)
+        while True:
+            index_dir = _index_dir(current)
+            meta_path = os.path.join(index_dir, "meta.json")
+            if os.path.exists(meta_path):
+                mtime = os.path.getmtime(meta_path)
+                with _open_indexes_lock:
+                    cached = _open_indexes.get(index_dir)
+                    if cached is None or cached[0] != mtime:
+                        cached = (mtime, cls(index_dir))
+                        _open_indexes[index_dir] = cached
+                return cached[1]
+            parent = os.path.dirname(current)
+            if parent == current:
+                return None
+            current = parent
+
+    def _changed_files(self) -> Set[str]:
+        return changed_files(self.root, self.meta.get("commit"), self.files)
+
+    def update(self, jobs: Optional[int] = None) -> "TrigramIndex":
+        """
+        Incrementally refreshes the set of changed files and persists it.
+        Rebuilds from scratch once too large a fraction of the tree has changed.
+        """
+        dirty = self._changed_files()
+        if len(dirty) > max(1000, MAX_DIRTY_FRACTION * len(self.files)):
+            return TrigramIndex.build(self.root, jobs=jobs)
+        with open(os.path.join(self.index_dir, "dirty.json"), 'w') as f:
+            json.dump(sorted(dirty), f)
+        with self._lock:
+            self.dirty = dirty
+            self._last_refresh = time.time()
+        print(f"{len(dirty)} files changed since the index was built.")
+        return self
+
+    def mark_changed(self, paths: Iterable[str]) -> None:
+        """Adds the given files (rewritten by this process) to the changed set."""
+        rels = set()
+        for path in paths:
+            rel = os.path.relpath(os.path.realpath(path), self.root)
+            if not rel.startswith(os.pardir + os.sep) and rel != os.pardir:
+                rels.add(rel)
+        with self._lock:
+            self.dirty |= rels
+            self._last_refresh = 0.0
+
+    def _maybe_refresh(self) -> None:
+        # Git trees are checked against the indexed commit (cheap). Other trees would need a
+        # walk of the whole tree, so they are refreshed by update() and mark_changed() only.
+        if not self.meta.get("commit"):
+            return
+        with self._lock:
+            if time.time() - self._last_refresh < REFRESH_INTERVAL:
+                return
+            self._last_refresh = time.time()
+        dirty = self._changed_files()
+        with self._lock:
+            self.dirty = dirty
+
+    def _postings_for(self, gram: int) -> np.ndarray:
+        lo, hi = 0, self._num_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = struct.unpack_from('<I', self._lex, mid * _LEX_ENTRY.size)[0]
+            if key < gram:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._num_keys:
+            key, offset, count = _LEX_ENTRY.unpack_from(self._lex, lo * _LEX_ENTRY.size)
+            if key == gram:
+                return np.frombuffer(self._postings, dtype='<u4', count=count, offset=offset * 4)
+        return np.empty(0, dtype='<u4')
+
+    def candidates(self, pattern: str, path: str) -> Optional[List[str]]:
+        """
+        Returns the files under path that may contain a match for the grep pattern,
+        spelled relative to path the way `grep -r pattern path` would print them.
+        Returns None when the pattern cannot be narrowed by the index.
+        """
+        grams = pattern_trigrams(pattern)
+        if grams is None or self._lex is None:
+            return None
+        self._maybe_refresh()
+
+        lists = sorted((self._postings_for(g) for g in grams), key=len)
+        ids = lists[0]
+        for other in lists[1:]:
+            if not len(ids):
+                break
+            ids = np.intersect1d(ids, other, assume_unique=True)
+
+        rels = {self.files[i][0] for i in ids.tolist()}
+        rels.update(self.files[i][0] for i in self.unindexed)
+        with self._lock:
+            rels.update(self.dirty)
+
+        prefix = os.path.relpath(os.path.realpath(path), self.root)
+        result = []
+        for rel in sorted(rels):
+            if prefix != '.':
+                if not rel.startswith(prefix + os.sep):
+                    continue
+                rel = rel[len(prefix) + 1:]
+            display = os.path.join(path, rel)
+            if os.path.isfile(display):
+                result.append(display)
+        return result
+
+_open_indexes: Dict[str, Tuple[float, TrigramIndex]] = {}
+_open_indexes_lock = threading.Lock()
+
+def expire_refresh(paths: Iterable[str] = ()) -> None:
+    """
+    After files were rewritten: marks them changed in every open index and makes the next
+    query of a git tree re-check it.
+    """
+    paths = list(paths)
+    with _open_indexes_lock:
+        indexes = [index for _, index in _open_indexes.values()]
+    for index in indexes:
+        index.mark_changed(paths)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or update the trigram index used by kernel_grep.")
+    parser.add_argument("command", choices=["build", "update"])
+    parser.add_argument("path", help="Root of the kernel tree")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        TrigramIndex.build(args.path, jobs=args.jobs)
+    else:
+        index = TrigramIndex.find(args.path)
+        if index is None:
+            TrigramIndex.build(args.path, jobs=args.jobs)
+        else:
+            index.update(jobs=args.jobs)
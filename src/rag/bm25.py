@@ -0,0 +1,148 @@
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+# In-process BM25 keyword index over the chunks of a Chroma collection.
+# Tokenization is C-aware: identifiers are kept whole and split on snake_case, and
+# field accesses (`urb->dev`, `cfg.flags`) are kept as compound tokens as well as
+# `->dev` / `.flags` member tokens. The index is rebuilt after every ingestion, saved
+# as CSR postings in one .npz file next to the database, and loaded on first use.
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+_TOKEN_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*(?:\s*(?:->|\.)\s*[A-Za-z_][A-Za-z0-9_]*)*|\d+')
+_ACCESS_RE = re.compile(r'\s*(->|\.)\s*')
+
+def tokenize_c(text: str) -> List[str]:
+    """Lowercased C-aware tokens of text (identifiers, their parts and field accesses)."""
+    tokens = []
+    for match in _TOKEN_RE.findall(text.lower()):
+        if "->" in match or "." in match:
+            pieces = _ACCESS_RE.split(match)
+            tokens.append("".join(pieces))
+            idents = pieces[0::2]
+            tokens.extend(op + member for op, member in zip(pieces[1::2], idents[1:]))
+        else:
+            idents = [match]
+        for ident in idents:
+            tokens.append(ident)
+            if "_" in ident.strip("_"):
+                tokens.extend(part for part in ident.split("_") if part)
+    return tokens
+
+def index_path(persist_directory: str, collection: str) -> str:
+    return os.path.join(persist_directory, f"bm25.{collection}.npz")
+
+class BM25Index:
+    """Immutable BM25 index: CSR postings (term -> documents, term frequencies)."""
+
+    def __init__(self, terms: Sequence[str], term_ptr: np.ndarray, post_docs: np.ndarray, post_tf: np.ndarray,
+                 doc_ids: Sequence[str], doc_types: Sequence[str], doc_len: np.ndarray):
+        self.vocab = {t: i for i, t in enumerate(terms)}
+        self.terms = np.asarray(terms)
+        self.term_ptr = term_ptr
+        self.post_docs = post_docs
+        self.post_tf = post_tf
+        self.doc_ids = np.asarray(doc_ids)
+        self.doc_types = np.asarray(doc_types)
+        self.doc_len = doc_len
+        n = len(doc_ids)
+        df = np.diff(term_ptr)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doc_len.mean()) if n else 0.0
+        self.norm = (BM25_K1 * (1 - BM25_B + BM25_B * doc_len / (avgdl or 1.0))).astype(np.float32)
+        self._type_masks: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[str, str, str]]) -> "BM25Index":
+        """Builds the index from (id, text, type) triples."""
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_ids, doc_types, doc_len = [], [], []
+        for n, (doc_id, text, doc_type) in enumerate(docs):
+            counts = Counter(tokenize_c(text))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((n, tf))
+            doc_ids.append(doc_id)
+            doc_types.append(doc_type or "")
+            doc_len.append(sum(counts.values()))
+        terms = sorted(postings)
+        term_ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_ptr[1:] = np.cumsum([len(postings[t]) for t in terms])
+        flat = [p for t in terms for p in postings[t]]
+        post_docs = np.fromiter((d for d, _ in flat), dtype=np.int32, count=len(flat))
+        post_tf = np.fromiter((tf for _, tf in flat), dtype=np.float32, count=len(flat))
+        return cls(terms, term_ptr, post_docs, post_tf, doc_ids, doc_types, np.asarray(doc_len, dtype=np.float32))
+
+    @classmethod
+    def from_store(cls, vector_store: Any, page_size: int = 5000) -> "BM25Index":
+        """Builds the index over every chunk of a Chroma store."""
+        docs = []
+        offset = 0
+        while True:
+            page = vector_store.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            for doc_id, text, meta in zip(page["ids"], page["documents"], page["metadatas"]):
+                docs.append((doc_id, text or "", (meta or {}).get("type", "")))
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+        return cls.build(docs)
+
+    def save(self, path: str) -> None:
+        tmp = f"{path}.tmp.npz"
+        np.savez(
+            tmp, terms=self.terms.astype(str), term_ptr=self.term_ptr, post_docs=self.post_docs,
+            post_tf=self.post_tf, doc_ids=self.doc_ids.astype(str), doc_types=self.doc_types.astype(str),
+            doc_len=self.doc_len
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["terms"].tolist(), data["term_ptr"], data["post_docs"], data["post_tf"],
+                       data["doc_ids"].tolist(), data["doc_types"].tolist(), data["doc_len"])
+
+    def search(self, query: str, k: int = 10, doc_type: Optional[str] = None) -> List[Tuple[str, float]]:
+        """Returns up to k (chunk id, score) pairs, best first, optionally restricted to one type."""
+        if not len(self):
+            return []
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize_c(query)):
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            start, end = self.term_ptr[t], self.term_ptr[t + 1]
+            docs, tf = self.post_docs[start:end], self.post_tf[start:end]
+            scores[docs] += self.idf[t] * tf * (BM25_K1 + 1) / (tf + self.norm[docs])
+        if doc_type is not None:
+            mask = self._type_masks.get(doc_type)
+            if mask is None:
+                mask = self._type_masks[doc_type] = self.doc_types != doc_type
+            scores[mask] = 0.0
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(str(self.doc_ids[i]), float(scores[i])) for i in hits]
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> List[str]:
+    """Fuses ranked id lists: score(id) = sum over lists of 1 / (k + rank)."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda d: -scores[d])
+
+def rebuild_index(vector_store: Any, persist_directory: str, collection: str) -> BM25Index:
+    """Rebuilds and saves the BM25 index of a collection (called after ingestion)."""
+    index = BM25Index.from_store(vector_store)
+    index.save(index_path(persist_directory, collection))
+    print(f"BM25 index rebuilt: {len(index)} chunks, {len(index.vocab)} terms.")
+    return index
@@ -0,0 +1,246 @@
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+from langchain_core.documents import Document
+from src.rag.rate_limit import estimate_tokens
+
+# Structure-aware chunking of the knowledge sources.
+# Each source is split along its own structure instead of fixed character windows:
+# .cocci files per @rule@ block (with the file's /// description attached), standard.iso
+# per isomorphism, the syntax manual per section and commits into the script plus the
+# per-file diff hunks. Small neighbouring units are packed together and oversized ones
+# are split on paragraph/line boundaries, so every chunk fits CHUNK_TOKEN_BUDGET.
+
+# Bumped whenever a strategy changes, so ingestion re-chunks files that did not change.
+CHUNKER_VERSION = "2"
+# Estimated tokens per chunk (bge-large-en-v1.5 truncates at 512).
+CHUNK_TOKEN_BUDGET = int(os.environ.get("LK_SPG_CHUNK_TOKENS", "384"))
+# Diff chunks kept per commit; tree-wide commits are represented by their first files.
+COMMIT_MAX_DIFF_CHUNKS = int(os.environ.get("LK_SPG_COMMIT_DIFF_CHUNKS", "8"))
+
+_RULE_HEADER_RE = re.compile(r'^@[^@\n]*@\s*$')
+_ISO_KIND_RE = re.compile(r'^(Expression|ArgExpression|TestExpression|ToTestExpression|Statement|Type|Declaration|TopLevel)\s*$')
+_TEX_SECTION_RE = re.compile(r'^\\(part|chapter|section|subsection|subsubsection)\*?\{(.*)\}\s*$')
+_DIFF_FILE_RE = re.compile(r'^diff --git a/(\S+) b/(\S+)', re.MULTILINE)
+
+def _is_comment_or_blank(line: str) -> bool:
+    s = line.strip()
+    return not s or s.startswith("//")
+
+def _hard_split(text: str, budget: int) -> List[str]:
+    """Splits text on line boundaries (characters only for single overlong lines)."""
+    max_chars = max(1, budget * 4)
+    pieces, current = [], []
+    size = 0
+    for line in text.splitlines():
+        while len(line) > max_chars:
+            if current:
+                pieces.append("\n".join(current))
+                current, size = [], 0
+            pieces.append(line[:max_chars])
+            line = line[max_chars:]
+        if current and size + len(line) + 1 > max_chars:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+def _pack(units: List[str], budget: int, sep: str = "\n\n") -> List[List[Tuple[int, str]]]:
+    """
+    Groups consecutive units into chunks that fit the token budget.
+    Returns (unit index, text) per chunk member; an oversized unit is split into several chunks.
+    """
+    groups: List[List[Tuple[int, str]]] = []
+    current: List[Tuple[int, str]] = []
+    used = 0
+    for i, unit in enumerate(units):
+        cost = estimate_tokens(unit + sep)
+        if cost > budget:
+            if current:
+                groups.append(current)
+                current, used = [], 0
+            groups.extend([(i, piece)] for piece in _hard_split(unit, budget))
+            continue
+        if current and used + cost > budget:
+            groups.append(current)
+            current, used = [], 0
+        current.append((i, unit))
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
+
+def _emit(header: str, units: List[str], metadata: Dict[str, Any], budget: int, sep: str = "\n\n",
+          unit_meta: Optional[List[Dict[str, Any]]] = None) -> List[Document]:
+    """Packs units under a repeated header into Documents; unit_meta values are joined per chunk."""
+    header = header.strip()
+    room = max(16, budget - (estimate_tokens(header) if header else 0))
+    docs = []
+    for index, group in enumerate(_pack(units, room, sep)):
+        meta = dict(metadata)
+        meta["chunk"] = index
+        if unit_meta:
+            members = [unit_meta[i] for i in dict.fromkeys(i for i, _ in group)]
+            for key in members[0]:
+                values = [str(m[key]) for m in members if m.get(key)]
+                meta[key] = ", ".join(dict.fromkeys(values))
+        body = sep.join(text for _, text in group)
+        docs.append(Document(page_content=f"{header}\n{body}" if header else body, metadata=meta))
+    return docs
+
+def chunk_text(text: str, metadata: Dict[str, Any], budget: int = CHUNK_TOKEN_BUDGET, header: str = "") -> List[Document]:
+    """Fallback strategy: paragraphs packed up to the budget."""
+    paragraphs = [p.strip("\n") for p in re.split(r'\n\s*\n', text) if p.strip()]
+    return _emit(header, paragraphs, metadata, budget)
+
+def split_cocci_rules(text: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    Splits a semantic patch into its preamble and rules.
+
+    Returns:
+        (description, rules): the /// description lines and (label, block) per rule. Comments
+        directly above a rule header belong to that rule.
+    """
+    lines = text.splitlines()
+    description = [l.strip()[3:].strip() for l in lines if l.strip().startswith("///")]
+    blocks: List[List[str]] = [[]]
+    in_decls = False
+    for line in lines:
+        if _RULE_HEADER_RE.match(line):
+            if not in_decls:
+                tail: List[str] = []
+                while blocks[-1] and _is_comment_or_blank(blocks[-1][-1]):
+                    tail.insert(0, blocks[-1].pop())
+                blocks.append([l for l in tail if l.strip() and not l.strip().startswith("///")])
+            in_decls = not in_decls
+        blocks[-1].append(line)
+
+    rules = []
+    for block in blocks[1:]:
+        header = next(l for l in block if _RULE_HEADER_RE.match(l)).strip()[1:-1].strip()
+        label = re.split(r'(?:^|\s+)depends\s+on\s+', header)[0].strip() or "(anonymous)"
+        rules.append((label, "\n".join(block).strip("\n")))
+    return description, rules
+
+def chunk_cocci(text: str, metadata: Dict[str, Any], budget: int = CHUNK_TOKEN_BUDGET) -> List[Document]:
+    """One chunk per @rule@ block (small neighbouring rules packed), prefixed with the /// description."""
+    description, rules = split_cocci_rules(text)
+    if not rules:
+        return chunk_text(text, metadata, budget)
+    header = "\n".join(f"/// {d}" for d in description if d)
+    meta = dict(metadata)
+    meta.setdefault("description", " ".join(description))
+    return _emit(header, [block for _, block in rules], meta, budget, unit_meta=[{"rules": label} for label, _ in rules])
+
+def split_iso_blocks(text: str) -> List[Tuple[str, str]]:
+    """Returns (name, block) for each isomorphism of an .iso file, with its leading comments."""
+    lines = text.splitlines()
+    starts = [i for i, line in enumerate(lines)
+              if _ISO_KIND_RE.match(line) and i + 1 < len(lines) and _RULE_HEADER_RE.match(lines[i + 1])]
+    blocks = []
+    for n, start in enumerate(starts):
+        end = starts[n + 1] if n + 1 < len(starts) else len(lines)
+        # Comments just above the kind line (no blank line in between) describe this iso.
+        first = start
+        while first > 0 and lines[first - 1].strip().startswith("//"):
+            first -= 1
+        body = lines[first:end]
+        # Drop the next block's comments and trailing blanks.
+        while body and _is_comment_or_blank(body[-1]):
+            body.pop()
+        name = lines[start + 1].strip()[1:-1].strip()
+        blocks.append((name, "\n".join(body)))
+    return blocks
+
+def chunk_iso(text: str, metadata: Dict[str, Any], budget: int = CHUNK_TOKEN_BUDGET) -> List[Document]:
+    """One chunk per isomorphism (tiny ones packed together)."""
+    blocks = split_iso_blocks(text)
+    if not blocks:
+        return chunk_text(text, metadata, budget)
+    return _emit("", [block for _, block in blocks], metadata, budget, unit_meta=[{"name": name} for name, _ in blocks])
+
+def split_tex_sections(text: str) -> List[Tuple[str, str]]:
+    """Returns (title, body) per \\section-level heading of a LaTeX document."""
+    sections: List[Tuple[str, List[str]]] = [("", [])]
+    for line in text.splitlines():
+        m = _TEX_SECTION_RE.match(line)
+        if m:
+            sections.append((m.group(2).strip(), []))
+        else:
+            sections[-1][1].append(line)
+    return [(title, "\n".join(body).strip()) for title, body in sections if "\n".join(body).strip()]
+
+def chunk_sections(sections: List[Tuple[str, str]], metadata: Dict[str, Any], budget: int = CHUNK_TOKEN_BUDGET,
+                   heading: str = "Syntax Guide - {title}:") -> List[Document]:
+    """One or more chunks per section; every chunk of a section repeats its heading."""
+    docs = []
+    for title, body in sections:
+        meta = dict(metadata)
+        meta["title"] = title
+        docs.extend(chunk_text(body, meta, budget, header=heading.format(title=title or "Introduction")))
+    return docs
+
+def chunk_tex(text: str, metadata: Dict[str, Any], budget: int = CHUNK_TOKEN_BUDGET) -> List[Document]:
+    return chunk_sections(split_tex_sections(text), metadata, budget)
+
+def split_diff_files(diff: str) -> List[Tuple[str, str]]:
+    """Splits a `git show`/`git diff` patch into (path, per-file diff)."""
+    matches = list(_DIFF_FILE_RE.finditer(diff))
+    if not matches:
+        return [("", diff.strip())] if diff.strip() else []
+    files = []
+    for n, m in enumerate(matches):
+        end = matches[n + 1].start() if n + 1 < len(matches) else len(diff)
+        files.append((m.group(2), diff[m.start():end].strip("\n")))
+    return files
+
+def chunk_commit(summary: str, sha: str, script: str, diff: str, metadata: Dict[str, Any],
+                 budget: int = CHUNK_TOKEN_BUDGET, max_diff_chunks: int = COMMIT_MAX_DIFF_CHUNKS) -> List[Document]:
+    """
+    Splits a Coccinelle-generated commit into a script chunk and per-file diff chunks.
+    Hunks of one file stay together while they fit; each chunk names the commit and intent.
+    """
+    header = f"Intent: {summary}\nReference Commit: {sha}\n"
+    docs = []
+    for doc in chunk_text(f"```cocci\n{script}\n```", metadata, budget, header=f"{header}\nCoccinelle Script:"):
+        doc.metadata["part"] = "script"
+        docs.append(doc)
+
+    units, unit_meta = [], []
+    for path, file_diff in split_diff_files(diff):
+        hunks = re.split(r'\n(?=@@ )', file_diff)
+        file_header, hunks = (hunks[0], hunks[1:]) if len(hunks) > 1 else ("", hunks)
+        prefix = f"{file_header}\n" if file_header else ""
+        for group in _pack(hunks, max(16, budget - estimate_tokens(header + prefix) - 8), "\n"):
+            units.append("```diff\n" + prefix + "\n".join(text for _, text in group) + "\n```")
+            unit_meta.append({"files": path})
+    diff_docs = _emit(f"{header}\nCommit Diff:", units, metadata, budget, sep="\n", unit_meta=unit_meta)
+    for doc in diff_docs[:max_diff_chunks]:
+        doc.metadata["part"] = "diff"
+        doc.metadata["chunk"] += len(docs)
+        docs.append(doc)
+    return docs
+
+_STRATEGIES = {".cocci": chunk_cocci, ".iso": chunk_iso, ".tex": chunk_tex}
+
+def chunk_file_documents(documents: List[Document], budget: int = CHUNK_TOKEN_BUDGET) -> List[Document]:
+    """Chunks whole-file Documents with the strategy matching their filename (paragraphs otherwise)."""
+    chunks = []
+    for doc in documents:
+        name = doc.metadata.get("filename") or doc.metadata.get("source") or ""
+        strategy = _STRATEGIES.get(os.path.splitext(name)[1], chunk_text)
+        chunks.extend(strategy(doc.page_content, doc.metadata or {}, budget))
+    return chunks
+
+def pack_documents(documents: List[Document], budget: int = CHUNK_TOKEN_BUDGET, key: str = "name") -> List[Document]:
+    """
+    Packs small, already structured Documents (e.g. one per macro) into budget-sized
+    chunks; the `key` metadata of the members is joined into the chunk's metadata.
+    """
+    if not documents:
+        return []
+    return _emit("", [d.page_content for d in documents], documents[0].metadata, budget,
+                 unit_meta=[{key: d.metadata.get(key, "")} for d in documents])
@@ -0,0 +1,169 @@
+import os
+import re
+import subprocess
+import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Streaming miner of Coccinelle-generated commits.
+# One `git log -p --grep ...` process lists every matching commit with its message and
+# patch; the output is parsed line by line, so memory stays bounded by one commit and no
+# `git show` is spawned per commit. Large revision ranges can be cut into disjoint
+# sub-ranges along the first-parent chain and mined by a process pool.
+
+COMMIT_KEYWORDS = ["Generated by", "Generated using", "Generated with", "Coccinelle", "semantic patch"]
+# Commits mined per ingestion run (0 mines the whole range).
+COMMIT_LIMIT = int(os.environ.get("LK_SPG_COMMIT_LIMIT", "500"))
+# Worker processes used when a range is mined without a limit.
+MINER_WORKERS = int(os.environ.get("LK_SPG_MINER_WORKERS", str(os.cpu_count() or 1)))
+# Sub-ranges with fewer first-parent commits are not split further.
+MIN_PART_COMMITS = 256
+
+# (sha, summary, script, diff)
+MinedCommit = Tuple[str, str, str, str]
+Revs = Union[str, Sequence[str]]
+
+_START = "\x01"
+_END = "\x02"
+_FORMAT = f"--format={_START}%H%n%B{_END}"
+_SCRIPT_RE = re.compile(r'(@@.*?@@.*)', re.DOTALL)
+_SMPL_RE = re.compile(r'//\s*<smpl>(.*?)//\s*</smpl>', re.DOTALL)
+
+def extract_script(message: str) -> Optional[str]:
+    """Returns the semantic patch quoted in a commit message, if any."""
+    m = _SCRIPT_RE.search(message) or _SMPL_RE.search(message)
+    return m.group(1).strip() if m else None
+
+def _rev_args(revs: Revs) -> List[str]:
+    return [revs] if isinstance(revs, str) else list(revs)
+
+def _parse_log(lines: Iterator[str]) -> Iterator[Tuple[str, str, str]]:
+    """Parses `git log -p` output in _FORMAT into (sha, message, diff)."""
+    sha, message, diff = None, [], []
+    in_message = False
+    for line in lines:
+        if line.startswith(_START):
+            if sha:
+                yield sha, "".join(message), "".join(diff)
+            sha, message, diff = line[1:].strip(), [], []
+            in_message = True
+        elif in_message:
+            end = line.find(_END)
+            if end >= 0:
+                message.append(line[:end])
+                in_message = False
+            else:
+                message.append(line)
+        elif sha:
+            diff.append(line)
+    if sha:
+        yield sha, "".join(message), "".join(diff)
+
+def mine_commits(repo_path: str, revs: Revs = "master", limit: int = 0,
+                 keywords: Sequence[str] = COMMIT_KEYWORDS) -> Iterator[MinedCommit]:
+    """
+    Streams the Coccinelle-generated commits of a revision range, newest first.
+
+    Args:
+        repo_path: Git repository.
+        revs: Anything `git log` accepts: a branch, a tag, "v6.0..v6.6", or a list of
+            revisions/exclusions such as ["v6.6", "^v6.0"].
+        limit: Maximum commits matching the keywords (0 for all); commits without a
+            quoted script still count, as with `git log -n`.
+        keywords: Case-insensitive message patterns (any of them).
+
+    Returns:
+        A generator of (sha, summary, script, diff); it stops the git process when closed.
+    """
+    cmd = ["git", "-C", repo_path, "log", "-p", "--no-color", "--no-ext-diff", "-i", _FORMAT]
+    cmd += [f"--grep={k}" for k in keywords]
+    if limit:
+        cmd.append(f"--max-count={limit}")
+    cmd += _rev_args(revs) + ["--"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            encoding="utf-8", errors="replace", bufsize=1 << 16)
+    try:
+        for sha, message, diff in _parse_log(proc.stdout):
+            script = extract_script(message)
+            if script:
+                yield sha, message.split("\n")[0], script, diff.strip("\n")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        if proc.wait() not in (0, -9) and stderr:
+            print(f"git log failed for {revs}: {stderr.strip()}")
+
+def split_range(repo_path: str, revs: Revs, parts: int, min_commits: int = MIN_PART_COMMITS) -> List[List[str]]:
+    """
+    Cuts a revision range into at most `parts` disjoint sub-ranges covering it exactly.
+    Boundaries are taken along the first-parent chain, so each sub-range is "b[i] ^b[i+1]"
+    plus the exclusions of the original range.
+    """
+    args = _rev_args(revs)
+    if parts <= 1 or any("..." in arg for arg in args):
+        return [args]
+    tips, excludes = [], []
+    for arg in args:
+        if ".." in arg:
+            base, tip = arg.split("..", 1)
+            excludes.append(f"^{base or 'HEAD'}")
+            tips.append(tip or "HEAD")
+        elif arg.startswith("^"):
+            excludes.append(arg)
+        else:
+            tips.append(arg)
+    if len(tips) != 1:
+        return [args]
+    try:
+        chain = subprocess.run(
+            ["git", "-C", repo_path, "rev-list", "--first-parent", tips[0], *excludes, "--"],
+            capture_output=True, text=True, check=True
+        ).stdout.split()
+    except subprocess.CalledProcessError as e:
+        print(f"Could not split {revs}: {e.stderr.strip()}")
+        return [args]
+    step = max(min_commits, -(-len(chain) // parts))
+    bounds = chain[::step]
+    if len(bounds) <= 1:
+        return [args]
+    ranges = [[tip, f"^{below}", *excludes] for tip, below in zip(bounds, bounds[1:])]
+    ranges.append([bounds[-1], *excludes])
+    return ranges
+
+def _mine_part(repo_path: str, revs: List[str], keywords: Sequence[str]) -> List[MinedCommit]:
+    return list(mine_commits(repo_path, revs, keywords=keywords))
+
+def mine_commits_parallel(repo_path: str, revs: Revs = "master", workers: int = MINER_WORKERS,
+                          keywords: Sequence[str] = COMMIT_KEYWORDS,
+                          min_commits: int = MIN_PART_COMMITS) -> Iterator[MinedCommit]:
+    """
+    Mines a whole range with a process pool over split_range() sub-ranges.
+    Sub-ranges are yielded in order (newest first) as soon as each one is complete.
+    """
+    # More sub-ranges than workers keep them small; at most `workers` results are held at once.
+    ranges = split_range(repo_path, revs, workers * 4, min_commits)
+    if len(ranges) == 1:
+        yield from mine_commits(repo_path, ranges[0], keywords=keywords)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+        inflight: Deque[Future] = deque()
+        for part in ranges:
+            inflight.append(pool.submit(_mine_part, repo_path, part, keywords))
+            if len(inflight) >= workers:
+                yield from inflight.popleft().result()
+        while inflight:
+            yield from inflight.popleft().result()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m src.rag.commit_miner <repo> [rev-range ...]")
+        sys.exit(1)
+    found = 0
+    for sha, summary, _, _ in mine_commits_parallel(sys.argv[1], sys.argv[2:] or "HEAD"):
+        found += 1
+        print(f"{sha[:12]} {summary}")
+    print(f"{found} Coccinelle-generated commits.", file=sys.stderr)
@@ -0,0 +1,176 @@
+import fcntl
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from src.mcp_server.cache import get_cache_dir
+
+# Persistent embedding cache keyed by (model name, sha256 of the chunk text).
+# Vectors of one model are appended as fixed-size rows to a flat array file
+# (<model>.f16 or <model>.f32) and located through a SQLite index (digest -> row),
+# so re-ingesting unchanged chunks never reaches the embedding endpoint.
+# Appends hold an exclusive flock on the array file plus a write transaction on the
+# index, so several processes can share one cache.
+
+DTYPES = {"float16": np.float16, "float32": np.float32}
+
+def _model_slug(model: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', model)
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8', errors='surrogateescape')).hexdigest()
+
+class EmbeddingCache:
+    """Flat-file vector store plus SQLite index for one embedding model."""
+
+    def __init__(self, model: str, cache_dir: Optional[str] = None, dtype: str = "float16"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype '{dtype}' (expected one of {sorted(DTYPES)})")
+        self.model = model
+        self.dtype = np.dtype(DTYPES[dtype])
+        cache_dir = cache_dir or get_cache_dir("embeddings")
+        base = os.path.join(cache_dir, _model_slug(model))
+        self.array_path = f"{base}.{'f16' if dtype == 'float16' else 'f32'}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f"{base}.{dtype}.sqlite3", check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (digest TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._conn.commit()
+        dim = self._conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        self.dim = int(dim[0]) if dim else None
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        self._array: Optional[np.memmap] = None
+
+    def _view(self) -> np.ndarray:
+        if self._array is None or self._array.shape[0] < self._rows:
+            self._array = np.memmap(self.array_path, dtype=self.dtype, mode='r', shape=(self._rows, self.dim))
+        return self._array
+
+    def get_many(self, digests: List[str]) -> Dict[str, List[float]]:
+        """Returns the cached vectors (as float lists) for the digests that are present."""
+        if not digests:
+            return {}
+        with self._lock:
+            rows = {}
+            unique = list(dict.fromkeys(digests))
+            for i in range(0, len(unique), 500):
+                part = unique[i:i + 500]
+                marks = ",".join("?" * len(part))
+                rows.update(self._conn.execute(
+                    f"SELECT digest, row FROM vectors WHERE digest IN ({marks})", part
+                ).fetchall())
+            if not rows:
+                return {}
+            # Rows appended by another process since this one last looked.
+            self._rows = max(self._rows, max(rows.values()) + 1)
+            if self.dim is None:
+                self.dim = int(self._conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()[0])
+            view = self._view()
+            return {d: view[r].astype(np.float32).tolist() for d, r in rows.items()}
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """Appends new vectors to the array file and records them in the index."""
+        if not items:
+            return
+        with self._lock, open(self.array_path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._append(f, items)
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    def _append(self, f, items: Dict[str, List[float]]) -> None:
+        """Appends under the file lock, numbering rows from the committed index, not a cached count."""
+        rows = self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        dim = self._conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        self.dim = int(dim[0]) if dim else None
+        new = [(d, v) for d, v in items.items()
+               if not self._conn.execute("SELECT 1 FROM vectors WHERE digest = ?", (d,)).fetchone()]
+        self._rows = rows
+        if not new:
+            return
+        matrix = np.asarray([v for _, v in new], dtype=self.dtype)
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),))
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension changed from {self.dim} to {matrix.shape[1]}")
+        # Drop any tail a crashed writer appended but never recorded, so the file size
+        # matches the index; the index is committed after the append, so a crash in
+        # between again leaves only such a tail.
+        f.truncate(rows * self.dim * self.dtype.itemsize)
+        f.write(matrix.tobytes())
+        f.flush()
+        self._conn.executemany(
+            "INSERT INTO vectors (digest, row) VALUES (?, ?)",
+            [(d, rows + i) for i, (d, _) in enumerate(new)]
+        )
+        self._rows = rows + len(new)
+
+    def __len__(self) -> int:
+        return self._rows
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with the on-disk EmbeddingCache.
+    Only texts whose (model, sha256) is not cached yet are sent to the wrapped model.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, cache: Optional[EmbeddingCache] = None):
+        self.embeddings = embeddings
+        self.model = model
+        if cache is None:
+            cache = EmbeddingCache(model, dtype=os.environ.get("LK_SPG_EMBEDDING_DTYPE", "float16"))
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        digests = [text_digest(t) for t in texts]
+        cached = self.cache.get_many(digests)
+        missing = {}
+        for digest, text in zip(digests, texts):
+            if digest not in cached:
+                missing.setdefault(digest, text)
+        misses = sum(1 for d in digests if d not in cached)
+        with self._stats_lock:
+            self.hits += len(texts) - misses
+            self.misses += misses
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(fresh)
+            cached.update(fresh)
+        return [list(cached[d]) for d in digests]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Queries are not cached: they rarely repeat across runs and would crowd the chunk cache.
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embeds several queries in one request, bypassing the chunk cache like embed_query."""
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.cache),
+            }
+
+    def report(self) -> str:
+        s = self.stats()
+        return f"Embedding cache: {s['hits']} hits, {s['misses']} misses ({s['hit_rate']:.1%} hit rate), {s['entries']} cached vectors."
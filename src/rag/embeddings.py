@@ -1,26 +1,52 @@
 import os
-from langchain_openai import OpenAIEmbeddings
+from typing import Optional
+from langchain_core.embeddings import Embeddings
+from src.rag.embedding_cache import CachedEmbeddings
+from src.rag.local_embeddings import HashedNgramEmbeddings
 
-def get_embedding_model() -> OpenAIEmbeddings:
+EMBEDDING_MODEL = "BAAI/bge-large-en-v1.5"
+COLLECTION_NAME = "cocci_patterns"
+
+def get_embedding_model(backend: Optional[str] = None) -> Embeddings:
     """
-    Returns the Silicon Flow embedding model instance.
-    Uses 'BAAI/bge-large-en-v1.5' by default but configured for Silicon Flow API.
+    Returns the embedding model selected by `backend` or LK_SPG_EMBEDDINGS:
+    "siliconflow" (default), "local" (offline hashed n-grams, src/rag/local_embeddings.py)
+    or "auto" (local when SILICONFLOW_API_KEY is not set).
+
+    The Silicon Flow model uses 'BAAI/bge-large-en-v1.5'. Its document embeddings go through
+    the on-disk embedding cache (src/rag/embedding_cache.py) unless LK_SPG_EMBEDDING_CACHE=0.
     
-    Requires SILICONFLOW_API_KEY environment variable.
+    Requires SILICONFLOW_API_KEY environment variable for the Silicon Flow backend.
     """
+    backend = backend or os.environ.get("LK_SPG_EMBEDDINGS", "siliconflow")
     api_key = os.environ.get("SILICONFLOW_API_KEY")
+    if backend == "local" or (backend == "auto" and not api_key):
+        return HashedNgramEmbeddings()
+    if backend not in ("siliconflow", "auto"):
+        raise ValueError(f"Unknown embedding backend '{backend}' (expected siliconflow, local or auto)")
     if not api_key:
         print("Warning: SILICONFLOW_API_KEY not found. Please set it for embeddings to work.")
         # We might want to fallback or just let OpenAIEmbeddings fail/warn later, 
         # but for now we proceed hoping it might be set elsewhere or user is aware.
     
-    return OpenAIEmbeddings(
+    from langchain_openai import OpenAIEmbeddings
+    embeddings = OpenAIEmbeddings(
         openai_api_base="https://api.siliconflow.cn/v1",
         openai_api_key=api_key,
-        model="BAAI/bge-large-en-v1.5",
+        model=EMBEDDING_MODEL,
         # Explicitly set dimensions if needed, though usually inferred or defaults are fine.
         # User request mentioned encoding_format float and dimensions 1024, 
         # OpenAIEmbeddings handles this mostly, but we can't easily force dimensions 
         # in the constructor args directly for all versions without model specific kwargs.
         # BAAI/bge-large-zh-v1.5 is 1024 dims naturally.
     )
+
+    if os.environ.get("LK_SPG_EMBEDDING_CACHE", "1") == "0":
+        return embeddings
+    return CachedEmbeddings(embeddings, model=EMBEDDING_MODEL)
+
+def collection_name(embeddings: Embeddings) -> str:
+    """Vectors of different models are not comparable, so local embeddings get their own collection."""
+    if isinstance(embeddings, HashedNgramEmbeddings):
+        return f"{COLLECTION_NAME}_local"
+    return COLLECTION_NAME
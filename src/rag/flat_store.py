@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+# Read-only flat vector index, an alternative search backend to Chroma.
+# A collection is exported into one directory next to the database:
+#   meta.json    - dimension, dtype, row count, source collection
+#   vectors.npy  - (rows, dim) float16, or int8 with a per-row scale in scales.npy
+#   norms.npy    - float32 norm of every stored (dequantized) row
+#   ids.npy      - chunk ids, types.npy - metadata "type" (for filtered search)
+#   records.bin  - {"document", "metadata"} JSON per row, located via offsets.npy
+# All arrays are memory-mapped, so opening takes milliseconds, search is a blocked NumPy
+# dot product over the rows of the requested type, and worker processes share the pages.
+# Chroma stays the store that ingestion writes to; the index is re-exported afterwards.
+
+FLAT_VERSION = 1
+# Search backend of CocciRetriever: "chroma" or "flat" (this index, exported after ingestion).
+VECTOR_BACKEND = os.environ.get("LK_SPG_VECTOR_STORE", "chroma")
+FLAT_DTYPE = os.environ.get("LK_SPG_FLAT_DTYPE", "float16")
+BLOCK_ROWS = 8192  # Rows scored per dot product (bounds the float32 temporary)
+
+def flat_path(persist_directory: str, collection: str) -> str:
+    return os.path.join(persist_directory, f"flat.{collection}")
+
+def _quantize(block: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    if dtype == "float16":
+        return block.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(block).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(block / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f"Unsupported flat index dtype '{dtype}' (expected float16 or int8)")
+
+class FlatVectorStore:
+    """
+    Memory-mapped, read-only vector store answering the subset of the Chroma API used by
+    CocciRetriever (similarity_search[_by_vector], get) with cosine similarity.
+
+    Args:
+        path: Index directory written by export_chroma.
+        embeddings: Embedding function of the exported collection (for similarity_search).
+    """
+
+    def __init__(self, path: str, embeddings: Optional[Embeddings] = None):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != FLAT_VERSION:
+            raise ValueError(f"Flat index {path} has version {self.meta.get('version')}, expected {FLAT_VERSION}")
+        self.path = path
+        self.embeddings = embeddings
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.vectors = load("vectors.npy")
+        self.scales = load("scales.npy") if self.meta["dtype"] == "int8" else None
+        self.norms = load("norms.npy")
+        self.ids = load("ids.npy")
+        self.types = load("types.npy")
+        self.offsets = load("offsets.npy")
+        self.records = np.memmap(os.path.join(path, "records.bin"), dtype=np.uint8, mode="r") \
+            if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+        self._rows_of_type: Dict[str, np.ndarray] = {}
+        self._row_of_id: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return int(self.meta["count"])
+
+    def count(self) -> int:
+        return len(self)
+
+    def _record(self, row: int) -> Dict[str, Any]:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return json.loads(self.records[start:end].tobytes().decode("utf-8"))
+
+    def _document(self, row: int) -> Document:
+        record = self._record(row)
+        return Document(id=str(self.ids[row]), page_content=record["document"] or "", metadata=record["metadata"] or {})
+
+    def _candidate_rows(self, filter: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Rows allowed by the filter (None for all). Only equality on "type" is indexed."""
+        if not filter:
+            return None
+        if set(filter) != {"type"} or not isinstance(filter["type"], str):
+            raise ValueError(f"FlatVectorStore only supports {{'type': <str>}} filters, got {filter}")
+        doc_type = filter["type"]
+        rows = self._rows_of_type.get(doc_type)
+        if rows is None:
+            rows = self._rows_of_type[doc_type] = np.flatnonzero(np.asarray(self.types) == doc_type)
+        return rows
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        total = len(self) if rows is None else len(rows)
+        scores = np.empty(total, dtype=np.float32)
+        for start in range(0, total, BLOCK_ROWS):
+            index = slice(start, min(total, start + BLOCK_ROWS)) if rows is None else rows[start:start + BLOCK_ROWS]
+            dots = np.asarray(self.vectors[index], dtype=np.float32) @ query
+            if self.scales is not None:
+                dots *= self.scales[index]
+            scores[start:start + len(dots)] = dots / np.maximum(self.norms[index], 1e-12)
+        return scores
+
+    def similarity_search_by_vector_with_scores(self, embedding: Sequence[float], k: int = 4,
+                                                filter: Optional[Dict[str, Any]] = None) -> List[Tuple[Document, float]]:
+        if not len(self):
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        rows = self._candidate_rows(filter)
+        scores = self._scores(query, rows)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self._document(int(i if rows is None else rows[i])), float(scores[i])) for i in top]
+
+    def similarity_search_by_vector(self, embedding: Sequence[float], k: int = 4,
+                                    filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_scores(embedding, k, filter)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        if self.embeddings is None:
+            raise ValueError("FlatVectorStore was opened without an embedding function")
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k, filter)
+
+    def get(self, ids: Optional[Sequence[str]] = None, include: Sequence[str] = ("documents", "metadatas"),
+            limit: Optional[int] = None, offset: int = 0, **kwargs: Any) -> Dict[str, Any]:
+        """Chroma-style get: by ids, or a page of all rows."""
+        if ids is not None:
+            if self._row_of_id is None:
+                self._row_of_id = {str(i): n for n, i in enumerate(self.ids)}
+            rows = [self._row_of_id[i] for i in ids if i in self._row_of_id]
+        else:
+            end = len(self) if limit is None else min(len(self), offset + limit)
+            rows = list(range(offset, end))
+        records = [self._record(r) for r in rows] if {"documents", "metadatas"} & set(include) else []
+        result: Dict[str, Any] = {"ids": [str(self.ids[r]) for r in rows]}
+        if "documents" in include:
+            result["documents"] = [rec["document"] for rec in records]
+        if "metadatas" in include:
+            result["metadatas"] = [rec["metadata"] for rec in records]
+        if "embeddings" in include:
+            result["embeddings"] = [self.vector(r) for r in rows]
+        return result
+
+    def vector(self, row: int) -> np.ndarray:
+        """The dequantized vector of a row."""
+        vec = np.asarray(self.vectors[row], dtype=np.float32)
+        return vec * self.scales[row] if self.scales is not None else vec
+
+def chroma_collection(vector_store: Any) -> Any:
+    """
+    The chromadb collection behind a langchain Chroma store.
+    langchain_chroma only exposes it as the private `_collection`; all access goes through here.
+    """
+    return vector_store._collection
+
+def store_count(vector_store: Any) -> int:
+    """Number of chunks in a Chroma store or a flat index."""
+    return vector_store.count() if isinstance(vector_store, FlatVectorStore) else chroma_collection(vector_store).count()
+
+def _chroma_pages(vector_store: Any, page_size: int) -> Iterator[Dict[str, Any]]:
+    offset = 0
+    while True:
+        page = vector_store.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        if len(page["ids"]):
+            yield page
+        if len(page["ids"]) < page_size:
+            return
+        offset += page_size
+
+def export_chroma(vector_store: Any, path: str, dtype: str = FLAT_DTYPE, page_size: int = 2000) -> FlatVectorStore:
+    """
+    Exports a Chroma collection (with its stored embeddings) into a flat index at `path`.
+    The index is written next to the old one and swapped in, so open readers are unaffected.
+    """
+    collection = chroma_collection(vector_store)
+    count = collection.count()
+    tmp = f"{path}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    vectors = scales = norms = None
+    ids, types = [], []
+    offsets = [0]
+    row = 0
+    with open(os.path.join(tmp, "records.bin"), "wb") as records:
+        for page in _chroma_pages(vector_store, page_size):
+            block = np.asarray(page["embeddings"], dtype=np.float32)
+            if vectors is None:
+                dim = block.shape[1]
+                vectors = np.lib.format.open_memmap(os.path.join(tmp, "vectors.npy"), mode="w+",
+                                                    dtype=np.float16 if dtype == "float16" else np.int8, shape=(count, dim))
+                scales = np.zeros(count, dtype=np.float32)
+                norms = np.zeros(count, dtype=np.float32)
+            stored, block_scales = _quantize(block, dtype)
+            end = row + len(block)
+            vectors[row:end] = stored
+            restored = stored.astype(np.float32) * (block_scales[:, None] if block_scales is not None else 1.0)
+            norms[row:end] = np.linalg.norm(restored, axis=1)
+            if block_scales is not None:
+                scales[row:end] = block_scales
+            for doc_id, text, meta in zip(page["ids"], page["documents"], page["metadatas"]):
+                data = json.dumps({"document": text, "metadata": meta or {}}, ensure_ascii=False).encode("utf-8")
+                records.write(data)
+                offsets.append(offsets[-1] + len(data))
+                ids.append(doc_id)
+                types.append((meta or {}).get("type", ""))
+            row = end
+    vectors_dim = 0 if vectors is None else vectors.shape[1]
+    if vectors is None:
+        vectors = np.zeros((0, 0), dtype=np.float16 if dtype == "float16" else np.int8)
+        np.save(os.path.join(tmp, "vectors.npy"), vectors)
+        scales = norms = np.zeros(0, dtype=np.float32)
+    else:
+        vectors.flush()
+        del vectors
+    if dtype == "int8":
+        np.save(os.path.join(tmp, "scales.npy"), scales[:row])
+    np.save(os.path.join(tmp, "norms.npy"), norms[:row])
+    np.save(os.path.join(tmp, "ids.npy"), np.asarray(ids, dtype=str))
+    np.save(os.path.join(tmp, "types.npy"), np.asarray(types, dtype=str))
+    np.save(os.path.join(tmp, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"version": FLAT_VERSION, "dtype": dtype, "dim": int(vectors_dim), "count": row, "created": time.time(),
+                   "collection": collection.name}, f)
+
+    old = f"{path}.old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"Flat index exported: {row} vectors ({dtype}) to {path}.")
+    return FlatVectorStore(path, getattr(vector_store, "embeddings", None))
+
+def import_chroma(store: FlatVectorStore, vector_store: Any, batch_size: int = 1000) -> int:
+    """Upserts every row of a flat index (with its vectors) into a Chroma collection."""
+    for start in range(0, len(store), batch_size):
+        page = store.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=start)
+        chroma_collection(vector_store).upsert(
+            ids=page["ids"], embeddings=[v.tolist() for v in page["embeddings"]],
+            documents=page["documents"], metadatas=[m or None for m in page["metadatas"]]
+        )
+    print(f"Imported {len(store)} vectors from {store.path}.")
+    return len(store)
+
+if __name__ == "__main__":
+    import argparse
+    from langchain_chroma import Chroma
+    from src.rag.embeddings import collection_name, get_embedding_model
+
+    parser = argparse.ArgumentParser(description="Export a Chroma collection to a flat index, or import one back.")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("--db-path", default="./chroma_db")
+    parser.add_argument("--dtype", default=FLAT_DTYPE, choices=["float16", "int8"])
+    args = parser.parse_args()
+    embeddings = get_embedding_model()
+    collection = collection_name(embeddings)
+    chroma = Chroma(collection_name=collection, embedding_function=embeddings, persist_directory=args.db_path)
+    if args.action == "export":
+        export_chroma(chroma, flat_path(args.db_path, collection), args.dtype)
+    else:
+        import_chroma(FlatVectorStore(flat_path(args.db_path, collection), embeddings), chroma)
@@ -1,10 +1,8 @@
 import os
 import glob
+import itertools
 import re
 from typing import List
-import chromadb
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
 
 def parse_cocci_file(file_path: str) -> List[Document]:
@@ -32,136 +30,129 @@ def parse_cocci_file(file_path: str) -> List[Document]:
         "description": " ".join(description)
     }
     
-    # TODO: Implement more granular splitting by rules if needed.
-    # For now, chunking by file is a safe start for RAG.
-    
+    # Split per rule at ingestion time (see src/rag/chunking.py).
     doc = Document(page_content=content, metadata=metadata)
     documents.append(doc)
     return documents
 
+STANDARD_FILES = ['standard.h', 'standard.iso', 'cocci_syntax.tex']
+
+def parse_standard_file(file_path: str) -> List[Document]:
+    """
+    Parses one of standard.h, standard.iso or cocci_syntax.tex into a Document.
+    """
+    with open(file_path, 'r', errors='ignore') as f:
+        content = f.read()
+    
+    metadata = {
+        "source": file_path,
+        "filename": os.path.basename(file_path),
+        "type": "standard_definition"
+    }
+    return [Document(page_content=content, metadata=metadata)]
+
 def parse_standard_files(cocci_dir: str) -> List[Document]:
     """
     Parses standard.h, standard.iso, and cocci_syntax.tex if they exist.
     """
     documents = []
-    files_to_check = ['standard.h', 'standard.iso', 'cocci_syntax.tex']
-    
-    for filename in files_to_check:
+    for filename in STANDARD_FILES:
         file_path = os.path.join(cocci_dir, filename)
         if os.path.exists(file_path):
-            with open(file_path, 'r', errors='ignore') as f:
-                content = f.read()
-            
-            metadata = {
-                "source": file_path,
-                "filename": filename,
-                "type": "standard_definition"
-            }
-            documents.append(Document(page_content=content, metadata=metadata))
-            
+            documents.extend(parse_standard_file(file_path))
     return documents
 
+def parse_file_source(source_id: str, kind: str, path: str, state, parse) -> "SourceUpdate":
+    """Parse stage of ingest_data (runs in a worker process): parse and chunk one file."""
+    from src.rag.chunking import chunk_file_documents
+    from src.rag.manifest import SourceUpdate
+    return SourceUpdate(source_id, kind, chunk_file_documents(parse(path)), path, state)
+
 def ingest_data(kernel_dir: str, db_path: str):
     """
     Ingests .cocci files from kernel source and standard definitions into ChromaDB.
+    Only new or changed files are embedded; chunks of deleted files are removed.
+    The ingestion manifest (src/rag/manifest.py) lives next to the database.
+    Files are parsed, chunked, embedded and stored as a stream (src/rag/pipeline.py).
     """
+    from src.rag.chunking import CHUNKER_VERSION
+    from src.rag.manifest import IngestManifest
+    from src.rag.pipeline import ingest_stream
+
     print(f"Scanning {kernel_dir} for .cocci files...")
     
-    cocci_files = glob.glob(os.path.join(kernel_dir, 'coccinelle/**/*.cocci'), recursive=True)
-    print(f"Found {len(cocci_files)} .cocci files.")
-    
-    all_docs = []
-    
-    # Parse Kernel Cocci Files
-    for file_path in cocci_files:
-        docs = parse_cocci_file(file_path)
-        all_docs.extend(docs)
+    cocci_files = glob.iglob(os.path.join(kernel_dir, 'coccinelle/**/*.cocci'), recursive=True)
+    sources = ((path, "cocci", parse_cocci_file) for path in cocci_files)
         
     # Parse Standard Definitions (Assuming they might be in the same dir or a specific one)
     # If standard files are in the kernel tree, they might be in scripts/coccinelle/ or elsewhere.
     # Often they are part of the coccinelle installation, not the kernel source.
     # But if the user provided them in the workspace, we check there.
     # For this implementation, we check the kernel_dir/scripts/coccinelle root.
-    standard_docs = parse_standard_files(os.path.join(kernel_dir, 'coccinelle'))
-    all_docs.extend(standard_docs)
-    print(len(all_docs), len(standard_docs))
-    if not all_docs:
-        print("No documents found to ingest.")
-        return
+    standard_dir = os.path.join(kernel_dir, 'coccinelle')
+    standard_sources = [
+        (os.path.join(standard_dir, filename), "standard", parse_standard_file) for filename in STANDARD_FILES
+        if os.path.exists(os.path.join(standard_dir, filename))
+    ]
 
-    # Custom splitter since langchain_text_splitters is missing
-    class SimpleCharacterTextSplitter:
-        def __init__(self, chunk_size, chunk_overlap):
-            self.chunk_size = chunk_size
-            self.chunk_overlap = chunk_overlap
-        
-        def split_documents(self, documents):
-            new_docs = []
-            from langchain_core.documents import Document
-            for doc in documents:
-                text = doc.page_content
-                if not text:
-                    continue
-                start = 0
-                text_len = len(text)
-                chunk_index = 0
-                while start < text_len:
-                    end = min(start + self.chunk_size, text_len)
-                    chunk_text = text[start:end]
-                    
-                    metadata = doc.metadata.copy() if doc.metadata else {}
-                    metadata["chunk"] = chunk_index
-                    new_docs.append(Document(page_content=chunk_text, metadata=metadata))
-                    
-                    if end == text_len:
-                        break
-                    start += (self.chunk_size - self.chunk_overlap)
-                    chunk_index += 1
-            return new_docs
+    # Note: We use Silicon Flow embeddings (or the local backend) via get_embedding_model
+    from src.rag.embeddings import collection_name, get_embedding_model
+    embeddings = get_embedding_model()
+    collection = collection_name(embeddings)
 
-    # Reduce chunk size further to 250 to be extremely safe against token limits
-    text_splitter = SimpleCharacterTextSplitter(
-        chunk_size=250,
-        chunk_overlap=50
-    )
-    
-    split_docs = text_splitter.split_documents(all_docs)
-    print(f"Split {len(all_docs)} documents into {len(split_docs)} chunks.")
+    manifest = IngestManifest.for_store(db_path, collection)
+    # Files chunked by an older chunker are re-chunked even when unchanged.
+    rechunk = manifest.get_meta("chunker") != CHUNKER_VERSION
+    # Change detection needs the manifest, so it runs here; the tasks only carry paths.
+    tasks = []
+    seen = set()
+    for path, kind, parse in itertools.chain(sources, standard_sources):
+        source_id = f"file:{os.path.abspath(path)}"
+        seen.add(source_id)
+        state = manifest.file_state(source_id, path, force=rechunk)
+        if state is not None:
+            tasks.append((parse_file_source, (source_id, kind, path, state, parse)))
+    removed = [s for kind in ("cocci", "standard") for s in manifest.source_ids(kind) if s not in seen]
 
-    print(f"Ingesting {len(split_docs)} documents into ChromaDB at {db_path}...")
-    
-    # Initialize Chroma
-    # Note: We use Silicon Flow embeddings via get_embedding_model
-    from embeddings import get_embedding_model
-    embeddings = get_embedding_model()
-    
+    print(f"{len(tasks)} new or changed sources, {len(seen) - len(tasks)} unchanged, {len(removed)} removed.")
+    if not tasks and not removed:
+        print("Nothing to ingest.")
+        return
+
+    print(f"Ingesting into ChromaDB at {db_path}...")
+    from langchain_chroma import Chroma
     vector_store = Chroma(
-        collection_name="cocci_patterns",
+        collection_name=collection,
         embedding_function=embeddings,
         persist_directory=db_path
     )
     
-    # Add documents
-    # Process in batches to avoid hitting limits if any
-    # Batch size limited to 32 by Silicon Flow API, reducing to 5 to avoid token totals
-    batch_size = 5
-    import time
-    for i in range(0, len(split_docs), batch_size):
-        batch = split_docs[i:i+batch_size]
-        try:
-            vector_store.add_documents(batch)
-            print(f"Ingested batch {i//batch_size + 1}/{(len(split_docs)-1)//batch_size + 1}")
-            # Sleep to avoid RPM limit (403)
-            time.sleep(1.2)
-        except Exception as e:
-            print(f"Error ingesting batch {i//batch_size + 1}: {e}")
-            # Try to continue or re-raise? For now, we print and continue best effort
-            pass
-        
-    print("Ingestion complete.")
+    # Add documents through the rate-limited, concurrent submitter (see src/rag/rate_limit.py);
+    # one submitter for the whole run, so its batch size and backoff state span the windows.
+    from src.rag.rate_limit import store_submitter, submit_documents
+    submitter = store_submitter(vector_store)
+    add_batches = lambda docs, ids: submit_documents(vector_store, docs, ids, submitter=submitter)
+
+    stats = ingest_stream(vector_store, manifest, tasks, removed, add_batches)
+    print(
+        f"Ingestion complete: {stats['added']} chunks added, {stats['deleted']} deleted, "
+        f"{stats['sources']} sources updated, {stats['removed']} removed, {stats['failed']} failed."
+    )
+    if hasattr(embeddings, "report"):
+        print(embeddings.report())
+    from src.rag.bm25 import rebuild_index
+    rebuild_index(vector_store, db_path, collection)
+    from src.rag.flat_store import VECTOR_BACKEND, export_chroma, flat_path
+    if VECTOR_BACKEND == "flat":
+        export_chroma(vector_store, flat_path(db_path, collection))
+    if stats["failed"] == 0:
+        manifest.set_meta("chunker", CHUNKER_VERSION)
 
 if __name__ == "__main__":
     import argparse
+    import sys
+    # Allow running as a script (python src/rag/ingest.py) as well as a module.
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
     parser = argparse.ArgumentParser()
     parser.add_argument("--kernel-dir", required=True, help="Path to Linux Kernel source")
     parser.add_argument("--db-path", default="./chroma_db", help="Path to persist ChromaDB")
@@ -0,0 +1,109 @@
+import re
+from typing import List, Tuple
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Offline embedding backend: signed feature hashing of character n-grams and
+# C identifiers (plus their snake_case parts) into a fixed-size vector.
+# All hashes of a batch are computed with NumPy over one concatenated byte array, so
+# there is no per-feature Python work; the vectors are log-scaled and L2-normalized,
+# so cosine similarity behaves like a weighted n-gram / identifier overlap.
+
+LOCAL_EMBEDDING_MODEL = "local-hashed-ngrams-v1"
+
+_PRIME = np.uint64(0x100000001B3)
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_IDENT_RE = re.compile(r'[a-z_][a-z0-9_]*')
+_PART_RE = re.compile(r'[a-z0-9]+')
+_SPACE_RE = re.compile(r'\s+')
+
+def _identifier_features(text: str) -> List[str]:
+    """Lowercased identifiers followed by all their snake_case parts."""
+    lowered = text.lower()
+    return _IDENT_RE.findall(lowered) + _PART_RE.findall(lowered)
+
+class HashedNgramEmbeddings(Embeddings):
+    """
+    Deterministic, network-free embeddings for air-gapped hosts.
+
+    Args:
+        dim: Output dimension.
+        ngram_range: Character n-gram sizes (inclusive).
+        identifier_weight: Weight of whole identifiers and their parts relative to n-grams.
+    """
+
+    def __init__(self, dim: int = 1024, ngram_range: Tuple[int, int] = (3, 5), identifier_weight: float = 2.0):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.identifier_weight = identifier_weight
+        self.model = f"{LOCAL_EMBEDDING_MODEL}-{dim}"
+
+    def _ngram_features(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (row, hash) of every character n-gram of the batch."""
+        joined = "\x00".join(_SPACE_RE.sub(" ", t.lower()).strip() for t in texts)
+        data = np.frombuffer(joined.encode("utf-8", errors="replace"), dtype=np.uint8)
+        seps_before = np.concatenate(([0], np.cumsum(data == 0)))
+        wide = data.astype(np.uint64)
+        low, high = self.ngram_range
+        rows, hashes = [], []
+        # Polynomial hashes of all windows; the n-gram hashes extend the (n-1)-gram ones.
+        h = wide.copy()
+        for n in range(2, high + 1):
+            count = len(data) - n + 1
+            if count <= 0:
+                break
+            h = h[:count] * _PRIME + wide[n - 1:n - 1 + count]
+            if n < low:
+                continue
+            # Windows crossing a text boundary are dropped.
+            keep = seps_before[n:n + count] == seps_before[:count]
+            rows.append(seps_before[1:count + 1][keep])
+            hashes.append(h[keep] ^ np.uint64(n))
+        if not hashes:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+        return np.concatenate(rows), np.concatenate(hashes)
+
+    def _identifier_features(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (row, hash) of every identifier (and identifier part) of the batch."""
+        per_text = [_identifier_features(t) for t in texts]
+        counts = np.fromiter((len(f) for f in per_text), dtype=np.int64, count=len(per_text))
+        idents = [i for f in per_text for i in f]
+        if not idents:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64)
+        # Identifiers are hashed as whole tokens, all at once over their space-joined bytes:
+        # h(token) = sum(byte * P^position) with the position counted within the token.
+        buf = np.frombuffer(" ".join(idents).encode("ascii"), dtype=np.uint8)
+        index = np.arange(len(buf))
+        is_start = np.concatenate(([True], buf[:-1] == 32))
+        starts = np.flatnonzero(is_start)
+        pos = index - np.maximum.accumulate(np.where(is_start, index, 0))
+        powers = np.full(int(pos.max()) + 1, _PRIME, dtype=np.uint64)
+        powers[0] = 1
+        powers = np.cumprod(powers, dtype=np.uint64)
+        terms = np.where(buf == 32, np.uint64(0), buf.astype(np.uint64) * powers[pos])
+        hashes = np.add.reduceat(terms, starts) ^ _GOLDEN
+        return np.repeat(np.arange(len(texts)), counts), hashes
+
+    def _accumulate(self, rows: np.ndarray, hashes: np.ndarray, size: int) -> np.ndarray:
+        """Signed bincount of features into a flat (texts * dim) array."""
+        # Multiplicative mixing: the high bits pick the bucket, bit 31 the sign.
+        mixed = hashes * _GOLDEN
+        buckets = (mixed >> np.uint64(32)).astype(np.int64) % self.dim
+        signs = 1.0 - 2.0 * ((mixed >> np.uint64(31)) & np.uint64(1)).astype(np.float64)
+        return np.bincount(rows * self.dim + buckets, weights=signs, minlength=size)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        size = len(texts) * self.dim
+        matrix = self._accumulate(*self._ngram_features(texts), size)
+        matrix += self.identifier_weight * self._accumulate(*self._identifier_features(texts), size)
+        matrix = matrix.reshape(len(texts), self.dim)
+        # Sublinear term frequency, then unit length.
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1.0, norms)
+        return matrix.astype(np.float32).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
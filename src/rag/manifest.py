@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from langchain_core.documents import Document
+
+# Ingestion manifest kept next to the Chroma database.
+# It records every ingested source (a file or a commit) with its fingerprint and the ids
+# of the chunks it produced, so a re-run only embeds new or changed sources and deletes
+# the chunks of sources that disappeared. Chunk ids are deterministic.
+
+MANIFEST_NAME = "ingest_manifest.sqlite3"
+
+FileState = Tuple[float, int, str]  # (mtime, size, sha256)
+
+def chunk_id(source_id: str, index: int, text: str) -> str:
+    """Deterministic id of the index-th chunk of a source."""
+    h = hashlib.sha256()
+    for part in (source_id, str(index), text):
+        data = part.encode('utf-8', errors='surrogateescape')
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()[:32]
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class IngestManifest:
+    """SQLite record of ingested sources and their chunk ids."""
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            " source_id TEXT PRIMARY KEY, kind TEXT NOT NULL, path TEXT, mtime REAL, size INTEGER,"
+            " sha256 TEXT, chunk_ids TEXT NOT NULL, ingested REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    @classmethod
+    def for_store(cls, persist_directory: str, collection: str = "cocci_patterns") -> "IngestManifest":
+        """Manifest of one collection; the default collection keeps the historical file name."""
+        name = MANIFEST_NAME if collection == "cocci_patterns" else MANIFEST_NAME.replace(".sqlite3", f".{collection}.sqlite3")
+        return cls(os.path.join(persist_directory, name))
+
+    def is_empty(self) -> bool:
+        return self._conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0] == 0
+
+    def has(self, source_id: str) -> bool:
+        return self._conn.execute("SELECT 1 FROM sources WHERE source_id = ?", (source_id,)).fetchone() is not None
+
+    def file_state(self, source_id: str, path: str, force: bool = False) -> Optional[FileState]:
+        """
+        Returns the current (mtime, size, sha256) of path, or None if the manifest
+        already holds this exact state. The file is only hashed when mtime or size moved.
+        With force, the state is returned even when unchanged (e.g. to re-chunk the file).
+        """
+        st = os.stat(path)
+        row = self._conn.execute("SELECT mtime, size, sha256 FROM sources WHERE source_id = ?", (source_id,)).fetchone()
+        if row and row[0] == st.st_mtime and row[1] == st.st_size and not force:
+            return None
+        sha = file_sha256(path)
+        if row and row[2] == sha and not force:
+            # Touched but not modified: refresh the stat fields only.
+            self._conn.execute("UPDATE sources SET mtime = ?, size = ? WHERE source_id = ?", (st.st_mtime, st.st_size, source_id))
+            self._conn.commit()
+            return None
+        return (st.st_mtime, st.st_size, sha)
+
+    def chunk_ids(self, source_id: str) -> List[str]:
+        row = self._conn.execute("SELECT chunk_ids FROM sources WHERE source_id = ?", (source_id,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def source_ids(self, kind: str) -> List[str]:
+        return [r[0] for r in self._conn.execute("SELECT source_id FROM sources WHERE kind = ?", (kind,))]
+
+    def record(self, source_id: str, kind: str, chunk_ids: List[str], path: Optional[str] = None, state: Optional[FileState] = None) -> None:
+        mtime, size, sha = state if state else (None, None, None)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (source_id, kind, path, mtime, size, sha, json.dumps(chunk_ids), time.time())
+        )
+        self._conn.commit()
+
+    def remove(self, source_id: str) -> None:
+        self._conn.execute("DELETE FROM sources WHERE source_id = ?", (source_id,))
+        self._conn.commit()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+        self._conn.commit()
+
+class SourceUpdate:
+    """A new or changed source: its chunks plus what to record once they are stored."""
+
+    def __init__(self, source_id: str, kind: str, chunks: List[Document], path: Optional[str] = None, state: Optional[FileState] = None):
+        self.source_id = source_id
+        self.kind = kind
+        self.chunks = chunks
+        self.path = path
+        self.state = state
+        self.ids = [chunk_id(source_id, i, doc.page_content) for i, doc in enumerate(chunks)]
+
+def new_stats() -> Dict[str, int]:
+    return {"added": 0, "deleted": 0, "sources": 0, "removed": 0, "failed": 0}
+
+def remove_sources(vector_store: Any, manifest: IngestManifest, removed: Iterable[str], stats: Dict[str, int]) -> None:
+    """Deletes the chunks of sources that no longer exist and forgets the sources."""
+    removed = list(removed)
+    stale: List[str] = []
+    for source_id in removed:
+        stale.extend(manifest.chunk_ids(source_id))
+        stats["removed"] += 1
+    if stale:
+        vector_store.delete(ids=stale)
+        stats["deleted"] += len(stale)
+    for source_id in removed:
+        manifest.remove(source_id)
+
+def delete_stale(vector_store: Any, manifest: IngestManifest, updates: List[SourceUpdate], stats: Dict[str, int]) -> None:
+    """Deletes the chunks the updated sources no longer produce (before their new chunks are added)."""
+    stale: List[str] = []
+    for update in updates:
+        new_ids = set(update.ids)
+        stale.extend(i for i in manifest.chunk_ids(update.source_id) if i not in new_ids)
+    if stale:
+        vector_store.delete(ids=stale)
+        stats["deleted"] += len(stale)
+
+def record_updates(manifest: IngestManifest, updates: List[SourceUpdate], failed: Set[str], stats: Dict[str, int]) -> None:
+    """Records the stored sources; sources with a failed chunk stay unrecorded so the next run retries them."""
+    stats["added"] += sum(len(update.ids) for update in updates) - len(failed)
+    for update in updates:
+        if failed.intersection(update.ids):
+            stats["failed"] += 1
+            continue
+        manifest.record(update.source_id, update.kind, update.ids, update.path, update.state)
+        stats["sources"] += 1
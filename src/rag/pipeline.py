@@ -0,0 +1,149 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+from langchain_core.documents import Document
+from src.rag.manifest import IngestManifest, SourceUpdate, delete_stale, new_stats, record_updates, remove_sources
+
+# Streaming ingestion: source -> parse -> chunk -> embed -> upsert.
+# Sources are enumerated lazily and parsed/chunked by a process pool; parsed sources flow
+# through a bounded queue into windows of about INGEST_WINDOW chunks, and each window is
+# embedded and upserted while the next one fills (INGEST_INFLIGHT windows at a time).
+# Every stage is bounded, so peak memory does not grow with the size of the corpus.
+
+# Parse worker processes (0 parses in a thread of this process).
+INGEST_PARSE_WORKERS = int(os.environ.get("LK_SPG_INGEST_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Parsed sources buffered between the parse and embed stages.
+INGEST_QUEUE_SIZE = int(os.environ.get("LK_SPG_INGEST_QUEUE", "64"))
+# Chunks per embed/upsert window.
+INGEST_WINDOW = int(os.environ.get("LK_SPG_INGEST_WINDOW", "256"))
+# Windows embedded/upserted concurrently (1 waits for each window before filling the next).
+INGEST_INFLIGHT = int(os.environ.get("LK_SPG_INGEST_INFLIGHT", "2"))
+
+# A parse task: a picklable (module-level) function and its arguments. It returns the
+# source's update, or None when the source produced nothing to store.
+ParseTask = Tuple[Callable[..., Optional[SourceUpdate]], tuple]
+
+_DONE = object()
+
+def _run_task(task: ParseTask) -> Optional[SourceUpdate]:
+    parse, args = task
+    return parse(*args)
+
+def _produce(tasks: Iterable[ParseTask], workers: int, out: "queue.Queue", errors: List[BaseException],
+             stop: threading.Event) -> None:
+    """Parse stage: feeds parsed sources into `out` in task order, then _DONE."""
+    try:
+        if workers <= 0:
+            for task in tasks:
+                if stop.is_set():
+                    break
+                out.put(_run_task(task))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            inflight: Deque[Future] = deque()
+            for task in tasks:
+                if stop.is_set():
+                    break
+                inflight.append(pool.submit(_run_task, task))
+                # Bounded look-ahead: the queue applies back-pressure through put().
+                if len(inflight) >= 2 * workers:
+                    out.put(inflight.popleft().result())
+            while inflight and not stop.is_set():
+                out.put(inflight.popleft().result())
+            for future in inflight:
+                future.cancel()
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        out.put(_DONE)
+
+def ingest_stream(
+    vector_store: Any,
+    manifest: IngestManifest,
+    tasks: Iterable[ParseTask],
+    removed: Iterable[str],
+    add_documents: Callable[[List[Document], List[str]], Set[str]],
+    parse_workers: int = INGEST_PARSE_WORKERS,
+    queue_size: int = INGEST_QUEUE_SIZE,
+    window: int = INGEST_WINDOW,
+    inflight: int = INGEST_INFLIGHT
+) -> Dict[str, int]:
+    """
+    Streams parse tasks into the vector store and records them in the manifest.
+
+    Args:
+        vector_store: The Chroma store (anything with delete(ids=...)).
+        manifest: The ingestion manifest of that store; only used from the calling thread.
+        tasks: Lazily produced parse tasks of new or changed sources.
+        removed: Ids of sources that no longer exist.
+        add_documents: Stores (chunks, ids) and returns the ids that could not be stored.
+        parse_workers: Parse processes (0 parses in a background thread).
+        queue_size: Parsed sources buffered ahead of the embed stage.
+        window: Chunks per embed/upsert window.
+        inflight: Windows stored concurrently.
+    Returns:
+        Counters: "added" / "deleted" chunks, "sources" updated, "removed" sources and
+        "failed" sources (left unrecorded so the next run retries them).
+    """
+    stats = new_stats()
+    remove_sources(vector_store, manifest, removed, stats)
+
+    parsed: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+    errors: List[BaseException] = []
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce, args=(tasks, parse_workers, parsed, errors, stop), daemon=True)
+    producer.start()
+
+    pending: Deque[Tuple[Future, List[SourceUpdate]]] = deque()
+    batch: List[SourceUpdate] = []
+    batch_chunks = 0
+
+    def finish(future: Future, updates: List[SourceUpdate]) -> None:
+        record_updates(manifest, updates, future.result(), stats)
+
+    with ThreadPoolExecutor(max_workers=max(1, inflight)) as pool:
+        def flush() -> None:
+            nonlocal batch, batch_chunks
+            if not batch:
+                return
+            delete_stale(vector_store, manifest, batch, stats)
+            docs = [chunk for update in batch for chunk in update.chunks]
+            ids = [i for update in batch for i in update.ids]
+            pending.append((pool.submit(add_documents, docs, ids), batch))
+            batch, batch_chunks = [], 0
+            while len(pending) >= max(1, inflight):
+                finish(*pending.popleft())
+
+        try:
+            while True:
+                update = parsed.get()
+                if update is _DONE:
+                    break
+                if update is None:
+                    continue
+                if not update.chunks:
+                    # Nothing to embed: record it (and drop its old chunks) right away.
+                    delete_stale(vector_store, manifest, [update], stats)
+                    record_updates(manifest, [update], set(), stats)
+                    continue
+                batch.append(update)
+                batch_chunks += len(update.chunks)
+                if batch_chunks >= window:
+                    flush()
+            flush()
+            while pending:
+                finish(*pending.popleft())
+        finally:
+            stop.set()
+            # Unblock the producer if it is waiting on a full queue.
+            while producer.is_alive():
+                try:
+                    parsed.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+    if errors:
+        raise errors[0]
+    return stats
@@ -0,0 +1,262 @@
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, List, Optional, Set, Tuple
+from langchain_core.documents import Document
+
+# Rate-limited, concurrent submission of chunks to the vector store.
+# Requests and (estimated) tokens are metered by two token buckets, several batches are
+# in flight at once, rate-limit responses (429/403) are retried with exponential backoff
+# and jitter, and the batch size adapts: it shrinks when the provider rejects a batch as
+# too large or starts throttling, and grows back after a run of successes.
+
+# Requests per minute allowed by the embedding provider.
+EMBED_RPM = float(os.environ.get("LK_SPG_EMBED_RPM", "120"))
+# Tokens per minute allowed by the embedding provider.
+EMBED_TPM = float(os.environ.get("LK_SPG_EMBED_TPM", "200000"))
+# Number of batches in flight at the same time.
+EMBED_CONCURRENCY = int(os.environ.get("LK_SPG_EMBED_CONCURRENCY", "4"))
+# Initial and maximum batch size (Silicon Flow accepts at most 32 inputs per request).
+EMBED_BATCH_SIZE = int(os.environ.get("LK_SPG_EMBED_BATCH_SIZE", "16"))
+EMBED_MAX_BATCH_SIZE = int(os.environ.get("LK_SPG_EMBED_MAX_BATCH_SIZE", "32"))
+# Attempts per batch before its chunks are reported as failed.
+EMBED_MAX_RETRIES = int(os.environ.get("LK_SPG_EMBED_MAX_RETRIES", "6"))
+
+_TOO_LARGE_RE = re.compile(r'too (?:long|large|many)|maximum context|max(?:imum)? (?:batch|input|token)', re.IGNORECASE)
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate` units per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes amount from the bucket and returns how long to wait.
+        An amount above the capacity is charged in full: the bucket goes into debt,
+        which this caller and the following ones wait out.
+        """
+        with self._lock:
+            self._refill()
+            self._level -= amount
+            return max(0.0, -self._level / self.rate)
+
+class RateLimiter:
+    """Meters both requests and tokens per minute."""
+
+    def __init__(self, requests_per_minute: float = EMBED_RPM, tokens_per_minute: float = EMBED_TPM):
+        self.requests = TokenBucket(requests_per_minute / 60.0, max(1.0, requests_per_minute / 60.0))
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, max(1.0, tokens_per_minute / 60.0))
+
+    def acquire(self, tokens: int) -> None:
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+
+_shared_limiter: Optional[RateLimiter] = None
+_shared_limiter_lock = threading.Lock()
+
+def shared_limiter() -> RateLimiter:
+    """The process-wide limiter, so concurrent submitters together stay within the provider limits."""
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter()
+        return _shared_limiter
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for code and English text)."""
+    return max(1, len(text) // 4)
+
+def _status_code(error: Exception) -> Optional[int]:
+    for obj in (error, getattr(error, "response", None)):
+        code = getattr(obj, "status_code", None)
+        if isinstance(code, int):
+            return code
+    m = re.search(r'\b(403|413|429)\b', str(error))
+    return int(m.group(1)) if m else None
+
+def _retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class EmbeddingSubmitter:
+    """
+    Adds documents to a vector store in concurrent, rate-limited, adaptive batches.
+    Batches that keep failing are reported instead of silently dropped.
+    """
+
+    def __init__(
+        self,
+        add: Callable[[List[Document], List[str]], Any],
+        limiter: Optional[RateLimiter] = None,
+        concurrency: int = EMBED_CONCURRENCY,
+        batch_size: int = EMBED_BATCH_SIZE,
+        max_batch_size: int = EMBED_MAX_BATCH_SIZE,
+        max_retries: int = EMBED_MAX_RETRIES,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0
+    ):
+        self.add = add
+        self.limiter = limiter or shared_limiter()
+        self.concurrency = max(1, concurrency)
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_size = max(1, min(batch_size, self.max_batch_size))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"batches": 0, "retries": 0, "throttled": 0, "splits": 0, "failed_chunks": 0}
+        self._lock = threading.Lock()
+        self._successes = 0
+
+    def _next_batch(self, pending: Deque[Tuple[List[Document], List[str], int]], items: List[Tuple[Document, str]], cursor: List[int]):
+        with self._lock:
+            if pending:
+                return pending.popleft()
+            if cursor[0] >= len(items):
+                return None
+            batch = items[cursor[0]:cursor[0] + self.batch_size]
+            cursor[0] += len(batch)
+        return [d for d, _ in batch], [i for _, i in batch], 0
+
+    def _adapt(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self._successes += 1
+                if self._successes >= 2 * self.concurrency and self.batch_size < self.max_batch_size:
+                    self.batch_size += 1
+                    self._successes = 0
+            else:
+                self._successes = 0
+                self.batch_size = max(1, self.batch_size // 2)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        hint = _retry_after(error)
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # Full jitter keeps concurrent workers from retrying in lockstep.
+        return max(hint or 0.0, random.uniform(0, delay))
+
+    def submit(self, docs: List[Document], ids: List[str]) -> Set[str]:
+        """Stores all documents and returns the ids of the chunks that could not be stored."""
+        items = list(zip(docs, ids))
+        pending: Deque[Tuple[List[Document], List[str], int]] = deque()
+        cursor = [0]
+        failed: Set[str] = set()
+        done = [0]
+        total_batches_hint = max(1, (len(items) + self.batch_size - 1) // self.batch_size)
+
+        def worker():
+            while True:
+                job = self._next_batch(pending, items, cursor)
+                if job is None:
+                    # Another worker may still requeue a split or a retry.
+                    with self._lock:
+                        busy = done[0] < len(items)
+                    if not busy:
+                        return
+                    time.sleep(0.05)
+                    continue
+                batch_docs, batch_ids, attempt = job
+                self.limiter.acquire(sum(estimate_tokens(d.page_content) for d in batch_docs))
+                try:
+                    self.add(batch_docs, batch_ids)
+                except Exception as e:
+                    code = _status_code(e)
+                    too_large = code == 413 or bool(_TOO_LARGE_RE.search(str(e)))
+                    throttled = code in (403, 429)
+                    if too_large and len(batch_docs) > 1:
+                        self._adapt(False)
+                        half = len(batch_docs) // 2
+                        with self._lock:
+                            self.stats["splits"] += 1
+                            pending.append((batch_docs[:half], batch_ids[:half], attempt))
+                            pending.append((batch_docs[half:], batch_ids[half:], attempt))
+                        continue
+                    if attempt + 1 < self.max_retries:
+                        if throttled:
+                            self._adapt(False)
+                        with self._lock:
+                            self.stats["retries"] += 1
+                            self.stats["throttled"] += int(throttled)
+                        delay = self._backoff(attempt, e)
+                        print(f"Embedding batch failed ({e}); retrying in {delay:.1f}s")
+                        time.sleep(delay)
+                        with self._lock:
+                            pending.append((batch_docs, batch_ids, attempt + 1))
+                        continue
+                    if len(batch_docs) > 1 and not throttled:
+                        # Isolate the failing chunks by bisection: after a backoff each half
+                        # gets one more attempt and is split again if it fails. Throttled
+                        # batches are not split, halves would only be throttled too.
+                        delay = self._backoff(attempt, e)
+                        print(f"Embedding batch failed after {attempt + 1} attempts ({e}); splitting it in {delay:.1f}s")
+                        time.sleep(delay)
+                        half = len(batch_docs) // 2
+                        with self._lock:
+                            self.stats["splits"] += 1
+                            pending.append((batch_docs[:half], batch_ids[:half], attempt))
+                            pending.append((batch_docs[half:], batch_ids[half:], attempt))
+                        continue
+                    print(f"Embedding batch failed after {attempt + 1} attempts: {e}")
+                    with self._lock:
+                        failed.update(batch_ids)
+                        self.stats["failed_chunks"] += len(batch_ids)
+                        done[0] += len(batch_ids)
+                    continue
+                self._adapt(True)
+                with self._lock:
+                    self.stats["batches"] += 1
+                    done[0] += len(batch_ids)
+                    progress = done[0]
+                print(f"Ingested batch {self.stats['batches']} (~{total_batches_hint} planned, {progress}/{len(items)} chunks, batch size {self.batch_size})")
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for future in [pool.submit(worker) for _ in range(self.concurrency)]:
+                future.result()
+        return failed
+
+def store_submitter(vector_store: Any, **kwargs: Any) -> EmbeddingSubmitter:
+    """
+    An EmbeddingSubmitter adding to vector_store. Create one per ingestion run and pass it to
+    every submit_documents() call, so the adapted batch size and throttling carry over.
+    """
+    from src.rag.local_embeddings import HashedNgramEmbeddings
+    if isinstance(getattr(vector_store, "embeddings", None), HashedNgramEmbeddings):
+        # Local embeddings have no provider limits: large batches, no throttling.
+        kwargs = {"limiter": RateLimiter(1e12, 1e15), "concurrency": 1, "batch_size": 512, "max_batch_size": 512, **kwargs}
+    return EmbeddingSubmitter(lambda d, i: vector_store.add_documents(d, ids=i), **kwargs)
+
+def submit_documents(
+    vector_store: Any,
+    docs: List[Document],
+    ids: List[str],
+    submitter: Optional[EmbeddingSubmitter] = None,
+    **kwargs: Any
+) -> Set[str]:
+    """
+    Adds documents (with their ids) to a vector store through an EmbeddingSubmitter
+    (the given one, or a new one built from kwargs).
+    Returns the ids of the chunks that could not be stored.
+    """
+    submitter = submitter or store_submitter(vector_store, **kwargs)
+    failed = submitter.submit(docs, ids)
+    s = submitter.stats
+    print(f"Submitted {len(docs) - len(failed)}/{len(docs)} chunks; {s['batches']} batches so far "
+          f"({s['retries']} retries, {s['throttled']} throttled, {s['splits']} splits, batch size {submitter.batch_size}).")
+    return failed
@@ -0,0 +1,60 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# In-memory LRU + TTL cache for retrieval results.
+# Identical task descriptions (e.g. repeated agent runs in one API process) are
+# answered without embedding the query or searching the collection again. Keys include
+# the collection version, so results computed before a re-ingestion are never served.
+
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("LK_SPG_RETRIEVAL_CACHE_SIZE", "256"))
+RETRIEVAL_CACHE_TTL = float(os.environ.get("LK_SPG_RETRIEVAL_CACHE_TTL", "600"))
+
+_SPACE_RE = re.compile(r'\s+')
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a query (both search paths are case-insensitive)."""
+    return _SPACE_RE.sub(" ", query).strip().lower()
+
+class ResultCache:
+    """Thread-safe LRU cache whose entries also expire ttl seconds after insertion."""
+
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -1,235 +1,321 @@
-from typing import List, Dict, Any
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
+from typing import List, Dict, Any, Callable, Iterator, Optional
 from langchain_core.documents import Document
+import itertools
 import os
 import re
-import git
 import subprocess
+from src.rag.bm25 import BM25Index, index_path, rebuild_index, reciprocal_rank_fusion
+from src.rag.chunking import CHUNKER_VERSION, chunk_commit, chunk_sections, pack_documents, split_iso_blocks
+from src.rag.commit_miner import COMMIT_LIMIT, MinedCommit, mine_commits, mine_commits_parallel
+from src.rag.flat_store import VECTOR_BACKEND, FlatVectorStore, export_chroma, flat_path, store_count
+from src.rag.manifest import FileState, SourceUpdate
+from src.rag.result_cache import ResultCache, normalize_query
 
 class CocciRetriever:
     def __init__(self, db_path: str = "./chroma_db"):
-        # Use Silicon Flow embeddings
-        from src.rag.embeddings import get_embedding_model
+        self.db_path = db_path
+        # Use Silicon Flow embeddings (or the local backend, see get_embedding_model)
+        from src.rag.embeddings import collection_name, get_embedding_model
         try:
              self.embeddings = get_embedding_model()
         except Exception as e:
              print(f"Failed to initialize embeddings: {e}")
-             print("Falling back to FakeEmbeddings for testing/offline support.")
-             # Simple Fake Embeddings
-             from langchain_core.embeddings import Embeddings
-             class FakeEmbeddings(Embeddings):
-                 def embed_documents(self, texts: List[str]) -> List[List[float]]:
-                     return [[0.0] * 1024 for _ in texts]
-                 def embed_query(self, text: str) -> List[float]:
-                     return [0.0] * 1024
-             self.embeddings = FakeEmbeddings()
-
-        self.vector_store = Chroma(
-            collection_name="cocci_patterns",
-            embedding_function=self.embeddings,
-            persist_directory=db_path
-        )
-        
+             print("Falling back to local hashed n-gram embeddings for offline support.")
+             from src.rag.local_embeddings import HashedNgramEmbeddings
+             self.embeddings = HashedNgramEmbeddings()
+        self.collection_name = collection_name(self.embeddings)
+
+        self._chroma: Any = None
+        self.vector_store = self._open_search_store()
+        self._bm25: Optional[BM25Index] = None
+        self._bm25_mtime: Optional[float] = None
+        self.result_cache = ResultCache()
+
+    @property
+    def chroma(self) -> Any:
+        """The Chroma collection ingestion writes to (opened on first use)."""
+        if self._chroma is None:
+            # Deferred: chromadb is the slowest import of the agent.
+            from langchain_chroma import Chroma
+            self._chroma = Chroma(
+                collection_name=self.collection_name,
+                embedding_function=self.embeddings,
+                persist_directory=self.db_path
+            )
+        return self._chroma
+
+    def _open_search_store(self) -> Any:
+        """The store searched by retrieve*: Chroma, or the flat index when LK_SPG_VECTOR_STORE=flat."""
+        if VECTOR_BACKEND == "flat":
+            path = flat_path(self.db_path, self.collection_name)
+            if os.path.exists(os.path.join(path, "meta.json")):
+                return FlatVectorStore(path, self.embeddings)
+            print(f"No flat index at {path}; searching Chroma until the next ingestion exports it.")
+        return self.chroma
+
+    @property
+    def bm25(self) -> Optional[BM25Index]:
+        """The keyword index of the collection, loaded on first use and reloaded after re-ingestion."""
+        path = index_path(self.db_path, self.collection_name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if self._bm25 is None or mtime != self._bm25_mtime:
+            self._bm25 = BM25Index.load(path)
+            self._bm25_mtime = mtime
+        return self._bm25
+
+    def _hybrid_search(self, query: str, k: int, doc_type: Optional[str] = None,
+                       embedding: Optional[List[float]] = None) -> List[Document]:
+        """
+        Dense (Chroma) and keyword (BM25) search fused with reciprocal-rank fusion.
+        Falls back to dense results only when no keyword index exists.
+
+        Args:
+            embedding: Precomputed query vector; the query is embedded here when omitted.
+        """
+        fetch_k = max(3 * k, 10)
+        search_filter = {"type": doc_type} if doc_type else None
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+        dense = self.vector_store.similarity_search_by_vector(embedding, k=fetch_k, filter=search_filter)
+        index = self.bm25
+        if index is None or any(d.id is None for d in dense):
+            return dense[:k]
+        keyword = [doc_id for doc_id, _ in index.search(query, k=fetch_k, doc_type=doc_type)]
+        fused = reciprocal_rank_fusion([[d.id for d in dense], keyword])[:k]
+
+        by_id = {d.id: d for d in dense}
+        missing = [i for i in fused if i not in by_id]
+        if missing:
+            found = self.vector_store.get(ids=missing, include=["documents", "metadatas"])
+            for doc_id, text, meta in zip(found["ids"], found["documents"], found["metadatas"]):
+                by_id[doc_id] = Document(id=doc_id, page_content=text, metadata=meta or {})
+        return [by_id[i] for i in fused if i in by_id]
+
+    def _collection_version(self) -> tuple:
+        """Changes whenever the collection is re-ingested (BM25 index rebuilt or chunk count changed)."""
+        self.bm25  # refreshes _bm25_mtime
+        return (self._bm25_mtime, store_count(self.vector_store))
+
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Embeds all queries in one call (without polluting the chunk embedding cache)."""
+        embed = getattr(self.embeddings, "embed_queries", None) or self.embeddings.embed_documents
+        return embed(queries)
+
+    def _structured_search(self, query: str, embedding: List[float], k: int) -> Dict[str, str]:
+        # Both type-filtered searches reuse the same query vector.
+        syntax_docs = self._hybrid_search(query, k=k, doc_type="syntax", embedding=embedding)
+        example_docs = self._hybrid_search(query, k=k, doc_type="example", embedding=embedding)
+        return {
+            "syntax_rules": "\n\n".join([d.page_content for d in syntax_docs]),
+            "examples": "\n\n".join([d.page_content for d in example_docs])
+        }
+
     def retrieve(self, query: str, k: int = 5) -> List[str]:
         """
         Retrieves top-k similar Coccinelle patterns for the given query.
         Returns a list of document contents.
         """
-        docs = self.vector_store.similarity_search(query, k=k)
+        docs = self._hybrid_search(query, k)
         return [doc.page_content for doc in docs]
 
     def retrieve_structured(self, query: str, k: int = 5) -> Dict[str, str]:
         """
         Retrieves knowledge separated by type (Syntax vs Examples).
+        Dense and keyword hits are fused, so exact API names are not missed.
+        The query is embedded once, and results are cached per normalized query, k and
+        collection version (see src/rag/result_cache.py).
         """
-        # Retrieve Syntax Rules
-        syntax_docs = self.vector_store.similarity_search(
-            query, 
-            k=3,
-            filter={"type": "syntax"}
-        )
-        
-        # Retrieve Examples
-        example_docs = self.vector_store.similarity_search(
-            query, 
-            k=3,
-            filter={"type": "example"}
-        )
-        
-        return {
-            "syntax_rules": "\n\n".join([d.page_content for d in syntax_docs]),
-            "examples": "\n\n".join([d.page_content for d in example_docs])
-        }
+        return self.retrieve_structured_many([query], k)[0]
 
-    def ingest_knowledge(self, kernel_dir: str, cocci_src_dir: str):
+    def retrieve_structured_many(self, queries: List[str], k: int = 5) -> List[Dict[str, str]]:
+        """
+        Batch form of retrieve_structured: all uncached queries are embedded in one call.
+
+        Args:
+            queries: Task descriptions.
+            k: Number of syntax rules and of examples returned per query.
+
+        Returns:
+            One {"syntax_rules", "examples"} dict per query, in order.
+        """
+        version = self._collection_version()
+        keys = [(normalize_query(q), k, version) for q in queries]
+        results: Dict[Any, Dict[str, str]] = {}
+        misses: Dict[Any, str] = {}
+        for key, query in zip(keys, queries):
+            if key in results or key in misses:
+                continue
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                results[key] = cached
+            else:
+                misses[key] = query
+
+        if misses:
+            embeddings = self._embed_queries(list(misses.values()))
+            for (key, query), embedding in zip(misses.items(), embeddings):
+                results[key] = self._structured_search(query, embedding, k)
+                self.result_cache.put(key, results[key])
+        return [dict(results[key]) for key in keys]
+
+    def ingest_knowledge(self, kernel_dir: str, cocci_src_dir: str, branch: str = "master"):
         """
         Ingests knowledge from standard files and git history.
+        Incremental: unchanged files are skipped and only commits newer than the last
+        ingested tip of the branch are mined (see src/rag/manifest.py).
         """
-        documents = []
+        from src.rag.manifest import IngestManifest
+        from src.rag.pipeline import ingest_stream
+
+        manifest = IngestManifest.for_store(self.db_path, self.collection_name)
+        if manifest.is_empty() and store_count(self.chroma) > 0:
+            print("Warning: existing collection has no ingestion manifest; chunks ingested before it are not tracked.")
+
+        # Files chunked by an older chunker are re-chunked even when unchanged.
+        rechunk = manifest.get_meta("chunker") != CHUNKER_VERSION
+        tasks = []
+        seen = set()
         
         # 1. Process standard.h and standard.iso
-        documents.extend(self._process_standard_files(
-            os.path.join(cocci_src_dir, "standard.h"),
-            os.path.join(cocci_src_dir, "standard.iso")
-        ))
-        
         # 2. Process cocci_syntax.tex
-        documents.extend(self._process_syntax_manual(
-            os.path.join(cocci_src_dir, "docs/manual/cocci_syntax.tex")
-        ))
+        syntax_sources = [
+            (os.path.join(cocci_src_dir, "standard.h"), parse_standard_h),
+            (os.path.join(cocci_src_dir, "standard.iso"), parse_standard_iso),
+            (os.path.join(cocci_src_dir, "docs/manual/cocci_syntax.tex"), parse_syntax_manual),
+        ]
+        for path, parse in syntax_sources:
+            if not os.path.exists(path):
+                continue
+            source_id = f"syntax:{os.path.abspath(path)}"
+            seen.add(source_id)
+            state = manifest.file_state(source_id, path, force=rechunk)
+            if state is not None:
+                tasks.append((syntax_update, (source_id, path, state, parse)))
+        removed = [s for s in manifest.source_ids("syntax") if s not in seen]
         
-        # 3. Process Commits
-        documents.extend(self._process_commits(kernel_dir))
-        
-        if documents:
-            # Custom splitter since langchain_text_splitters is missing
-            class SimpleCharacterTextSplitter:
-                def __init__(self, chunk_size, chunk_overlap):
-                    self.chunk_size = chunk_size
-                    self.chunk_overlap = chunk_overlap
-                
-                def split_documents(self, documents):
-                    new_docs = []
-                    # Assuming Document is imported in outer scope
-                    for doc in documents:
-                        text = doc.page_content
-                        if not text:
-                            continue
-                        start = 0
-                        text_len = len(text)
-                        chunk_index = 0
-                        while start < text_len:
-                            end = min(start + self.chunk_size, text_len)
-                            chunk_text = text[start:end]
-                            
-                            metadata = doc.metadata.copy() if doc.metadata else {}
-                            metadata["chunk"] = chunk_index
-                            new_docs.append(Document(page_content=chunk_text, metadata=metadata))
-                            
-                            if end == text_len:
-                                break
-                            start += (self.chunk_size - self.chunk_overlap)
-                            chunk_index += 1
-                    return new_docs
-
-            text_splitter = SimpleCharacterTextSplitter(
-                chunk_size=250,
-                chunk_overlap=50
+        # 3. Process Commits (only those after the last ingested tip), streamed from the miner
+        # The tip is kept per chunker version: without a tip for the current chunker, the
+        # whole branch is mined again and commits chunked by an older chunker are re-chunked.
+        tip_key = f"commit_tip:{CHUNKER_VERSION}:{os.path.abspath(kernel_dir)}:{branch}"
+        last_tip = manifest.get_meta(tip_key)
+        rechunk_commits = last_tip is None
+        if last_tip and not self._branch_head(kernel_dir, last_tip):
+            last_tip = None  # History was rewritten; already ingested commits are still skipped below
+        rev = f"{last_tip}..{branch}" if last_tip else branch
+        head = self._branch_head(kernel_dir, branch)
+        known = set() if rechunk_commits else set(manifest.source_ids("commit"))
+        commit_tasks = (
+            (commit_update, commit) for commit in self._mine_commits(kernel_dir, rev=rev)
+            if f"commit:{commit[0]}" not in known
+        )
+
+        from src.rag.rate_limit import store_submitter, submit_documents
+        # One submitter per run: its adapted batch size and backoff state span the windows.
+        submitter = store_submitter(self.chroma)
+        add_batches = lambda docs, ids: submit_documents(self.chroma, docs, ids, submitter=submitter)
+
+        stats = ingest_stream(self.chroma, manifest, itertools.chain(tasks, commit_tasks), removed, add_batches)
+        if stats["sources"] or stats["removed"] or stats["failed"]:
+            print(
+                f"Ingestion complete: {stats['added']} chunks added, {stats['deleted']} deleted, "
+                f"{stats['sources']} sources updated, {stats['removed']} removed, {stats['failed']} failed."
             )
-            split_docs = text_splitter.split_documents(documents)
-            print(f"Split {len(documents)} documents into {len(split_docs)} chunks.")
-            
-            print(f"Adding {len(split_docs)} documents to VectorDB...")
-            # Batch size limited to 32 by Silicon Flow API, reducing to 5
-            batch_size = 5
-            import time
-            for i in range(0, len(split_docs), batch_size):
-                batch = split_docs[i:i+batch_size]
-                try:
-                    self.vector_store.add_documents(batch)
-                    print(f"Ingested batch {i//batch_size + 1}/{(len(split_docs)-1)//batch_size + 1}")
-                    time.sleep(1.2) # Avoid RPM limit
-                except Exception as e:
-                     print(f"Error ingesting batch: {e}")
-            print("Ingestion complete.")
+            if hasattr(self.embeddings, "report"):
+                print(self.embeddings.report())
+            rebuild_index(self.chroma, self.db_path, self.collection_name)
         else:
-            print("No documents found to ingest.")
+            print("No new documents to ingest.")
+        if VECTOR_BACKEND == "flat" and (stats["sources"] or stats["removed"] or self.vector_store is self.chroma):
+            self.vector_store = export_chroma(self.chroma, flat_path(self.db_path, self.collection_name))
+        commits_ok = stats["failed"] == 0
 
-    def _process_standard_files(self, standard_h_path, standard_iso_path) -> List[Document]:
-        docs = []
-        
-        # standard.h
-        if os.path.exists(standard_h_path):
-            with open(standard_h_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            matches = re.findall(r'(#define\s+(\w+)\s*[^\n]*)', content)
-            for full_line, name in matches:
-                docs.append(Document(
-                    page_content=f"Standard Macro '{name}':\n```c\n{full_line.strip()}\n```",
-                    metadata={"type": "syntax", "source": "standard.h", "name": name}
-                ))
-
-        # standard.iso
-        if os.path.exists(standard_iso_path):
-            with open(standard_iso_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            iso_blocks = re.split(r'\n\n(?=Expression|Statement|Type|Declaration)', content)
-            for block in iso_blocks:
-                name_match = re.search(r'@\s*([\w_]+)\s*@', block)
-                if name_match:
-                    name = name_match.group(1)
-                    docs.append(Document(
-                        page_content=f"Isomorphism Rule '{name}':\n```\n{block.strip()}\n```",
-                        metadata={"type": "syntax", "source": "standard.iso", "name": name}
-                    ))
-        return docs
-
-    def _process_syntax_manual(self, tex_path) -> List[Document]:
-        if not os.path.exists(tex_path):
-            return []
-        
+        # Advance the commit tip only once every mined commit is stored, so failures are retried.
+        if head and commits_ok:
+            manifest.set_meta(tip_key, head)
+        if commits_ok:
+            manifest.set_meta("chunker", CHUNKER_VERSION)
+
+    def _branch_head(self, repo_path, branch) -> Optional[str]:
+        import git
         try:
-            md_content = subprocess.check_output(['pandoc', '-f', 'latex', '-t', 'markdown', tex_path]).decode('utf-8')
-        except (FileNotFoundError, subprocess.CalledProcessError):
-            print("Pandoc not found or failed. Skipping syntax manual.")
-            return []
-
-        docs = []
-        sections = re.split(r'\n#+\s+', md_content)
-        for sec in sections:
-            lines = sec.split('\n')
-            title = lines[0].strip()
-            body = "\n".join(lines[1:]).strip()
-            if len(body) > 20:
-                docs.append(Document(
-                    page_content=f"Syntax Guide - {title}:\n{body}",
-                    metadata={"type": "syntax", "source": "manual", "title": title}
-                ))
-        return docs
-
-    def _process_commits(self, repo_path, limit=500) -> List[Document]:
+            return git.Repo(repo_path).commit(branch).hexsha
+        except Exception:
+            return None
+
+    def _mine_commits(self, repo_path, limit=COMMIT_LIMIT, rev="master") -> Iterator[MinedCommit]:
+        """
+        Streams the Coccinelle-generated commits of `rev` (a branch, tag or range such as
+        "v6.0..v6.6"), mined in one `git log -p` pass (src/rag/commit_miner.py).
+        With limit=0 the whole range is mined by a process pool over sub-ranges.
+        """
+        import git
         try:
-            repo = git.Repo(repo_path)
+            git.Repo(repo_path)
         except:
             print("Invalid git repo path")
-            return []
+            return iter(())
+        return mine_commits(repo_path, rev, limit=limit) if limit else mine_commits_parallel(repo_path, rev)
 
-        docs = []
-        keywords = ["Generated by", "Generated using", "Generated with", "Coccinelle", "semantic patch"]
-        commits = repo.iter_commits('master', max_count=limit, grep=keywords, regexp_ignore_case=True)
-        
-        for commit in commits:
-            msg = commit.message
-            script_match = re.search(r'(@@.*?@@.*)', msg, re.DOTALL)
-            if not script_match:
-                script_match = re.search(r'//\s*<smpl>(.*?)//\s*</smpl>', msg, re.DOTALL)
-            
-            if script_match:
-                script_content = script_match.group(1).strip()
-                summary = msg.split('\n')[0]
-                
-                # Get the diff
-                try:
-                    diff_content = repo.git.show(commit.hexsha, pretty="", patch=True)
-                except Exception as e:
-                    print(f"Failed to get diff for {commit.hexsha}: {e}")
-                    diff_content = ""
-
-                content = f"""Intent: {summary}
-Reference Commit: {commit.hexsha}
-
-Coccinelle Script:
-```cocci
-{script_content}
-```
-
-Commit Diff:
-```diff
-{diff_content}
-```"""
-                docs.append(Document(
-                    page_content=content,
-                    metadata={"type": "example", "commit": commit.hexsha}
-                ))
-        return docs
+# Parse stage of ingest_knowledge: module-level so the pipeline can run them in worker processes.
+
+def parse_standard_h(path: str) -> List[Document]:
+    """One Document per macro of standard.h."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    matches = re.findall(r'(#define\s+(\w+)\s*[^\n]*)', content)
+    return [
+        Document(
+            page_content=f"Standard Macro '{name}':\n```c\n{full_line.strip()}\n```",
+            metadata={"type": "syntax", "source": "standard.h", "name": name}
+        )
+        for full_line, name in matches
+    ]
+
+def parse_standard_iso(path: str) -> List[Document]:
+    """One Document per isomorphism of standard.iso."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    return [
+        Document(
+            page_content=f"Isomorphism Rule '{name}':\n```\n{block.strip()}\n```",
+            metadata={"type": "syntax", "source": "standard.iso", "name": name}
+        )
+        for name, block in split_iso_blocks(content)
+    ]
+
+def parse_syntax_manual(tex_path: str) -> List[Document]:
+    """The SmPL manual converted by pandoc, chunked per section."""
+    if not os.path.exists(tex_path):
+        return []
+    
+    try:
+        md_content = subprocess.check_output(['pandoc', '-f', 'latex', '-t', 'markdown', tex_path]).decode('utf-8')
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        print("Pandoc not found or failed. Skipping syntax manual.")
+        return []
+
+    sections = []
+    for sec in re.split(r'\n#+\s+', md_content):
+        lines = sec.split('\n')
+        title = lines[0].strip()
+        body = "\n".join(lines[1:]).strip()
+        if len(body) > 20:
+            sections.append((title, body))
+    return chunk_sections(sections, {"type": "syntax", "source": "manual"})
+
+def syntax_update(source_id: str, path: str, state: FileState, parse: Callable[[str], List[Document]]) -> SourceUpdate:
+    docs = parse(path)
+    # The manual is already chunked per section; standard.h / standard.iso units are packed.
+    chunks = docs if parse is parse_syntax_manual else pack_documents(docs)
+    return SourceUpdate(source_id, "syntax", chunks, path, state)
+
+def commit_update(sha: str, summary: str, script: str, diff: str) -> SourceUpdate:
+    chunks = chunk_commit(summary, sha, script, diff, {"type": "example", "commit": sha})
+    return SourceUpdate(f"commit:{sha}", "commit", chunks)
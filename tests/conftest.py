@@ -0,0 +1,15 @@
+import os
+import tempfile
+import pytest
+
+# Caches opened while the test modules are imported (before any fixture runs) stay out of
+# the developer's cache too.
+os.environ["LK_SPG_CACHE_DIR"] = tempfile.mkdtemp(prefix="lk-spg-tests-")
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Every cache (spatch results, indexes, embeddings, LLM responses) goes to the test's
+    # tmp dir instead of ~/.cache/lk-spg.
+    path = tmp_path / "cache"
+    monkeypatch.setenv("LK_SPG_CACHE_DIR", str(path))
+    return path
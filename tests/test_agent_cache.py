@@ -0,0 +1,102 @@
+import asyncio
+from src.agent.speculative import speculative_draft
+
+def test_llm_response_cache_exact_semantic_and_eviction(tmp_path):
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from src.agent.llm_cache import LLMResponseCache
+
+    class KeywordEmbeddings(Embeddings):
+        # Prompts about the same API embed to the same direction.
+        def embed_documents(self, texts):
+            return [self.embed_query(t) for t in texts]
+        def embed_query(self, text):
+            return [float("usb_alloc_urb" in text), float("kmalloc" in text), 0.1]
+
+    db = str(tmp_path / "llm.sqlite3")
+    cache = LLMResponseCache(db, max_entries=2, embeddings=KeywordEmbeddings(), similarity=0.95)
+    llm = FakeListChatModel(responses=["first", "second", "third"], cache=cache)
+    assert llm.invoke("Migrate usb_alloc_urb on v6.1").content == "first"
+    assert llm.invoke("Migrate usb_alloc_urb on v6.1").content == "first"
+    # A resubmission against another branch is close enough for the semantic tier.
+    assert llm.invoke("Migrate usb_alloc_urb on v6.6").content == "first"
+    assert llm.invoke("Convert kmalloc calls").content == "second"
+    assert cache.stats() == {
+        "exact_hits": 1, "semantic_hits": 1, "misses": 2, "hit_rate": 0.5, "entries": 2, "max_entries": 2
+    }
+
+    # Entries survive a restart; the least recently used one is evicted past the bound.
+    cache = LLMResponseCache(db, max_entries=2)
+    llm = FakeListChatModel(responses=["first", "second", "third"], cache=cache)
+    assert llm.invoke("Migrate usb_alloc_urb on v6.1").content == "first"
+    assert cache.stats()["exact_hits"] == 1
+    llm.invoke("Rename a field")
+    assert cache.stats()["entries"] == 2
+    llm.invoke("Convert kmalloc calls")
+    assert cache.stats()["misses"] == 2
+
+def test_llm_response_cache_discards_failed_drafts(tmp_path, monkeypatch):
+    import asyncio
+    from langchain_core.embeddings import Embeddings
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from src.agent import llm_cache
+    from src.agent.speculative import speculative_draft
+
+    class KeywordEmbeddings(Embeddings):
+        def embed_documents(self, texts):
+            return [self.embed_query(t) for t in texts]
+        def embed_query(self, text):
+            return [float("usb_alloc_urb" in text), float("kmalloc" in text), 0.1]
+
+    cache = llm_cache.LLMResponseCache(str(tmp_path / "llm.sqlite3"), embeddings=KeywordEmbeddings(), similarity=0.95)
+    llm = FakeListChatModel(responses=["not json", '{"cocci_script": "@@ @@", "mock_c": "int x;"}'], cache=cache)
+    prompt = "Migrate usb_alloc_urb on v6.1"
+    assert llm.invoke(prompt).content == "not json"
+    # The failed draft is evicted, so the retry asks the model again.
+    llm_cache.discard_response(llm, prompt)
+    assert llm.invoke(prompt).content.startswith("{")
+    # A semantic hit is discarded through the prompt it answered.
+    assert llm.invoke("Migrate usb_alloc_urb on v6.6").content.startswith("{")
+    assert cache.stats()["semantic_hits"] == 1
+    assert cache.discard("Migrate usb_alloc_urb on v6.6") and not cache.discard(prompt)
+    assert cache.stats()["entries"] == 0 and all(not keys for keys, _ in cache._vectors.values())
+
+    # Stored prompt vectors join the in-memory matrix without reloading it.
+    llm.invoke(prompt)
+    (keys, matrix), = cache._vectors.values()
+    assert len(keys) == 1 and matrix.shape == (1, 3)
+
+    # Embeddings of lookups that never store a response are bounded.
+    monkeypatch.setattr(llm_cache, "PENDING_VECTORS_MAX", 2)
+    for n in range(5):
+        cache.lookup(f"kmalloc prompt {n}", "other-model")
+    assert len(cache._pending_vectors) == 2
+
+    # Speculative candidates that fail validation are not replayed by the next iteration.
+    llm = FakeListChatModel(responses=["not json"], cache=cache)
+    result = asyncio.run(speculative_draft(llm, "Convert kmalloc calls", k=2))
+    assert result["winner"] is None and result["attempts"] == 2
+    assert cache.stats()["entries"] == 1  # Only the draft stored above
+
+def test_feasibility_parse_failure_is_not_replayed(tmp_path):
+    from unittest.mock import patch
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from src.agent import nodes
+    from src.agent.llm_cache import LLMResponseCache
+
+    db = str(tmp_path / "llm.sqlite3")
+    state = {"user_request": "Convert kmalloc + memset to kzalloc"}
+    llm = FakeListChatModel(responses=["not json"], cache=LLMResponseCache(db))
+    with patch("src.agent.nodes.get_shared_llm", return_value=llm):
+        assert nodes.analyze_feasibility(state)["strategy"] == "LLM_DIRECT"
+    # A later run (another process: a fresh cache over the same file) asks the model again.
+    llm = FakeListChatModel(responses=['{"strategy": "COCCI"}'], cache=LLMResponseCache(db))
+    with patch("src.agent.nodes.get_shared_llm", return_value=llm):
+        assert nodes.analyze_feasibility(state)["strategy"] == "COCCI"
+        assert nodes.analyze_feasibility(state)["strategy"] == "COCCI"
+    assert llm.cache.stats()["exact_hits"] == 1
+
+    # A response served by one instance is discarded through another.
+    assert llm.invoke("Use kzalloc").content == '{"strategy": "COCCI"}'
+    assert LLMResponseCache(db).discard("Use kzalloc")
+    assert not llm.cache.discard("Use kzalloc")
@@ -1,5 +1,7 @@
+import json
 import os
 os.environ["OPENAI_API_KEY"] = "dummy"
+os.environ.setdefault("LK_SPG_CHECKPOINT_DB", ":memory:")
 from fastapi.testclient import TestClient
 from src.api.server import app
 from unittest.mock import MagicMock, patch
@@ -11,9 +13,11 @@ def test_health():
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
 
-@patch("src.api.server.agent_app")
-def test_run_agent(mock_agent_app):
+@patch("src.api.server.get_agent_app")
+def test_run_agent(mock_get_agent_app):
     # Mock the agent response
+    mock_agent_app = mock_get_agent_app.return_value
+    mock_agent_app.checkpointer = None
     mock_agent_app.invoke.return_value = {
         "status": "success",
         "cocci_script": "@@...@@",
@@ -27,6 +31,215 @@ def test_run_agent(mock_agent_app):
     assert data["status"] == "success"
     assert data["cocci_script"] == "@@...@@"
 
+@patch("src.api.server.tree_dry_run")
+def test_tree_dry_run_streams_ndjson(mock_tree_dry_run, tmp_path):
+    mock_tree_dry_run.return_value = iter([
+        {"event": "start", "candidates": 1},
+        {"event": "file", "file": "a.c", "diff": "--- a/a.c", "hunks": 1, "counts": {"files_matched": 1}},
+        {"event": "done", "counts": {"files_matched": 1}},
+    ])
+    response = client.post("/dry-run/tree", json={"script": "@@ @@", "kernel_dir": str(tmp_path)})
+    assert response.status_code == 200
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert [e["event"] for e in events] == ["start", "file", "done"]
+
+    response = client.post("/dry-run/tree", json={"script": "@@ @@", "kernel_dir": str(tmp_path / "missing")})
+    assert response.status_code == 400
+
+def test_lazy_startup_and_warm_up(monkeypatch):
+    from src.agent import graph, runtime
+
+    # Importing the API builds neither the LLM nor the retriever.
+    assert client.get("/ready").json()["built"] == {"llm": False, "retriever": False, "tools": False}
+    # Nor does it open the checkpoint database or compile the graphs.
+    assert not graph._checkpointer.built and not graph._app.built
+
+    retriever = MagicMock()
+    monkeypatch.setenv("LK_SPG_JOBS_DB", ":memory:")
+    with patch("src.agent.runtime._build_retriever", return_value=retriever):
+        with TestClient(app):  # runs the startup warm-up
+            report = client.get("/ready").json()
+        assert runtime.get_retriever() is retriever
+    assert report["warmed_up"] and report["built"] == {"llm": True, "retriever": True, "tools": True}
+    assert report["timings"]["import_to_ready"] >= report["timings"]["retriever"]
+    runtime._retriever.reset()
+
+def _wait_for(predicate, timeout=5.0):
+    import time
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_jobs_submit_poll_stream(tmp_path, monkeypatch):
+    from src.api import server
+
+    monkeypatch.setenv("LK_SPG_JOBS_DB", str(tmp_path / "jobs.sqlite3"))
+    server._jobs.reset()
+    agent = MagicMock()
+    agent.stream.return_value = iter([
+        ((), "updates", {"analyze_feasibility": {"strategy": "COCCI"}}),
+        ((), "updates", {"spg_agent": {"status": "success", "final_diff": "+ code"}}),
+    ])
+    with patch("src.api.server.get_agent_app", return_value=agent):
+        job_id = client.post("/jobs", json={"request": "test request"}).json()["job_id"]
+        _wait_for(lambda: client.get(f"/jobs/{job_id}").json()["status"] == "succeeded")
+    job = client.get(f"/jobs/{job_id}").json()
+    assert job["result"]["status"] == "success" and job["request"]["request"] == "test request"
+
+    events = [json.loads(line) for line in client.get(f"/jobs/{job_id}/events").text.splitlines()]
+    assert [e["event"] for e in events] == ["queued", "started", "node", "node", "succeeded"]
+    assert events[3]["data"]["node"] == "spg_agent"
+    assert events[3]["data"]["update"] == {"status": "success", "final_diff": "+ code"}
+    assert client.get(f"/jobs/{job_id}/events", params={"after": 4}).text.count("\n") == 1
+    assert client.get("/jobs/missing").status_code == 404
+    server.get_job_manager().shutdown()
+    server._jobs.reset()
+
+def _parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+def test_agent_stream_sse():
+    from typing import TypedDict
+    from langgraph.graph import END, START, StateGraph
+    from src.agent.progress import report_progress
+
+    class State(TypedDict, total=False):
+        status: str
+        cocci_script: str
+
+    def draft(state):
+        report_progress("candidate", index=0)
+        return {"cocci_script": "@@ @@"}
+
+    sub = StateGraph(State)
+    sub.add_node("architect_draft", draft)
+    sub.add_edge(START, "architect_draft")
+    sub.add_edge("architect_draft", END)
+    graph = StateGraph(State)
+    graph.add_node("analyze_feasibility", lambda state: {"status": "feasible"})
+    graph.add_node("spg_agent", sub.compile())
+    graph.add_edge(START, "analyze_feasibility")
+    graph.add_edge("analyze_feasibility", "spg_agent")
+    graph.add_edge("spg_agent", END)
+
+    with patch("src.api.server.get_agent_app", return_value=graph.compile()):
+        response = client.post("/agent/stream", json={"request": "test request"})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _parse_sse(response.text)
+    assert [(e, d.get("node") or d.get("data", {}).get("stage")) for e, d in events] == [
+        ("start", None), ("node", "analyze_feasibility"), ("progress", "candidate"),
+        ("node", "architect_draft"), ("node", "spg_agent"), ("done", None),
+    ]
+    assert events[3][1]["namespace"] == ["spg_agent"] and events[3][1]["update"] == {"cocci_script": "@@ @@"}
+    assert all(d["duration"] >= 0 for e, d in events if e == "node")
+    assert events[-1][1]["result"]["cocci_script"] == "@@ @@"
+
+def test_run_resumes_from_checkpoint_and_replays_history():
+    from typing import TypedDict
+    from langgraph.graph import END, START, StateGraph
+    from src.agent.checkpoint import open_checkpointer
+    from src.api import server
+
+    class State(TypedDict, total=False):
+        user_request: str
+        status: str
+        cocci_script: str
+
+    calls = []
+    def node(name, update, fail=False):
+        def run(state):
+            calls.append(name)
+            if fail and calls.count(name) == 1:
+                raise RuntimeError("spatch timed out")
+            return update
+        return run
+
+    checkpointer = open_checkpointer(":memory:")
+    sub = StateGraph(State)
+    sub.add_node("architect_draft", node("architect_draft", {"cocci_script": "@@ @@"}))
+    sub.add_node("dry_run", node("dry_run", {"status": "success"}, fail=True))
+    sub.add_edge(START, "architect_draft")
+    sub.add_edge("architect_draft", "dry_run")
+    sub.add_edge("dry_run", END)
+    spg = sub.compile(checkpointer=checkpointer)
+    graph = StateGraph(State)
+    graph.add_node("analyze_feasibility", node("analyze_feasibility", {"status": "feasible"}))
+    graph.add_node("spg_agent", lambda state: spg.invoke({"user_request": state["user_request"]}))
+    graph.add_edge(START, "analyze_feasibility")
+    graph.add_edge("analyze_feasibility", "spg_agent")
+    graph.add_edge("spg_agent", END)
+
+    with patch("src.api.server.get_agent_app", return_value=graph.compile(checkpointer=checkpointer)):
+        body = {"request": "test request", "thread_id": "run-1"}
+        assert client.post("/agent/run", json=body).status_code == 500
+        # The retry resumes inside the subgraph: nothing before the failed node runs again.
+        data = client.post("/agent/run", json=body).json()
+        assert data["status"] == "success" and data["thread_id"] == "run-1"
+        assert calls == ["analyze_feasibility", "architect_draft", "dry_run", "dry_run"]
+
+        history = client.get("/runs/run-1/history").json()
+        assert client.get("/runs/missing/history").status_code == 404
+
+        # A finished run is not restarted on top of its old channel values.
+        assert client.post("/agent/run", json=body).status_code == 409
+        assert client.post("/agent/stream", json=body).status_code == 409
+        # A job recovered after its run finished reports that run's result.
+        result = server.run_agent_job({"request": "test request", "job_id": "run-1"}, lambda *a: None)
+        assert result["status"] == "success" and result["thread_id"] == "run-1"
+    assert calls.count("dry_run") == 2
+    drafted = [h for h in history if h["namespace"] == ["spg_agent"] and h["next"] == ["dry_run"]]
+    assert drafted[0]["values"]["cocci_script"] == "@@ @@"
+    assert history[-1]["namespace"] == [] and history[-1]["values"]["status"] == "success"
+
+def test_job_cancel_and_restart_recovery(tmp_path):
+    import threading
+    from src.api.jobs import JobManager, JobStore
+
+    release = threading.Event()
+    def runner(request, emit):
+        emit("node", {"node": "first"})
+        release.wait(5)
+        emit("node", {"node": "second"})
+        return {"status": "success"}
+
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    manager = JobManager(runner, store, max_workers=1)
+    running, queued = manager.submit({"request": "a"}), manager.submit({"request": "b"})
+    _wait_for(lambda: store.get(running)["status"] == "running")
+    assert manager.cancel(queued) == "cancelled"
+    assert manager.cancel(running) == "running"
+    release.set()
+    _wait_for(lambda: store.get(running)["status"] == "cancelled")
+    assert [e["event"] for e in store.events(running)][-2:] == ["node", "cancelled"]
+    manager.shutdown()
+
+    # A job left running by a stopped server is queued again on the next start.
+    orphan = store.create({"request": "c"})
+    store.set_status(orphan, "running")
+    manager = JobManager(runner, JobStore(store.db_path), max_workers=1)
+    assert manager.recover() == [orphan]
+    _wait_for(lambda: manager.store.get(orphan)["status"] == "succeeded")
+    manager.shutdown()
+
+    # Shutting down stops a running job at its next event, leaving it to the next start.
+    release.clear()
+    manager = JobManager(runner, JobStore(store.db_path), max_workers=1)
+    interrupted = manager.submit({"request": "d"})
+    _wait_for(lambda: manager.store.get(interrupted)["status"] == "running")
+    manager.shutdown()
+    release.set()
+    _wait_for(lambda: manager.store.events(interrupted)[-1]["event"] == "interrupted")
+    assert manager.store.get(interrupted)["status"] == "running"
+    manager = JobManager(runner, JobStore(store.db_path), max_workers=1)
+    assert manager.recover() == [interrupted]
+    _wait_for(lambda: manager.store.get(interrupted)["status"] == "succeeded")
+    manager.shutdown()
+
 if __name__ == "__main__":
     test_health()
     test_run_agent()
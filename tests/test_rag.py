@@ -0,0 +1,390 @@
+import os
+import subprocess
+import textwrap
+import pytest
+from langchain_core.documents import Document
+from src.rag.bm25 import BM25Index, reciprocal_rank_fusion, tokenize_c
+from src.rag.chunking import chunk_commit, chunk_cocci, split_cocci_rules, split_iso_blocks
+from src.rag.manifest import IngestManifest, SourceUpdate
+from src.rag.embedding_cache import CachedEmbeddings, EmbeddingCache
+from src.rag.local_embeddings import HashedNgramEmbeddings
+from src.rag.rate_limit import EmbeddingSubmitter, RateLimiter
+
+class _CountingEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t)), 0.5, -1.0] for t in texts]
+
+def test_embedding_cache_serves_unchanged_chunks(tmp_path):
+    inner = _CountingEmbeddings()
+    cache = EmbeddingCache("test/model", cache_dir=str(tmp_path))
+    embeddings = CachedEmbeddings(inner, model="test/model", cache=cache)
+    assert embeddings.embed_documents(["a", "bb", "a"]) == [[1.0, 0.5, -1.0], [2.0, 0.5, -1.0], [1.0, 0.5, -1.0]]
+    assert inner.calls == [["a", "bb"]]
+
+    # A new process (fresh instances over the same files) only embeds new text.
+    reopened = CachedEmbeddings(inner, model="test/model", cache=EmbeddingCache("test/model", cache_dir=str(tmp_path)))
+    assert reopened.embed_documents(["bb", "ccc"]) == [[2.0, 0.5, -1.0], [3.0, 0.5, -1.0]]
+    assert inner.calls[-1] == ["ccc"]
+    assert reopened.stats()["hits"] == 1 and reopened.stats()["entries"] == 3
+
+def test_embedding_cache_shared_by_two_writers(tmp_path):
+    # Both instances open the (empty) cache before either writes, like two ingest processes.
+    first = EmbeddingCache("test/model", cache_dir=str(tmp_path))
+    second = EmbeddingCache("test/model", cache_dir=str(tmp_path))
+    first.put_many({"a": [1.0, 0.0]})
+    second.put_many({"b": [2.0, 0.0], "a": [1.0, 0.0]})
+    with open(first.array_path, "ab") as f:
+        f.write(b"\0" * 3)  # tail of a writer that crashed before committing
+    first.put_many({"c": [3.0, 0.0]})
+    for cache in (first, second, EmbeddingCache("test/model", cache_dir=str(tmp_path))):
+        assert cache.get_many(["a", "b", "c"]) == {"a": [1.0, 0.0], "b": [2.0, 0.0], "c": [3.0, 0.0]}
+    assert len(first) == 3
+
+class _FakeStore:
+    def __init__(self):
+        self.docs = {}
+
+    def delete(self, ids):
+        for i in ids:
+            self.docs.pop(i, None)
+
+    def add(self, docs, ids):
+        failed = {i for d, i in zip(docs, ids) if "FAIL" in d.page_content}
+        self.docs.update({i: d for d, i in zip(docs, ids) if i not in failed})
+        return failed
+
+def test_manifest_sync_is_incremental(tmp_path):
+    from src.rag.pipeline import ingest_stream
+
+    manifest = IngestManifest.for_store(str(tmp_path / "db"))
+    store = _FakeStore()
+    a, b = tmp_path / "a.cocci", tmp_path / "b.cocci"
+    a.write_text("rule a")
+    b.write_text("rule b")
+
+    def run(paths):
+        tasks, seen = [], set()
+        for path in paths:
+            source_id = f"file:{path}"
+            seen.add(source_id)
+            state = manifest.file_state(source_id, str(path))
+            if state is not None:
+                tasks.append((SourceUpdate, (source_id, "cocci", [Document(page_content=path.read_text())], str(path), state)))
+        removed = [s for s in manifest.source_ids("cocci") if s not in seen]
+        return ingest_stream(store, manifest, tasks, removed, store.add, parse_workers=0)
+
+    assert run([a, b])["added"] == 2
+    assert run([a, b]) == {"added": 0, "deleted": 0, "sources": 0, "removed": 0, "failed": 0}
+
+    b.write_text("rule b v2")
+    stats = run([a, b])
+    assert (stats["added"], stats["deleted"], stats["sources"]) == (1, 1, 1)
+    assert sorted(d.page_content for d in store.docs.values()) == ["rule a", "rule b v2"]
+
+    # Removed sources lose their chunks; failed ones are retried on the next run.
+    a.write_text("rule a FAIL")
+    stats = run([a])
+    assert (stats["removed"], stats["failed"]) == (1, 1)
+    assert list(store.docs.values()) == []
+    a.write_text("rule a fixed")
+    assert run([a])["sources"] == 1
+    assert [d.page_content for d in store.docs.values()] == ["rule a fixed"]
+
+class _ThrottledError(Exception):
+    status_code = 429
+
+def test_embedding_submitter_retries_and_adapts():
+    stored, throttled = {}, []
+
+    def add(docs, ids):
+        if len(ids) > 4:
+            raise ValueError("input batch too large")
+        if not throttled:
+            throttled.append(ids)
+            raise _ThrottledError("rate limited")
+        if "poison" in ids:
+            raise RuntimeError("bad chunk")
+        stored.update(zip(ids, docs))
+
+    ids = [f"c{i}" for i in range(20)] + ["poison"]
+    docs = [Document(page_content=f"chunk {i}") for i in ids]
+    submitter = EmbeddingSubmitter(add, RateLimiter(1e6, 1e9), concurrency=3, batch_size=8, max_retries=3, base_delay=0.001)
+    failed = submitter.submit(docs, ids)
+
+    # Only the chunk that keeps failing is reported; its batch neighbours are isolated and stored.
+    assert failed == {"poison"}
+    assert set(stored) == set(ids) - {"poison"}
+    assert submitter.stats["splits"] >= 1 and submitter.stats["throttled"] == 1
+    assert submitter.batch_size <= 4
+
+    # A batch that is still throttled after its last retry fails whole instead of being split.
+    calls = []
+    def always_throttled(docs, ids):
+        calls.append(ids)
+        raise _ThrottledError("rate limited")
+    submitter = EmbeddingSubmitter(always_throttled, RateLimiter(1e6, 1e9), concurrency=1, batch_size=4, max_retries=2, base_delay=0.001)
+    assert submitter.submit(docs[:4], ids[:4]) == set(ids[:4])
+    assert len(calls) == 2 and submitter.stats["splits"] == 0
+
+def test_rate_limiter_charges_batches_above_capacity():
+    import time
+    from types import SimpleNamespace
+    from src.rag.rate_limit import store_submitter, submit_documents
+
+    # 60000 tokens/min = 1000 tokens/s with a one-second burst of 1000 tokens.
+    limiter = RateLimiter(requests_per_minute=1e6, tokens_per_minute=60000)
+    started = time.monotonic()
+    limiter.acquire(1500)  # 500 tokens over the burst: half a second of debt
+    assert 0.45 <= time.monotonic() - started < 0.9
+    limiter.acquire(100)   # The debt is paid: the bucket is empty, not negative
+    assert 0.5 <= time.monotonic() - started < 1.0
+
+    # One submitter per ingestion run keeps its adapted batch size across windows.
+    batches = []
+    def add_documents(docs, ids):
+        batches.append(len(ids))
+        if len(ids) > 2:
+            raise ValueError("input batch too large")
+    store = SimpleNamespace(add_documents=add_documents)
+    submitter = store_submitter(store, limiter=RateLimiter(1e6, 1e9), concurrency=1, batch_size=8)
+    docs = [Document(page_content="x") for _ in range(8)]
+    submit_documents(store, docs, [f"a{i}" for i in range(8)], submitter=submitter)
+    batches.clear()
+    submit_documents(store, docs, [f"b{i}" for i in range(8)], submitter=submitter)
+    # The second window starts from the shrunk batch size instead of 8.
+    assert batches[0] < 8
+
+def test_structure_aware_chunking():
+    cocci = textwrap.dedent("""\
+        /// Use new_api() instead of old_api().
+        virtual patch
+
+        @r@
+        expression E;
+        @@
+        - old_api(E)
+        + new_api(E)
+
+        // Report leftovers.
+        @script:python depends on r@
+        @@
+        print("done")
+        """)
+    docs = chunk_cocci(cocci, {"source": "x.cocci"})
+    assert len(docs) == 1 and docs[0].metadata["rules"] == "r, script:python"
+    assert docs[0].page_content.startswith("/// Use new_api()")
+    description, rules = split_cocci_rules(cocci)
+    assert [label for label, _ in rules] == ["r", "script:python"]
+    assert rules[1][1].startswith("// Report leftovers.")
+    _, rules = split_cocci_rules("virtual context\n@ depends on context @\nexpression E;\n@@\n* old_api(E)\n")
+    assert [label for label, _ in rules] == ["(anonymous)"]
+    # A tight budget keeps rules whole rather than cutting windows through them.
+    assert [d.metadata["rules"] for d in chunk_cocci(cocci, {}, budget=36)] == ["r", "script:python"]
+
+    iso = "// comment\nExpression\n@ a @\nexpression E;\n@@\n E => (E)\n\nType\n@ b @\n@@\nint => signed int\n"
+    assert [name for name, _ in split_iso_blocks(iso)] == ["a", "b"]
+
+    diff = ("diff --git a/x.c b/x.c\n--- a/x.c\n+++ b/x.c\n@@ -1 +1 @@\n-old_api(1);\n+new_api(1);\n"
+            "diff --git a/y.c b/y.c\n--- a/y.c\n+++ b/y.c\n@@ -1 +1 @@\n-old_api(2);\n+new_api(2);\n")
+    docs = chunk_commit("use new_api", "abc123", "@@ @@", diff, {"commit": "abc123"}, budget=48)
+    assert [d.metadata["part"] for d in docs] == ["script", "diff", "diff"]
+    assert [d.metadata.get("files") for d in docs[1:]] == ["x.c", "y.c"]
+    assert all("Reference Commit: abc123" in d.page_content for d in docs)
+
+def test_local_embeddings_ingest_and_retrieve(tmp_path, monkeypatch):
+    from src.rag.ingest import ingest_data
+    from src.rag.retriever import CocciRetriever
+
+    monkeypatch.setenv("LK_SPG_EMBEDDINGS", "local")
+    rules = tmp_path / "kernel" / "coccinelle" / "api"
+    rules.mkdir(parents=True)
+    (rules / "kzalloc.cocci").write_text("/// Use kzalloc rather than kmalloc followed by memset with 0\n@@\nexpression x;\n@@\n- kmalloc(x)\n+ kzalloc(x)\n")
+    (rules / "array_size.cocci").write_text("/// Use ARRAY_SIZE instead of dividing sizeof array with sizeof an element\n@@\ntype T;\nT[] E;\n@@\n- (sizeof(E)/sizeof(E[0]))\n+ ARRAY_SIZE(E)\n")
+
+    embeddings = HashedNgramEmbeddings()
+    a, b = embeddings.embed_documents(["kmalloc then memset", "ARRAY_SIZE of E"])
+    assert len(a) == 1024 and abs(sum(x * x for x in a) - 1.0) < 1e-4
+    assert embeddings.embed_query("kmalloc then memset") == a
+
+    db = str(tmp_path / "db")
+    ingest_data(str(tmp_path / "kernel"), db)
+    retriever = CocciRetriever(db_path=db)
+    assert retriever.collection_name == "cocci_patterns_local"
+    assert retriever.bm25 is not None and len(retriever.bm25) == 2
+    assert "kzalloc" in retriever.retrieve("replace kmalloc + memset by kzalloc", k=1)[0]
+    assert "ARRAY_SIZE" in retriever.retrieve("use the ARRAY_SIZE macro", k=1)[0]
+
+def test_bm25_index_and_fusion(tmp_path):
+    assert tokenize_c("usb_alloc_urb(urb->dev, cfg.flags)") == [
+        "usb_alloc_urb", "usb", "alloc", "urb", "urb->dev", "->dev", "urb", "dev", "cfg.flags", ".flags", "cfg", "flags"
+    ]
+    index = BM25Index.build([
+        ("a", "usb_alloc_urb(0, GFP_KERNEL) allocates an urb", "example"),
+        ("b", "kmalloc followed by memset becomes kzalloc", "example"),
+        ("c", "usb_alloc_urb iso rule", "syntax"),
+    ])
+    path = str(tmp_path / "bm25.npz")
+    index.save(path)
+    index = BM25Index.load(path)
+    # "a" also matches the gfp part of GFP_KERNEL.
+    assert [i for i, _ in index.search("usb_alloc_urb now takes gfp_flags")] == ["a", "c"]
+    assert [i for i, _ in index.search("usb_alloc_urb", doc_type="example")] == ["a"]
+    assert index.search("nothing matches") == []
+    assert reciprocal_rank_fusion([["x", "y"], ["y", "z"]]) == ["y", "x", "z"]
+
+def test_retrieve_structured_embeds_once_and_caches(tmp_path, monkeypatch):
+    from langchain_core.documents import Document
+    from src.rag.retriever import CocciRetriever
+
+    monkeypatch.setenv("LK_SPG_EMBEDDINGS", "local")
+    retriever = CocciRetriever(db_path=str(tmp_path / "db"))
+    retriever.vector_store.add_documents([
+        Document(page_content="- kmalloc(x)\n+ kzalloc(x)", metadata={"type": "example"}),
+        Document(page_content="@@ expression x; @@ declares a metavariable", metadata={"type": "syntax"}),
+    ])
+
+    calls = []
+    embed_documents = retriever.embeddings.embed_documents
+    monkeypatch.setattr(retriever.embeddings, "embed_documents", lambda texts: calls.append(list(texts)) or embed_documents(texts))
+    monkeypatch.setattr(retriever.embeddings, "embed_query", lambda text: pytest.fail("query embedded separately"))
+
+    first, second, again = retriever.retrieve_structured_many(["Use kzalloc", "ARRAY_SIZE", "  use KZALLOC "])
+    assert calls == [["Use kzalloc", "ARRAY_SIZE"]]
+    assert "kzalloc" in first["examples"] and "metavariable" in first["syntax_rules"] and again == first
+    assert retriever.retrieve_structured("use kzalloc") == first
+    assert len(calls) == 1 and retriever.result_cache.hits == 1
+
+    # k bounds the hits of each type and is part of the cache key.
+    retriever.vector_store.add_documents([Document(page_content="- kmalloc(n)\n+ kcalloc(n)", metadata={"type": "example"})])
+    assert retriever.retrieve_structured("use kzalloc", k=1)["examples"].count("+ k") == 1
+    assert retriever.retrieve_structured("use kzalloc", k=2)["examples"].count("+ k") == 2
+
+def test_ingest_knowledge_rechunks_commits_after_chunker_change(tmp_path, monkeypatch):
+    import sqlite3
+    from src.rag import retriever as retriever_module
+    from src.rag.manifest import IngestManifest
+
+    monkeypatch.setenv("LK_SPG_EMBEDDINGS", "local")
+    repo = str(tmp_path / "repo")
+    git = lambda *args: subprocess.run(["git", "-C", repo, *args], check=True, capture_output=True, text=True).stdout.strip()
+    os.makedirs(repo)
+    git("init", "-q", "-b", "master")
+    (tmp_path / "repo" / "f.c").write_text("int f;\n")
+    git("add", ".")
+    git("-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m",
+        "foo: use kzalloc\n\nGenerated by: scripts/coccinelle/api/kzalloc.cocci\n\n@@\nexpression x;\n@@\n- kmalloc(x)\n+ kzalloc(x)\n")
+
+    db = str(tmp_path / "db")
+    retriever = retriever_module.CocciRetriever(db_path=db)
+    manifest_path = IngestManifest.for_store(db, retriever.collection_name).db_path
+    ingested = lambda: sqlite3.connect(manifest_path).execute("SELECT ingested FROM sources WHERE kind = 'commit'").fetchall()
+
+    retriever.ingest_knowledge(repo, str(tmp_path / "cocci"))
+    first = ingested()
+    assert len(first) == 1
+    retriever.ingest_knowledge(repo, str(tmp_path / "cocci"))
+    assert ingested() == first
+    # A new chunker re-chunks the commits already ingested.
+    monkeypatch.setattr(retriever_module, "CHUNKER_VERSION", "next")
+    retriever.ingest_knowledge(repo, str(tmp_path / "cocci"))
+    assert len(ingested()) == 1 and ingested() != first
+
+def test_commit_miner_streams_ranges(tmp_path):
+    from src.rag.commit_miner import mine_commits, mine_commits_parallel, split_range
+
+    repo = str(tmp_path / "repo")
+    git = lambda *args: subprocess.run(["git", "-C", repo, *args], check=True, capture_output=True, text=True).stdout.strip()
+    os.makedirs(repo)
+    git("init", "-q", "-b", "master")
+    git("config", "user.email", "dev@example.com")
+    git("config", "user.name", "dev")
+    messages = [
+        "base",
+        "foo: use kzalloc\n\nGenerated by: scripts/coccinelle/api/kzalloc.cocci\n\n@@\nexpression x;\n@@\n- kmalloc(x)\n+ kzalloc(x)\n",
+        "bar: unrelated fix",
+        "baz: coccinelle cleanup without script",
+        "qux: use ARRAY_SIZE\n\nsemantic patch:\n// <smpl>\n- sizeof(E)/sizeof(E[0])\n+ ARRAY_SIZE(E)\n// </smpl>\n",
+    ]
+    for n, message in enumerate(messages):
+        (tmp_path / "repo" / f"f{n}.c").write_text(f"int f{n};\n")
+        git("add", ".")
+        git("commit", "-q", "-m", message)
+    git("tag", "v1", "HEAD~2")
+
+    commits = list(mine_commits(repo, "master"))
+    assert [c[1] for c in commits] == ["qux: use ARRAY_SIZE", "foo: use kzalloc"]
+    sha, _, script, diff = commits[1]
+    assert sha == git("rev-parse", "HEAD~3") and script.startswith("@@") and "+int f1;" in diff and "f2.c" not in diff
+    assert [c[1] for c in mine_commits(repo, "v1..master")] == ["qux: use ARRAY_SIZE"]
+    assert [c[1] for c in mine_commits(repo, "master", limit=2)] == ["qux: use ARRAY_SIZE"]
+
+    ranges = split_range(repo, "master", parts=3, min_commits=1)
+    assert len(ranges) == 3
+    assert list(mine_commits_parallel(repo, "master", workers=3, min_commits=1)) == commits
+
+def _chunked_source(n: int) -> SourceUpdate:
+    text = "FAIL" if n == 4 else f"chunk {n}"
+    return SourceUpdate(f"file:{n}", "cocci", [Document(page_content=f"{text} {j}") for j in range(n % 3)])
+
+def test_ingest_stream_is_bounded_and_incremental(tmp_path):
+    from src.rag.pipeline import ingest_stream
+
+    manifest = IngestManifest.for_store(str(tmp_path / "db"))
+    store = _FakeStore()
+    produced, windows = [], []
+
+    def tasks():
+        for n in range(12):
+            produced.append(n)
+            yield (_chunked_source, (n,))
+
+    def add(docs, ids):
+        # The parse stage never runs far ahead of the embed stage.
+        windows.append(len(docs))
+        assert len(produced) - sum(windows) <= 12
+        return store.add(docs, ids)
+
+    stats = ingest_stream(store, manifest, tasks(), [], add, parse_workers=2, queue_size=2, window=3, inflight=2)
+    assert stats == {"added": 11, "deleted": 0, "sources": 11, "removed": 0, "failed": 1}
+    assert all(w <= 4 for w in windows) and sum(windows) == 12
+    assert len(store.docs) == 11 and not manifest.has("file:4") and manifest.has("file:11")
+
+    stats = ingest_stream(store, manifest, iter([]), ["file:5"], add, parse_workers=0)
+    assert (stats["removed"], stats["deleted"], len(store.docs)) == (1, 2, 9)
+
+def test_flat_store_export_search_and_import(tmp_path, monkeypatch):
+    from langchain_chroma import Chroma
+    from langchain_core.documents import Document
+    import src.rag.retriever as retriever_module
+    from src.rag.flat_store import FlatVectorStore, export_chroma, flat_path, import_chroma
+
+    embeddings = HashedNgramEmbeddings()
+    db = str(tmp_path / "db")
+    chroma = Chroma(collection_name="cocci_patterns_local", embedding_function=embeddings, persist_directory=db)
+    texts = ["kmalloc then memset", "usb_alloc_urb(0, GFP_KERNEL)", "ARRAY_SIZE(arr)", "spin_lock_irqsave(&lock, flags)"]
+    chroma.add_documents([Document(page_content=t, metadata={"type": "example" if n % 2 else "syntax"})
+                          for n, t in enumerate(texts)], ids=[f"id{n}" for n in range(len(texts))])
+    query = embeddings.embed_query("usb_alloc_urb GFP_KERNEL")
+
+    for dtype in ("float16", "int8"):
+        flat = export_chroma(chroma, flat_path(db, f"test_{dtype}"), dtype=dtype)
+        assert len(flat) == 4 and flat.vectors.dtype.name == dtype
+        hits = flat.similarity_search_by_vector(query, k=2)
+        assert [d.id for d in hits] == [d.id for d in chroma.similarity_search_by_vector(query, k=2)]
+        assert [d.id for d in flat.similarity_search_by_vector(query, k=4, filter={"type": "syntax"})] in (["id0", "id2"], ["id2", "id0"])
+        assert flat.get(ids=["id3"])["documents"] == [texts[3]]
+
+    copy = Chroma(collection_name="imported", embedding_function=embeddings, persist_directory=db)
+    assert import_chroma(FlatVectorStore(flat_path(db, "test_float16")), copy) == 4
+    assert copy.similarity_search_by_vector(query, k=1)[0].page_content == texts[1]
+
+    monkeypatch.setenv("LK_SPG_EMBEDDINGS", "local")
+    monkeypatch.setattr(retriever_module, "VECTOR_BACKEND", "flat")
+    export_chroma(chroma, flat_path(db, "cocci_patterns_local"))
+    retriever = retriever_module.CocciRetriever(db_path=db)
+    assert isinstance(retriever.vector_store, FlatVectorStore) and retriever._chroma is None
+    assert retriever.retrieve("usb_alloc_urb GFP_KERNEL", k=1) == [texts[1]]
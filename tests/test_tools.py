@@ -0,0 +1,432 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import pytest
+from unittest.mock import patch
+from src.agent.speculative import speculative_draft
+from src.mcp_server.async_tools import _exec, arun_spatch_apply, arun_spatch_syntax_check
+from src.mcp_server.cache import SpatchResultCache
+from src.mcp_server.discovery import discover_target_files, tree_dry_run
+from src.mcp_server.prefilter import extract_required_tokens, prefilter_files
+from src.mcp_server.tools import (
+    kernel_grep,
+    lookup_symbol_def,
+    read_window,
+    read_windows,
+    run_spatch_apply,
+    run_spatch_syntax_check,
+    spatch_apply_sharded
+)
+from src.mcp_server import trigram_index
+from src.mcp_server.trigram_index import TrigramIndex, pattern_trigrams
+from src.mcp_server import symbol_index
+from src.mcp_server.symbol_index import SymbolIndex, scan_symbols
+
+# Minimal stand-in for spatch: rewrites old_api -> new_api in-place,
+# fails on any file containing CRASH and hangs on any file containing HANG
+# (after writing its pid to <file>.pid).
+FAKE_SPATCH = textwrap.dedent("""\
+    #!{python}
+    import os, sys, time
+    args = sys.argv[1:]
+    if '--parse-cocci' in args:
+        sys.exit(1 if 'BAD' in open(args[args.index('--parse-cocci') + 1]).read() else 0)
+    files = [a for i, a in enumerate(args) if not a.startswith('-') and args[i - 1] != '--sp-file']
+    rc = 0
+    for f in files:
+        src = open(f).read()
+        if 'HANG' in src:
+            open(f + '.pid', 'w').write(str(os.getpid()))
+            time.sleep(60)
+        if 'CRASH' in src:
+            print('crash on ' + f, file=sys.stderr)
+            rc = 1
+            continue
+        if '--in-place' in args:
+            open(f, 'w').write(src.replace('old_api', 'new_api'))
+        elif 'old_api' in src:
+            print('--- ' + f + '\\n+++ /tmp/cocci-output-' + os.path.basename(f))
+    sys.exit(rc)
+""")
+
+@pytest.fixture
+def fake_spatch(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    spatch = bin_dir / "spatch"
+    spatch.write_text(FAKE_SPATCH.format(python=sys.executable))
+    spatch.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    return spatch
+
+def _make_files(tmp_path, count):
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    files = []
+    for i in range(count):
+        path = src_dir / f"f{i}.c"
+        path.write_text(f"int f{i}(void) {{ return old_api({i}); }}\n")
+        files.append(str(path))
+    return files
+
+def test_sharded_apply_keeps_good_shards(fake_spatch, tmp_path):
+    files = _make_files(tmp_path, 10)
+    with open(files[0], "w") as f:
+        f.write("CRASH old_api\n")
+
+    events = []
+    report = spatch_apply_sharded("@@ @@", files, max_workers=3, shard_size=2, on_progress=events.append)
+
+    assert report["shards"] == 5
+    assert len(report["errors"]) == 1
+    assert files[0] not in report["diffs"]
+    assert len(report["diffs"]) == 9  # f1 shares the failed shard but is still rewritten
+    assert len(events) == 10
+    assert "+int f3(void) { return new_api(3); }" in report["diffs"][files[3]]
+
+def test_run_spatch_apply_summary(fake_spatch, tmp_path):
+    files = _make_files(tmp_path, 3)
+    out = run_spatch_apply("@@ @@", files)
+    assert out.endswith("Summary: 3 changed, 0 unchanged, 0 failed (0/1 shards failed), 0 pruned by prefilter.")
+    assert run_spatch_apply("@@ @@", []) == "No target files specified."
+
+def test_sharded_apply_deduplicates_targets(fake_spatch, tmp_path):
+    files = _make_files(tmp_path, 2)
+    events = []
+    report = spatch_apply_sharded("@@ @@", files + files[:1], max_workers=2, shard_size=1, on_progress=events.append)
+    assert report["shards"] == 2 and len(events) == 2
+    assert run_spatch_apply("@@ @@", files + files).endswith("Summary: 0 changed, 2 unchanged, 0 failed (0/1 shards failed), 0 pruned by prefilter.")
+
+OLD_API_COCCI = """@r@
+expression E;
+@@
+(
+- old_api(E)
++ new_api(E)
+|
+- legacy_api(E, \\(GFP_KERNEL\\|GFP_ATOMIC\\))
++ new_api(E)
+)
+"""
+
+def test_prefilter_prunes_files_without_required_identifiers(fake_spatch, tmp_path):
+    assert extract_required_tokens(OLD_API_COCCI) == [[frozenset({"old_api", "legacy_api"})]]
+    assert extract_required_tokens("@@\nexpression E;\n@@\n- !E\n+ E == 0\n") is None
+
+    files = _make_files(tmp_path, 3)
+    with open(files[1], "w") as f:
+        f.write("int g(void) { return old_api_v2(1); }\n")
+    assert prefilter_files(OLD_API_COCCI, files)["candidates"] == [files[0], files[2]]
+
+    out = run_spatch_apply(OLD_API_COCCI, files)
+    assert out.endswith("Summary: 2 changed, 0 unchanged, 0 failed (0/1 shards failed), 1 pruned by prefilter.")
+
+def test_discover_target_files_is_cached(fake_spatch, tmp_path, monkeypatch):
+    files = _make_files(tmp_path, 6)
+    with open(files[2], "w") as f:
+        f.write("int g(void) { return other_api(2); }\n")
+    root = os.path.dirname(files[0])
+    subprocess.run(["git", "init", "-q", root], check=True)
+    subprocess.run(["git", "-C", root, "add", "."], check=True)
+    subprocess.run(["git", "-C", root, "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-qm", "init"], check=True)
+
+    first = discover_target_files(OLD_API_COCCI, root, shard_size=2)
+    assert first["targets"] == [os.path.realpath(f) for f in files if f != files[2]]
+    assert first["candidates"] == 5 and not first["cached"]
+    assert discover_target_files(OLD_API_COCCI, root)["cached"]
+
+    # Editing the tree invalidates the cached result.
+    with open(files[2], "w") as f:
+        f.write("int g(void) { return old_api(2); }\n")
+    assert len(discover_target_files(OLD_API_COCCI, root)["targets"]) == 6
+
+def test_tree_dry_run_streams_and_writes_series(fake_spatch, tmp_path, monkeypatch):
+    files = _make_files(tmp_path, 4)
+    with open(files[3], "w") as f:
+        f.write("CRASH old_api\n")
+    root = os.path.dirname(files[0])
+    out_dir = tmp_path / "series"
+
+    events = list(tree_dry_run(OLD_API_COCCI, root, output_dir=str(out_dir), shard_size=1))
+    assert events[0]["event"] == "start" and events[0]["candidates"] == 4
+    matched = [e for e in events if e["event"] == "file"]
+    assert sorted(e["file"] for e in matched) == ["f0.c", "f1.c", "f2.c"]
+    assert matched[0]["diff"].startswith(f"--- a/{matched[0]['file']}\n+++ b/{matched[0]['file']}")
+    assert [e["files"] for e in events if e["event"] == "error"] == [["f3.c"]]
+    assert events[-1]["event"] == "done"
+    assert events[-1]["counts"]["files_matched"] == 3 and events[-1]["counts"]["errors"] == 1
+
+    assert (out_dir / "series").read_text() == "f0.c.patch\nf1.c.patch\nf2.c.patch\n"
+    assert (out_dir / "f1.c.patch").exists()
+    assert json.loads((out_dir / "summary.json").read_text())["scanned"] == 4
+
+def test_tree_dry_run_kills_spatch_when_abandoned(fake_spatch, tmp_path):
+    import time
+    files = _make_files(tmp_path, 2)
+    with open(files[1], "w") as f:
+        f.write("HANG old_api\n")
+    root = os.path.dirname(files[0])
+
+    events = tree_dry_run(OLD_API_COCCI, root, output_dir=str(tmp_path / "series"), shard_size=1)
+    assert next(events)["event"] == "start"
+    assert next(events)["file"] == "f0.c"
+    deadline = time.monotonic() + 10
+    while not os.path.exists(files[1] + ".pid") and time.monotonic() < deadline:
+        time.sleep(0.05)
+    pid = int(open(files[1] + ".pid").read())
+
+    # Closing the stream (as on a client disconnect) kills the hanging spatch.
+    started = time.monotonic()
+    events.close()
+    assert time.monotonic() - started < 5
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+def test_syntax_check_is_cached(fake_spatch, tmp_path):
+    cache = SpatchResultCache(db_path=str(tmp_path / "cache.sqlite3"))
+    with patch("src.mcp_server.tools.get_spatch_cache", return_value=cache):
+        assert run_spatch_syntax_check("@@ BAD @@").startswith("Syntax Error")
+        assert run_spatch_syntax_check("@@ BAD @@").startswith("Syntax Error")
+        assert run_spatch_syntax_check("@@ @@") == "OK"
+    assert cache.stats()["memory_hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+    # A fresh instance over the same file is served from disk.
+    reopened = SpatchResultCache(db_path=cache.db_path)
+    assert reopened.get(reopened.make_key("syntax_check", "@@ @@")) == "OK"
+    assert reopened.stats()["disk_hits"] == 1
+
+def test_spatch_cache_evicts_least_recently_used_from_disk(tmp_path, monkeypatch):
+    from src.mcp_server import cache as cache_module
+
+    cache = SpatchResultCache(db_path=str(tmp_path / "cache.sqlite3"), max_memory_entries=0, max_disk_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"  # b is now the least recently used
+    cache.put("c", "3")
+    assert cache.get("b") is None and cache.get("a") == "1" and cache.stats()["disk_entries"] == 2
+
+    # A fingerprint taken while spatch is missing is not kept once it shows up.
+    monkeypatch.setattr(cache_module, "_fingerprint", None)
+    monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+    missing = cache_module.spatch_fingerprint()
+    assert cache_module._fingerprint is None
+    monkeypatch.setattr(cache_module.subprocess, "run", lambda *a, **k: subprocess.CompletedProcess(a, 0, "spatch 1.1.1\n", ""))
+    assert cache_module.spatch_fingerprint() != missing and cache_module._fingerprint is not None
+
+def test_kernel_grep_uses_trigram_index(tmp_path, monkeypatch):
+    files = _make_files(tmp_path, 20)
+    with open(files[7], "a") as f:
+        f.write("struct urb *u = usb_alloc_urb(0, GFP_KERNEL);\n")
+    root = str(tmp_path / "src")
+
+    assert pattern_trigrams("foo\\|bar") is None
+    assert pattern_trigrams("a.b") is None
+    assert pattern_trigrams("usb_alloc_urb(") is not None
+
+    TrigramIndex.build(root, jobs=1)
+    index = TrigramIndex.find(root)
+    assert index.candidates("usb_alloc_urb(", root) == [files[7]]
+
+    # Outside git, queries do not walk the tree: rewritten files are reported by the
+    # apply tools, other edits are picked up by update().
+    with open(files[3], "a") as f:
+        f.write("void y(void) { usb_alloc_urb(1, 0); }\n")
+    with open(files[4], "a") as f:
+        f.write("void z(void) { usb_alloc_urb(2, 0); }\n")
+    index._last_refresh = 0.0
+    assert index.candidates("usb_alloc_urb(", root) == [files[7]]
+    trigram_index.expire_refresh([files[3]])
+    assert index.candidates("usb_alloc_urb(", root) == [files[3], files[7]]
+
+    # Binary files are not indexed but still grepped.
+    (tmp_path / "src" / "fw.bin").write_bytes(b"\0\1usb_alloc_urb(\n")
+
+    # Files added after the build are picked up by update()
+    (tmp_path / "src" / "late.c").write_text("void x(void) { usb_alloc_urb(0, 0); }\n")
+    index.update()
+    out = kernel_grep("usb_alloc_urb(", root)
+    assert f"{files[7]}:2:struct urb" in out
+    assert "late.c:1:" in out and f"{files[4]}:2:" in out
+    index = TrigramIndex.build(root, jobs=1)
+    assert os.path.join(root, "fw.bin") in index.candidates("usb_alloc_urb(", root)
+    plain = subprocess.run(["grep", "-rn", "usb_alloc_urb(", root], capture_output=True, text=True)
+    assert sorted(kernel_grep("usb_alloc_urb(", root).splitlines()) == sorted(plain.stdout.splitlines())
+
+def test_trigram_index_in_git_subdirectory(tmp_path, monkeypatch):
+    files = _make_files(tmp_path, 3)
+    git = lambda *args: subprocess.run(["git", "-C", str(tmp_path)] + list(args), check=True, capture_output=True)
+    git("init", "-q")
+    git("add", "src")
+    git("-c", "user.name=t", "-c", "user.email=t@t", "commit", "-qm", "init")
+    root = str(tmp_path / "src")
+    index = TrigramIndex.build(root, jobs=1)
+    assert index.candidates("usb_alloc_urb(", root) == []
+
+    # git diff prints paths from the repo top; the index root is a subdirectory.
+    with open(files[1], "a") as f:
+        f.write("void y(void) { usb_alloc_urb(1, 0); }\n")
+    index._last_refresh = 0.0
+    assert index.candidates("usb_alloc_urb(", root) == [files[1]]
+
+SYMBOLS_C = """\
+#define URB_MAX 4
+struct urb {
+	int status;
+};
+typedef int (*complete_t)(struct urb *);
+struct urb *usb_alloc_urb(int iso_packets,
+			  gfp_t mem_flags)
+{
+	return NULL;
+}
+int usb_submit_urb(struct urb *urb, gfp_t mem_flags);
+EXPORT_SYMBOL(usb_alloc_urb);
+"""
+
+def test_scan_symbols():
+    found = {(name, kind, line) for name, kind, line, _ in scan_symbols(SYMBOLS_C)}
+    assert found == {
+        ("URB_MAX", "macro", 1),
+        ("urb", "struct", 2),
+        ("complete_t", "typedef", 5),
+        ("usb_alloc_urb", "function", 6),
+        ("usb_submit_urb", "prototype", 11),
+    }
+
+def test_lookup_symbol_def_uses_index(tmp_path, monkeypatch):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "urb.c").write_text(SYMBOLS_C)
+    SymbolIndex.build(str(tmp_path / "src"), jobs=1)
+
+    out = lookup_symbol_def("usb_alloc_urb", str(tmp_path / "src"))
+    assert out == f"--- Matches for 'usb_alloc_urb(' ---\n{tmp_path}/src/urb.c:6:struct urb *usb_alloc_urb(int iso_packets,"
+
+    # Files rewritten after the build are re-scanned, so the line numbers stay current.
+    (tmp_path / "src" / "urb.c").write_text("#include <linux/usb.h>\n\n" + SYMBOLS_C)
+    (tmp_path / "src" / "new.c").write_text("int usb_alloc_urb(int n);\n")
+    symbol_index.expire_refresh()
+    out = lookup_symbol_def("usb_alloc_urb", str(tmp_path / "src"))
+    assert f"{tmp_path}/src/urb.c:8:struct urb *usb_alloc_urb(int iso_packets," in out
+    assert f"{tmp_path}/src/new.c:1:int usb_alloc_urb(int n);" in out
+
+def test_read_window_and_batch(tmp_path):
+    path = tmp_path / "big.c"
+    path.write_text("".join(f"line {i}\n" for i in range(1, 101)))
+
+    assert read_window(str(path), 50, 1) == "49: line 49\n50: line 50\n51: line 51"
+    assert read_window(str(path), 100, 2).splitlines()[-1] == "100: line 100"
+
+    # Appending invalidates the cached line offsets.
+    with open(path, "a") as f:
+        f.write("line 101")
+    assert read_window(str(path), 101, 0) == "101: line 101"
+
+    out = read_windows([
+        {"file_path": str(path), "line_number": 2, "window_size": 0},
+        {"file_path": str(tmp_path / "missing.c"), "line_number": 1},
+        {"file_path": str(path), "line_number": 3, "window_size": 0},
+    ])
+    sections = out.split("\n\n")
+    assert sections[0] == f"==> {path}:2 <==\n2: line 2"
+    assert sections[1].startswith(f"==> {tmp_path}/missing.c:1 <==\nError reading file")
+    assert sections[2] == f"==> {path}:3 <==\n3: line 3"
+
+    # A malformed window gets its own error section instead of failing the call.
+    out = read_windows([{"file_path": str(path)}, {"file_path": str(path), "line_number": "x"}, {"file_path": str(path), "line_number": 4, "window_size": 0}])
+    sections = out.split("\n\n")
+    assert sections[0].startswith("==> window 0 <==\nError: invalid window") and "KeyError" in sections[0]
+    assert sections[1].startswith("==> window 1 <==\nError: invalid window") and "ValueError" in sections[1]
+    assert sections[2] == f"==> {path}:4 <==\n4: line 4"
+
+def test_async_tools(fake_spatch, tmp_path):
+    files = _make_files(tmp_path, 4)
+    cache = SpatchResultCache(db_path=str(tmp_path / "cache.sqlite3"))
+
+    async def scenario():
+        with patch("src.mcp_server.async_tools.get_spatch_cache", return_value=cache):
+            checks = await asyncio.gather(arun_spatch_syntax_check("@@ @@"), arun_spatch_syntax_check("@@ BAD @@"))
+        applied = await arun_spatch_apply("@@ @@", files)
+        with pytest.raises(asyncio.TimeoutError):
+            await _exec(["sleep", "5"], timeout=0.2)
+        return checks, applied
+
+    checks, applied = asyncio.run(scenario())
+    assert checks[0] == "OK"
+    assert checks[1].startswith("Syntax Error")
+    assert applied.endswith("Summary: 4 changed, 0 unchanged, 0 failed (0/1 shards failed), 0 pruned by prefilter.")
+
+def test_async_subprocess_cap_is_process_wide(monkeypatch):
+    import threading
+    import time
+    from src.mcp_server import async_tools
+
+    monkeypatch.setattr(async_tools, "_slots", threading.BoundedSemaphore(1))
+    sleep = [sys.executable, "-c", "import time; time.sleep(0.3)"]
+
+    async def cancelled_waiter():
+        task = asyncio.ensure_future(_exec(sleep, timeout=5))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    # Two event loops in two threads (like job workers) share the one slot.
+    started = time.monotonic()
+    threads = [threading.Thread(target=lambda: asyncio.run(_exec(sleep, timeout=5))) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.monotonic() - started >= 0.6
+    asyncio.run(cancelled_waiter())
+    assert async_tools._slots.acquire(timeout=2)  # No slot was leaked
+
+    async def many_waiters():
+        # Waiting for a slot does not park a thread per waiter.
+        tasks = [asyncio.ensure_future(_exec(sleep, timeout=5)) for _ in range(20)]
+        await asyncio.sleep(0.1)
+        busy = threading.active_count()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return busy
+
+    assert asyncio.run(many_waiters()) <= threading.active_count() + 1
+    async_tools._slots.release()
+
+class _FakeDraftLLM:
+    """Drafts a broken script, a good one, or hangs, depending on the candidate hint."""
+
+    def __init__(self):
+        self.cancelled = 0
+
+    async def ainvoke(self, prompt):
+        if "simplest rule" in prompt:
+            script = "@@\n@@\n- old_api(1)\n+ new_api(1)\n"
+        elif "disjunctions" in prompt:
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            script = ""
+        else:
+            script = "@@ BAD"
+        content = json.dumps({"cocci_script": script, "mock_c": "int f(void) { return old_api(1); }\n"})
+        return type("Response", (), {"content": content})
+
+def test_speculative_draft_takes_first_passing_candidate(fake_spatch, monkeypatch):
+    monkeypatch.setenv("LK_SPG_SPATCH_CACHE", "0")
+    llm = _FakeDraftLLM()
+    result = asyncio.run(speculative_draft(llm, "Task: migrate old_api", k=3, concurrency=3))
+    assert result["winner"]["index"] == 1
+    assert result["winner"]["patch_preview"].startswith("--- ")
+    assert llm.cancelled == 1
+
+    failed = asyncio.run(speculative_draft(llm, "Task: migrate old_api", k=1))
+    assert failed["winner"] is None
+    assert failed["best"]["stage"] == "syntax_check"
+    assert failed["best"]["error"].startswith("Syntax Error")